@@ -1,6 +1,7 @@
 from flask import Flask
 from flask_cors import CORS
-from .routes import api
+from .routes import api, run_chat_job
+from .services.jobs import get_job_queue
 from .databases.mimiciv import MIMICIVNotesDatabase
 from .databases.n2c22018 import N2C22018CTMatchingDatabase
 
@@ -21,4 +22,7 @@ def create_app():
     
     app.register_blueprint(api, url_prefix='/api')
 
+    # Run queued /api/jobs in the background (and resume any that were interrupted)
+    get_job_queue().start(run_chat_job)
+
     return app
\ No newline at end of file
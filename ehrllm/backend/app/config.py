@@ -17,6 +17,110 @@ PATH_TO_MIMICIV_DIR = os.getenv("PATH_TO_MIMICIV_DIR", get_rel_path("../../data/
 
 ## N2C2 2018
 PATH_TO_N2C22018_DIR = os.getenv("PATH_TO_N2C22018_DIR", get_rel_path("../../data/n2c2-2018/"))
+# Number of processes used to parse XML files that aren't already in the parse cache
+N2C22018_N_WORKERS = int(os.getenv("N2C22018_N_WORKERS", os.cpu_count() or 1))
 
 ## LLM Cache
-PATH_TO_CACHE_DIR = os.getenv("PATH_TO_CACHE_DIR", get_rel_path("../../cache/"))
\ No newline at end of file
+PATH_TO_CACHE_DIR = os.getenv("PATH_TO_CACHE_DIR", get_rel_path("../../cache/"))
+# Backend for the LLM response cache: 'sqlite', 'directory', or 'none' to disable
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "sqlite")
+# Evict cached LLM responses older than this many seconds (0 => never expire)
+LLM_CACHE_MAX_AGE_SECONDS = float(os.getenv("LLM_CACHE_MAX_AGE_SECONDS", 30 * 24 * 60 * 60)) or None
+# Evict least recently used LLM responses beyond this many entries (0 => unlimited)
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 1_000_000)) or None
+
+## MIMIC-IV notes snapshot (normalized, patient-sorted Arrow IPC file that is memory-mapped at startup)
+PATH_TO_MIMICIV_SNAPSHOT_DIR = os.getenv("PATH_TO_MIMICIV_SNAPSHOT_DIR", os.path.join(PATH_TO_CACHE_DIR, "mimiciv-notes-snapshot/"))
+# If True, only keep note metadata resident and lazily read note text from the snapshot's text blob on demand
+IS_MIMICIV_LAZY_TEXT = os.getenv("IS_MIMICIV_LAZY_TEXT", "false").lower() == "true"
+# Number of patients whose note texts are kept in memory when `IS_MIMICIV_LAZY_TEXT` is True
+MIMICIV_TEXT_CACHE_N_PATIENTS = int(os.getenv("MIMICIV_TEXT_CACHE_N_PATIENTS", 256))
+
+## n2c2 2018 parse cache (parsed patients, keyed by XML file path + mtime + size)
+PATH_TO_N2C22018_CACHE_DIR = os.getenv("PATH_TO_N2C22018_CACHE_DIR", os.path.join(PATH_TO_CACHE_DIR, "n2c2-2018/"))
+
+## LLM execution
+# How per-note LLM calls are fanned out: 'async' (shared event loop + global concurrency limit) or 'thread' (per-request thread pool)
+LLM_EXECUTION_ENGINE = os.getenv("LLM_EXECUTION_ENGINE", "async")
+# Max # of in-flight LLM calls across all requests in this process ('async' engine only)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 64))
+# Max # of LLM calls started per second across all requests in this process (0 => unlimited; 'async' engine only)
+LLM_MAX_REQUESTS_PER_SECOND = float(os.getenv("LLM_MAX_REQUESTS_PER_SECOND", 0))
+# Backoff before the first retry of a failed LLM call (doubled on each subsequent retry, with full jitter)
+LLM_RETRY_BASE_DELAY_SECONDS = float(os.getenv("LLM_RETRY_BASE_DELAY_SECONDS", 1))
+# Cap on the backoff before any single retry
+LLM_RETRY_MAX_DELAY_SECONDS = float(os.getenv("LLM_RETRY_MAX_DELAY_SECONDS", 60))
+# If True, mark the static prefix of note-level prompts (system prompt + note) with `cache_control` for providers that need explicit prompt caching hints (e.g. Anthropic)
+IS_PROMPT_CACHE_CONTROL_ENABLED = os.getenv("IS_PROMPT_CACHE_CONTROL_ENABLED", "true").lower() == "true"
+
+## Chat pipeline
+# Pack multiple short notes into one LLM call, up to this many note tokens per call (0 => one call per note)
+NOTE_PACKING_TOKEN_BUDGET = int(os.getenv("NOTE_PACKING_TOKEN_BUDGET", 0))
+# Notes longer than this fraction of the model's context window are split into chunks (on section boundaries)
+NOTE_CHUNK_CONTEXT_FRACTION = float(os.getenv("NOTE_CHUNK_CONTEXT_FRACTION", 0.5))
+# Consecutive chunks of a note overlap by this many tokens
+NOTE_CHUNK_OVERLAP_TOKENS = int(os.getenv("NOTE_CHUNK_OVERLAP_TOKENS", 200))
+# Context window assumed for models that litellm doesn't know about
+DEFAULT_MODEL_MAX_INPUT_TOKENS = int(os.getenv("DEFAULT_MODEL_MAX_INPUT_TOKENS", 8192))
+# Max # of tokens of note-level responses per aggregation call. If exceeded, responses are aggregated 
+# hierarchically (in groups, in parallel) until they fit. 0 => derive from the model's context window.
+AGGREGATION_TOKEN_BUDGET = int(os.getenv("AGGREGATION_TOKEN_BUDGET", 0))
+# If True, notes are pruned with a cheap lexical (BM25 + synonyms) pre-filter before being sent to the LLM (overridable per request via `settings.prefilter`)
+IS_PREFILTER_ENABLED = os.getenv("IS_PREFILTER_ENABLED", "false").lower() == "true"
+# Pre-filter keeps the top-scoring notes that account for this fraction of the total BM25 score
+PREFILTER_RECALL = float(os.getenv("PREFILTER_RECALL", 0.95))
+# Pre-filter keeps at most this many notes (0 => no limit)
+PREFILTER_TOP_K = int(os.getenv("PREFILTER_TOP_K", 0))
+# Number of patients whose lazily-built note indexes are kept in memory
+NOTE_INDEX_CACHE_N_PATIENTS = int(os.getenv("NOTE_INDEX_CACHE_N_PATIENTS", 256))
+# If True, near-duplicate notes and sections copied forward verbatim from a newer note are only sent to the LLM once (overridable per request via `settings.dedup`)
+IS_NOTE_DEDUP_ENABLED = os.getenv("IS_NOTE_DEDUP_ENABLED", "true").lower() == "true"
+# Notes whose estimated Jaccard similarity (over word shingles) to a newer note is at least this are treated as duplicates of it
+NOTE_DEDUP_THRESHOLD = float(os.getenv("NOTE_DEDUP_THRESHOLD", 0.9))
+# Sections (blank-line separated blocks) shorter than this many characters are never elided as copied forward
+NOTE_DEDUP_MIN_SECTION_CHARS = int(os.getenv("NOTE_DEDUP_MIN_SECTION_CHARS", 200))
+# Shingle size (in words) and # of permutations of the MinHash signatures computed for every note at load time
+NOTE_DEDUP_SHINGLE_SIZE = int(os.getenv("NOTE_DEDUP_SHINGLE_SIZE", 5))
+NOTE_DEDUP_N_PERMUTATIONS = int(os.getenv("NOTE_DEDUP_N_PERMUTATIONS", 64))
+
+## Model cascade (cheap relevance triage before the main model)
+# Small / local model (e.g. 'ollama/llama3.2') that first triages every note for relevance, so that only notes it escalates are read by the main model ('' => no triage; overridable per request via `settings.triage_model`)
+TRIAGE_MODEL = os.getenv("TRIAGE_MODEL", "")
+# Notes the triage model marks irrelevant with a confidence below this are escalated anyway (overridable per request via `settings.triage_min_confidence`)
+TRIAGE_MIN_CONFIDENCE = float(os.getenv("TRIAGE_MIN_CONFIDENCE", 0.8))
+
+## Cohort-wide full-text search index (SQLite FTS5) over all notes in all databases
+PATH_TO_SEARCH_INDEX = os.getenv("PATH_TO_SEARCH_INDEX", os.path.join(PATH_TO_CACHE_DIR, "search_index.sqlite"))
+
+## Telemetry
+# If set, a JSONL trace (spans + LLM usage) of every API request is appended to this file
+PATH_TO_TRACE_FILE = os.getenv("PATH_TO_TRACE_FILE", "") or None
+
+## /api/chat response cache (in-memory LRU in front of an on-disk store)
+# Backend for the on-disk store: 'sqlite', 'directory', or 'none' to keep responses in memory only
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "sqlite")
+# Cached responses older than this many seconds are recomputed (0 => never expire)
+RESPONSE_CACHE_MAX_AGE_SECONDS = float(os.getenv("RESPONSE_CACHE_MAX_AGE_SECONDS", 7 * 24 * 60 * 60)) or None
+# Evict least recently used responses on disk beyond this many entries (0 => unlimited)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 100_000)) or None
+# Number of most recently used responses also kept in memory
+RESPONSE_CACHE_MEMORY_N_ENTRIES = int(os.getenv("RESPONSE_CACHE_MEMORY_N_ENTRIES", 1024))
+
+## Follow-up turns (per-conversation state, in memory)
+# If True, follow-up messages are answered from the previous turn's per-note evidence (or only re-query the notes it found relevant) when possible, instead of re-scanning every note (overridable per request via `settings.follow_up`)
+IS_FOLLOW_UP_REUSE_ENABLED = os.getenv("IS_FOLLOW_UP_REUSE_ENABLED", "true").lower() == "true"
+# Number of most recent turns whose per-note responses are kept in memory
+CONVERSATION_STORE_N_ENTRIES = int(os.getenv("CONVERSATION_STORE_N_ENTRIES", 1024))
+# Turns older than this many seconds can no longer be followed up on incrementally (0 => never expire)
+CONVERSATION_MAX_AGE_SECONDS = float(os.getenv("CONVERSATION_MAX_AGE_SECONDS", 24 * 60 * 60)) or None
+
+## Background jobs (durable SQLite queue for long-running chart reviews, see /api/jobs)
+PATH_TO_JOBS_DB = os.getenv("PATH_TO_JOBS_DB", os.path.join(PATH_TO_CACHE_DIR, "jobs.sqlite"))
+# Number of jobs each backend process runs at once (0 => only accept jobs, don't run them). All of their LLM calls share the `LLM_MAX_CONCURRENCY` limit.
+JOB_N_WORKERS = int(os.getenv("JOB_N_WORKERS", 4))
+# A running job whose process hasn't sent a heartbeat for this many seconds (e.g. it was restarted) is picked up again, resuming from its saved note-level results
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", 60))
+# Jobs are marked failed after being picked up this many times without finishing
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+# Notes are queried in batches of this many, checking for cancellation between batches
+JOB_NOTE_BATCH_SIZE = int(os.getenv("JOB_NOTE_BATCH_SIZE", 64))
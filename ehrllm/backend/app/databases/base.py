@@ -1,8 +1,22 @@
+import datetime
+import threading
+from collections import OrderedDict
 from typing import Any, Dict, List, Optional
+import numpy as np
+from ehrllm.backend.app.config import NOTE_INDEX_CACHE_N_PATIENTS
+from ehrllm.backend.app.models import Note, NoteFilter
+from ehrllm.backend.app.services.dedup import get_note_signatures
+from ehrllm.backend.app.services.prefilter import NoteIndex
+from ehrllm.inflight import get_inflight_deduplicator
 
 class BaseDatabase:
     name: str = "base"
     _instance: Optional['BaseDatabase'] = None
+    # LRU of patient_id => NoteIndex over that patient's notes
+    _patient_id_2_note_index: 'OrderedDict[str, NoteIndex]'
+    _patient_id_2_note_index_lock: threading.Lock
+    # LRU of patient_id => { note_id => MinHash signature } of that patient's notes
+    _patient_id_2_note_signatures: 'OrderedDict[str, Dict[str, np.ndarray]]'
 
     def __init__(self):
         raise RuntimeError('Call instance() instead')
@@ -10,18 +24,70 @@ class BaseDatabase:
     @classmethod
     def instance(cls) -> 'BaseDatabase':
         if cls._instance is None:
-            cls._instance = cls.__new__(cls)
-            cls._instance.load_data()
+            # Concurrent first calls share one load, and the instance is only published once fully loaded
+            get_inflight_deduplicator('database_load').run(cls.name, cls._create_instance)
         return cls._instance
+
+    @classmethod
+    def _create_instance(cls) -> None:
+        if cls._instance is not None:
+            # Loaded by a call that finished just before this one started
+            return
+        instance = cls.__new__(cls)
+        instance._patient_id_2_note_index = OrderedDict()
+        instance._patient_id_2_note_index_lock = threading.Lock()
+        instance._patient_id_2_note_signatures = OrderedDict()
+        instance.load_data()
+        cls._instance = instance
     
     def load_data(self) -> None:
         raise NotImplementedError('Subclasses must implement this method')
     
-    def get_patient_notes(self, patient_id: int) -> List[Dict[str, Any]]:
+    def get_patient_notes(self, patient_id: int, note_filter: Optional[NoteFilter] = None) -> List[Note]:
+        """A patient's notes (most recent first), restricted to those matching `note_filter` (if provided)"""
         raise NotImplementedError('Subclasses must implement this method')
 
     def get_patient_metadata(self, patient_id: int) -> Dict[str, Any]:
         raise NotImplementedError('Subclasses must implement this method')
 
     def is_patient_exists(self, patient_id: int) -> bool:
-        raise NotImplementedError('Subclasses must implement this method')
\ No newline at end of file
+        raise NotImplementedError('Subclasses must implement this method')
+
+    def get_patient_latest_note_datetime(self, patient_id: str) -> Optional[datetime.datetime]:
+        """chartdatetime of the patient's most recent (dated) note, i.e. the default anchor for relative time windows"""
+        dates: List[datetime.datetime] = [ note.chartdatetime for note in self.load_patient_notes(patient_id) if note.chartdatetime is not None ]
+        return max(dates) if len(dates) > 0 else None
+
+    def load_patient_notes(self, patient_id: str, note_filter: Optional[NoteFilter] = None) -> List[Note]:
+        """Same as `get_patient_notes()`, except that concurrent loads of the same patient (and filter) share one load"""
+        notes: List[Note] = get_inflight_deduplicator('patient_notes').run((self.name, patient_id, note_filter), self.get_patient_notes, patient_id, note_filter)
+        # Notes are shared between callers, so only the list is copied
+        return list(notes)
+
+    def get_patient_note_index(self, patient_id: str) -> NoteIndex:
+        """Inverted index over a patient's notes (for pre-filtering). 
+            By default, built on first access and cached for recently viewed patients."""
+        with self._patient_id_2_note_index_lock:
+            if patient_id in self._patient_id_2_note_index:
+                self._patient_id_2_note_index.move_to_end(patient_id)
+                return self._patient_id_2_note_index[patient_id]
+        index: NoteIndex = get_inflight_deduplicator('note_index').run((self.name, patient_id), lambda: NoteIndex(self.load_patient_notes(patient_id)))
+        with self._patient_id_2_note_index_lock:
+            self._patient_id_2_note_index[patient_id] = index
+            while len(self._patient_id_2_note_index) > NOTE_INDEX_CACHE_N_PATIENTS:
+                self._patient_id_2_note_index.popitem(last=False)
+        return index
+
+    def get_patient_note_signatures(self, patient_id: str) -> Dict[str, np.ndarray]:
+        """note_id => MinHash signature of each of a patient's notes (for near-duplicate detection).
+            By default, computed on first access and cached for recently viewed patients."""
+        with self._patient_id_2_note_index_lock:
+            if patient_id in self._patient_id_2_note_signatures:
+                self._patient_id_2_note_signatures.move_to_end(patient_id)
+                return self._patient_id_2_note_signatures[patient_id]
+        signatures: Dict[str, np.ndarray] = get_note_signatures(self.load_patient_notes(patient_id))
+        with self._patient_id_2_note_index_lock:
+            self._patient_id_2_note_signatures[patient_id] = signatures
+            while len(self._patient_id_2_note_signatures) > NOTE_INDEX_CACHE_N_PATIENTS:
+                self._patient_id_2_note_signatures.popitem(last=False)
+        return signatures
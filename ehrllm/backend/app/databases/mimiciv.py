@@ -1,62 +1,287 @@
 import os
+import json
+import datetime
+import fcntl
+import mmap
+import time
+import threading
+from collections import OrderedDict
 from enum import Enum
 from ehrllm.backend.app.databases.base import BaseDatabase
-from ehrllm.backend.app.models import Note
+from ehrllm.backend.app.models import Note, NoteFilter
+from ehrllm.backend.app.services.dedup import compute_minhashes
+from ehrllm.llms.utils import run_in_parallel
+import numpy as np
 import polars as pl
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 from ehrllm.utils import get_rel_path
-from ehrllm.backend.app.config import IS_DEBUG, PATH_TO_MIMICIV_NOTES_DIR
+from ehrllm.backend.app.config import (
+    IS_DEBUG, 
+    IS_MIMICIV_LAZY_TEXT, 
+    MIMICIV_TEXT_CACHE_N_PATIENTS, 
+    NOTE_DEDUP_N_PERMUTATIONS,
+    NOTE_DEDUP_SHINGLE_SIZE,
+    PATH_TO_MIMICIV_NOTES_DIR, 
+    PATH_TO_MIMICIV_SNAPSHOT_DIR
+)
 from loguru import logger
 
 class MIMICIVNoteType(Enum):
     DISCHARGE = "discharge"
     RADIOLOGY = "radiology"
 
+# Bump whenever the normalization in `load_notes_from_csvs()` changes, to invalidate existing snapshots
+SNAPSHOT_VERSION: int = 3
+SNAPSHOT_FILENAME: str = "notes.arrow"
+# Concatenated UTF-8 note texts, addressed by the snapshot's `text_offset` / `text_length` columns
+SNAPSHOT_TEXT_BLOB_FILENAME: str = "text.bin"
+SNAPSHOT_MANIFEST_FILENAME: str = "manifest.json"
+# # of notes per task when computing MinHash signatures across a process pool
+MINHASH_BATCH_SIZE: int = 10_000
+
+def get_source_paths(data_dir: str) -> List[str]:
+    """Paths to the raw MIMIC-IV note CSVs"""
+    return [ os.path.join(data_dir, 'discharge.csv'), os.path.join(data_dir, 'radiology.csv') ]
+
+def get_snapshot_manifest(source_paths: List[str]) -> Dict[str, Any]:
+    """Fingerprint of the source CSVs (mtime + size) that a snapshot was built from"""
+    return {
+        'version' : SNAPSHOT_VERSION,
+        'minhash' : { 'shingle_size' : NOTE_DEDUP_SHINGLE_SIZE, 'n_permutations' : NOTE_DEDUP_N_PERMUTATIONS },
+        'sources' : [
+            { 'path' : os.path.abspath(path), 'mtime' : os.stat(path).st_mtime, 'size' : os.stat(path).st_size }
+            for path in source_paths
+        ],
+    }
+
+def is_snapshot_valid(snapshot_dir: str, source_paths: List[str]) -> bool:
+    """True if the snapshot in `snapshot_dir` was built from the current versions of `source_paths`"""
+    path_to_manifest: str = os.path.join(snapshot_dir, SNAPSHOT_MANIFEST_FILENAME)
+    for filename in [SNAPSHOT_MANIFEST_FILENAME, SNAPSHOT_FILENAME, SNAPSHOT_TEXT_BLOB_FILENAME]:
+        if not os.path.exists(os.path.join(snapshot_dir, filename)):
+            return False
+    with open(path_to_manifest, 'r') as f:
+        manifest: Dict[str, Any] = json.load(f)
+    return manifest == get_snapshot_manifest(source_paths)
+
+def load_notes_from_csvs(source_paths: List[str]) -> pl.DataFrame:
+    """Parse the raw CSVs into a normalized dataframe sorted by (subject_id, charttime)"""
+    return (
+        pl.concat([ pl.scan_csv(path) for path in source_paths ])
+        .select([
+            pl.col('note_id'),
+            pl.col('subject_id').cast(pl.Utf8),
+            pl.col('hadm_id').cast(pl.Utf8),
+            pl.col('note_type').replace({
+                'DS' : MIMICIVNoteType.DISCHARGE.value,
+                'LR' : MIMICIVNoteType.RADIOLOGY.value,
+            }),
+            pl.col('charttime').str.to_datetime('%Y-%m-%d %H:%M:%S', strict=False),
+            pl.col('text').fill_null(''),
+        ])
+        # Sort by (subject_id, charttime) so that each patient's notes sit in one contiguous slice
+        .sort(['subject_id', 'charttime'])
+        # Byte range of each note's text in the text blob (which is written in this same row order)
+        .with_columns(pl.col('text').str.len_bytes().cast(pl.Int64).alias('text_length'))
+        .with_columns((pl.col('text_length').cum_sum() - pl.col('text_length')).alias('text_offset'))
+        .collect()
+    )
+
+def compute_minhash_column(texts: List[str]) -> pl.Series:
+    """MinHash signature of each note (for near-duplicate detection), computed across a process pool"""
+    batches: List[List[str]] = [ texts[idx:idx + MINHASH_BATCH_SIZE] for idx in range(0, len(texts), MINHASH_BATCH_SIZE) ]
+    signatures: List[np.ndarray] = run_in_parallel(compute_minhashes, 
+                                                   [ (batch, ) for batch in batches ], 
+                                                   max_workers=max(1, min(os.cpu_count() or 1, len(batches))), 
+                                                   pool_strat='process', 
+                                                   merge_strat='append')
+    # `run_in_parallel()` returns None for batches whose worker raised
+    failed_batch_idxs: List[int] = [ idx for idx, signature in enumerate(signatures) if signature is None ]
+    if len(failed_batch_idxs) > 0:
+        raise RuntimeError(f"Failed to compute MinHash signatures for batch(es) {failed_batch_idxs} of {len(batches)} ({MINHASH_BATCH_SIZE} notes each). See the worker traceback(s) printed above.")
+    if len(signatures) == 0:
+        return pl.Series('minhash', np.zeros((0, NOTE_DEDUP_N_PERMUTATIONS), dtype=np.uint32))
+    return pl.Series('minhash', np.concatenate(signatures))
+
+def build_snapshot(data_dir: str, snapshot_dir: str) -> str:
+    """Parse the source CSVs in `data_dir` and write a normalized snapshot to `snapshot_dir`.
+        Returns the path to the snapshot file."""
+    source_paths: List[str] = get_source_paths(data_dir)
+    path_to_snapshot: str = os.path.join(snapshot_dir, SNAPSHOT_FILENAME)
+    os.makedirs(snapshot_dir, exist_ok=True)
+
+    start_time = time.time()
+    logger.info(f"Building snapshot of {source_paths} at {path_to_snapshot}")
+    df_notes: pl.DataFrame = load_notes_from_csvs(source_paths)
+    df_notes = df_notes.with_columns(compute_minhash_column(df_notes['text'].to_list()))
+
+    # Write to temp files + atomically rename, so readers never see a partially written snapshot
+    path_to_text_blob: str = os.path.join(snapshot_dir, SNAPSHOT_TEXT_BLOB_FILENAME)
+    with open(path_to_text_blob + ".tmp", 'wb') as f:
+        for text in df_notes['text']:
+            f.write(text.encode('utf-8'))
+    os.replace(path_to_text_blob + ".tmp", path_to_text_blob)
+    df_notes.write_ipc(path_to_snapshot + ".tmp", compression='uncompressed')
+    os.replace(path_to_snapshot + ".tmp", path_to_snapshot)
+    path_to_manifest: str = os.path.join(snapshot_dir, SNAPSHOT_MANIFEST_FILENAME)
+    with open(path_to_manifest + ".tmp", 'w') as f:
+        json.dump(get_snapshot_manifest(source_paths), f)
+    os.replace(path_to_manifest + ".tmp", path_to_manifest)
+    logger.info(f"Built snapshot with shape {df_notes.shape} in {time.time() - start_time:.2f}s")
+    return path_to_snapshot
+
+def ensure_snapshot(data_dir: str, snapshot_dir: str, is_force: bool = False) -> str:
+    """Return the path to an up-to-date snapshot, building it first if necessary.
+        Takes a file lock so that concurrently starting workers only build it once."""
+    source_paths: List[str] = get_source_paths(data_dir)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    with open(os.path.join(snapshot_dir, ".lock"), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if is_force or not is_snapshot_valid(snapshot_dir, source_paths):
+                return build_snapshot(data_dir, snapshot_dir)
+            return os.path.join(snapshot_dir, SNAPSHOT_FILENAME)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
 class MIMICIVNotesDatabase(BaseDatabase):
     name: str = "mimiciv-notes"
     _instance: Optional['MIMICIVNotesDatabase'] = None
     df_notes: Optional[pl.DataFrame] = None
     df_patients: Optional[pl.DataFrame] = None
+    # Map of subject_id => (start row, # of rows) into `df_notes`, which is sorted by (subject_id, charttime)
+    patient_id_2_row_range: Dict[str, Tuple[int, int]] = {}
+    # Map of hadm_id => (start, # of entries) into `hadm_row_idxs`, which holds the rows of each admission's notes (ascending)
+    hadm_id_2_row_range: Dict[str, Tuple[int, int]] = {}
+    hadm_row_idxs: np.ndarray = np.zeros(0, dtype=np.int64)
+    # Lazy text mode: `df_notes` has no `text` column, and texts are read from `text_blob` on demand
+    is_lazy_text: bool = False
+    text_blob: Optional[mmap.mmap] = None
+    # LRU of patient_id => note texts (in `df_notes` row order) for recently viewed patients
+    patient_id_2_texts: 'OrderedDict[str, List[str]]' = OrderedDict()
+    patient_id_2_texts_lock: threading.Lock = threading.Lock()
 
     def load_data(self) -> None:
-        """Load CSV data into memory"""
+        """Memory-map the notes snapshot, (re)building it from the source CSVs if it is missing or stale"""
         data_dir = get_rel_path(PATH_TO_MIMICIV_NOTES_DIR)
-        
-        # Load discharge notes
-        path_to_discharge_notes = os.path.join(data_dir, 'discharge.csv')
-        path_to_radiology_notes = os.path.join(data_dir, 'radiology.csv')
-        logger.info(f"Loading notes from {path_to_discharge_notes} and {path_to_radiology_notes}")
-        self.df_notes = pl.concat([pl.scan_csv(f) for f in [path_to_discharge_notes, path_to_radiology_notes]])
-        
-        # Set patient_id column to string
-        self.df_notes = self.df_notes.with_columns(
-            pl.col('subject_id').cast(pl.Utf8)
-        )
+        snapshot_dir = get_rel_path(PATH_TO_MIMICIV_SNAPSHOT_DIR)
+        path_to_snapshot: str = ensure_snapshot(data_dir, snapshot_dir)
+
+        # Uncompressed Arrow IPC => pages are mapped lazily and shared across workers via the OS page cache
+        start_time = time.time()
+        self.is_lazy_text = IS_MIMICIV_LAZY_TEXT
+        if self.is_lazy_text:
+            columns: List[str] = [ c for c in pl.read_ipc_schema(path_to_snapshot).keys() if c != 'text' ]
+            self.df_notes = pl.read_ipc(path_to_snapshot, columns=columns, memory_map=True)
+            with open(os.path.join(snapshot_dir, SNAPSHOT_TEXT_BLOB_FILENAME), 'rb') as f:
+                # mmap() fails on empty files
+                self.text_blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size > 0 else None
+        else:
+            self.df_notes = pl.read_ipc(path_to_snapshot, memory_map=True)
+        logger.info(f"Memory-mapped snapshot {path_to_snapshot} in {time.time() - start_time:.2f}s")
         
         if IS_DEBUG:
             # Limit to top 100 if IS_DEBUG is True
-            self.df_notes = self.df_notes.limit(100)
+            self.df_notes = self.df_notes.head(100)
         
-        self.df_notes = self.df_notes.collect()
+        self.build_patient_index()
         logger.info(f"Loaded notes with shape: {self.df_notes.shape}")
         logger.info(f"Column names: {self.df_notes.columns}")
-        logger.info(f"First 10 patient IDs: {self.df_notes['subject_id'].unique().head(10).to_list()}")
+        logger.info(f"First 10 patient IDs: {list(self.patient_id_2_row_range.keys())[:10]}")
 
-    def get_patient_notes(self, patient_id: str) -> List[Note]:
-        """Get all notes for a specific patient"""
-        if self.df_notes is None:
+    def build_patient_index(self) -> None:
+        """Build the subject_id => (start row, # of rows) index over `df_notes`.
+            Assumes `df_notes` is already sorted by subject_id."""
+        df_index = (
+            self.df_notes
+            .select(pl.col('subject_id'))
+            .with_row_index('row_idx')
+            .group_by('subject_id', maintain_order=True)
+            .agg(
+                pl.col('row_idx').first().alias('start'),
+                pl.len().alias('length'),
+            )
+        )
+        self.patient_id_2_row_range = {
+            patient_id: (start, length)
+            for patient_id, start, length in zip(df_index['subject_id'].to_list(), 
+                                                 df_index['start'].to_list(), 
+                                                 df_index['length'].to_list())
+        }
+        logger.info(f"Indexed {len(self.patient_id_2_row_range)} patients")
+
+        # Rows of each admission's notes. Within a patient, rows are in charttime order, so these are too.
+        df_hadm_rows = (
+            self.df_notes
+            .select(pl.col('hadm_id'))
+            .with_row_index('row_idx')
+            .filter(pl.col('hadm_id').is_not_null())
+            .sort(['hadm_id', 'row_idx'])
+        )
+        self.hadm_row_idxs = df_hadm_rows['row_idx'].cast(pl.Int64).to_numpy()
+        df_hadm_index = (
+            df_hadm_rows
+            .with_row_index('position')
+            .group_by('hadm_id', maintain_order=True)
+            .agg(
+                pl.col('position').first().alias('start'),
+                pl.len().alias('length'),
+            )
+        )
+        self.hadm_id_2_row_range = {
+            hadm_id: (start, length)
+            for hadm_id, start, length in zip(df_hadm_index['hadm_id'].to_list(), 
+                                              df_hadm_index['start'].to_list(), 
+                                              df_hadm_index['length'].to_list())
+        }
+        logger.info(f"Indexed {len(self.hadm_id_2_row_range)} admissions")
+
+    def get_patient_row_idxs(self, patient_id: str, note_filter: NoteFilter) -> np.ndarray:
+        """Rows of `df_notes` (ascending) holding the patient's notes that match `note_filter`, 
+            found via the admission index and a binary search over the patient's charttime-sorted rows"""
+        start, length = self.patient_id_2_row_range[patient_id]
+        if note_filter.hadm_id is not None:
+            if note_filter.hadm_id not in self.hadm_id_2_row_range:
+                return np.zeros(0, dtype=np.int64)
+            hadm_start, hadm_length = self.hadm_id_2_row_range[note_filter.hadm_id]
+            row_idxs: np.ndarray = self.hadm_row_idxs[hadm_start:hadm_start + hadm_length]
+            row_idxs = row_idxs[(row_idxs >= start) & (row_idxs < start + length)]
+        else:
+            row_idxs: np.ndarray = np.arange(start, start + length, dtype=np.int64)
+        if note_filter.is_date_bounded():
+            # Notes with a null charttime sort first, and are excluded from date-bounded windows
+            charttimes: pl.Series = self.df_notes['charttime'].slice(start, length)
+            n_null: int = charttimes.null_count()
+            charttimes = charttimes.slice(n_null)
+            window_start: int = start + n_null + (charttimes.search_sorted(note_filter.start_datetime, side='left') if note_filter.start_datetime is not None else 0)
+            window_end: int = start + n_null + (charttimes.search_sorted(note_filter.end_datetime, side='right') if note_filter.end_datetime is not None else len(charttimes))
+            row_idxs = row_idxs[(row_idxs >= window_start) & (row_idxs < window_end)]
+        return row_idxs
+
+    def get_patient_notes(self, patient_id: str, note_filter: Optional[NoteFilter] = None) -> List[Note]:
+        """Get all notes for a specific patient (that match `note_filter`, if provided)"""
+        if self.df_notes is None or patient_id not in self.patient_id_2_row_range:
             return []
         
-        df_patient_notes = self.df_notes.filter(
-            pl.col('subject_id') == patient_id
-        ).sort('charttime', descending=True)
+        if note_filter is None:
+            # Zero-copy slice of this patient's contiguous rows (already sorted by charttime ascending)
+            start, length = self.patient_id_2_row_range[patient_id]
+            df_patient_notes = self.df_notes.slice(start, length)
+            if self.is_lazy_text:
+                df_patient_notes = df_patient_notes.with_columns(pl.Series('text', self.get_patient_texts(patient_id, df_patient_notes), dtype=pl.Utf8))
+        else:
+            # Only gather (and, in lazy text mode, read the texts of) the rows that match
+            df_patient_notes = self.df_notes[self.get_patient_row_idxs(patient_id, note_filter)]
+            if self.is_lazy_text:
+                df_patient_notes = df_patient_notes.with_columns(pl.Series('text', self.read_texts(df_patient_notes), dtype=pl.Utf8))
+        df_patient_notes = df_patient_notes.reverse()
         logger.info(f"Found {df_patient_notes.shape[0]} notes for patient {patient_id}")
         
         note_dicts = df_patient_notes.select([
             pl.col('note_id'),
             pl.col('charttime'),
             pl.col('hadm_id'),
-            pl.col("note_type").replace("DS", MIMICIVNoteType.DISCHARGE.value).replace("LR", MIMICIVNoteType.RADIOLOGY.value).alias("note_type"),
+            pl.col('note_type'),
             pl.col('text')
         ]).to_dicts()
         
@@ -72,10 +297,46 @@ class MIMICIVNotesDatabase(BaseDatabase):
             )
             for n in note_dicts
         ]
-        # Sort notes by chartdatetime in descending order
-        notes.sort(key=lambda x: x.chartdatetime, reverse=True)
         return notes
 
+    def get_patient_note_signatures(self, patient_id: str) -> Dict[str, np.ndarray]:
+        """note_id => MinHash signature of each of a patient's notes (precomputed in the snapshot)"""
+        if self.df_notes is None or patient_id not in self.patient_id_2_row_range:
+            return {}
+        start, length = self.patient_id_2_row_range[patient_id]
+        df_patient_notes = self.df_notes.slice(start, length)
+        return dict(zip(df_patient_notes['note_id'].to_list(), df_patient_notes['minhash'].to_numpy()))
+
+    def get_patient_texts(self, patient_id: str, df_patient_notes: pl.DataFrame) -> List[str]:
+        """Read the note texts for the rows in `df_patient_notes` from the text blob, 
+            caching the most recently viewed patients"""
+        with self.patient_id_2_texts_lock:
+            if patient_id in self.patient_id_2_texts:
+                self.patient_id_2_texts.move_to_end(patient_id)
+                return self.patient_id_2_texts[patient_id]
+
+        texts: List[str] = self.read_texts(df_patient_notes)
+
+        with self.patient_id_2_texts_lock:
+            self.patient_id_2_texts[patient_id] = texts
+            while len(self.patient_id_2_texts) > MIMICIV_TEXT_CACHE_N_PATIENTS:
+                self.patient_id_2_texts.popitem(last=False)
+        return texts
+
+    def read_texts(self, df_rows: pl.DataFrame) -> List[str]:
+        """Read the note texts for the rows in `df_rows` from the text blob"""
+        return [
+            self.text_blob[offset:offset + length].decode('utf-8') if length > 0 else ''
+            for offset, length in zip(df_rows['text_offset'].to_list(), df_rows['text_length'].to_list())
+        ]
+
+    def get_patient_latest_note_datetime(self, patient_id: str) -> Optional[datetime.datetime]:
+        """charttime of the patient's last row (rows are sorted by charttime, with nulls first)"""
+        if self.df_notes is None or patient_id not in self.patient_id_2_row_range:
+            return None
+        start, length = self.patient_id_2_row_range[patient_id]
+        return self.df_notes['charttime'][start + length - 1]
+
     def get_patient_metadata(self, patient_id: str) -> dict:
         """Get patient demographic information"""
         if self.df_patients is None:
@@ -99,6 +360,4 @@ class MIMICIVNotesDatabase(BaseDatabase):
     
     def is_patient_exists(self, patient_id: str) -> bool:
         """Check if a patient exists in the database"""
-        if self.df_notes is None:
-            return False
-        return patient_id in self.df_notes['subject_id'].unique().to_list()
\ No newline at end of file
+        return patient_id in self.patient_id_2_row_range
\ No newline at end of file
@@ -1,16 +1,22 @@
-from tqdm import tqdm
-from typing import Any, Dict, List, Optional
+import os
+import pickle
+import time
+from typing import Any, Dict, List, Optional, Tuple
 from pathlib import Path
-from ehrllm.backend.app.models import Note
+from ehrllm.backend.app.models import Note, NoteFilter
 from ehrllm.utils import get_rel_path
-from ehrllm.backend.app.config import IS_DEBUG, PATH_TO_N2C22018_DIR
+from ehrllm.backend.app.config import IS_DEBUG, N2C22018_N_WORKERS, PATH_TO_N2C22018_CACHE_DIR, PATH_TO_N2C22018_DIR
+from ehrllm.llms.utils import run_in_parallel
 from loguru import logger
 import re
 import xml.etree.ElementTree as ET
 from datetime import datetime
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import List
+import numpy as np
 from ehrllm.backend.app.databases.base import BaseDatabase
+from ehrllm.backend.app.services.dedup import get_note_signatures
+from ehrllm.backend.app.services.prefilter import NoteIndex
 
 LABEL_2_DEFINITION = {
     'ABDOMINAL': 'History of intra-abdominal surgery. This could include any form of intra-abdominal surgery, including but not limited to small/large intestine resection or small bowel obstruction',
@@ -38,6 +44,38 @@ class Patient:
     id: str
     notes: List[Note]
     labels: List[Criterion]
+    # note_id => MinHash signature of each note (for near-duplicate detection)
+    note_signatures: Dict[str, np.ndarray] = field(default_factory=dict)
+
+# Bump whenever `parse_patient_xml()` or the dataclasses above change, to invalidate existing parse caches
+PARSE_CACHE_VERSION: int = 2
+PARSE_CACHE_FILENAME: str = "patients.pkl"
+
+def get_file_fingerprint(file_path: Path) -> Tuple[float, int]:
+    """(mtime, size) of `file_path`, used to detect files that changed since they were cached"""
+    stat = os.stat(file_path)
+    return (stat.st_mtime, stat.st_size)
+
+def load_parse_cache(path_to_cache: str) -> Dict[str, Tuple[Tuple[float, int], Patient]]:
+    """Load the map of XML file path => (fingerprint, parsed Patient) written by `save_parse_cache()`"""
+    if not os.path.exists(path_to_cache):
+        return {}
+    try:
+        with open(path_to_cache, 'rb') as f:
+            cache: Dict[str, Any] = pickle.load(f)
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable parse cache at {path_to_cache}: {e}")
+        return {}
+    if cache.get('version') != PARSE_CACHE_VERSION:
+        return {}
+    return cache['entries']
+
+def save_parse_cache(path_to_cache: str, entries: Dict[str, Tuple[Tuple[float, int], Patient]]) -> None:
+    """Atomically write the parse cache"""
+    os.makedirs(os.path.dirname(path_to_cache), exist_ok=True)
+    with open(path_to_cache + ".tmp", 'wb') as f:
+        pickle.dump({ 'version' : PARSE_CACHE_VERSION, 'entries' : entries }, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path_to_cache + ".tmp", path_to_cache)
 
 def parse_patient_xml(file_path: Path) -> Patient:
     # Parse the XML file
@@ -94,15 +132,72 @@ def parse_patient_xml(file_path: Path) -> Patient:
             labels.append(Criterion(name=name, is_met=is_met))
     
     # Create and return Patient object
-    return Patient(id=patient_id, notes=notes, labels=labels)
+    return Patient(id=patient_id, notes=notes, labels=labels, note_signatures=get_note_signatures(notes))
+
+def load_patients(xml_files: List[Path], timings: Optional[Dict[str, float]] = None) -> Tuple[List[Patient], int]:
+    """Parse `xml_files` into Patients, reusing the parse cache for files that haven't changed.
+        Returns (patients, # of files that had to be re-parsed)."""
+    timings = timings if timings is not None else {}
+    file_2_fingerprint: Dict[str, Tuple[float, int]] = { str(file) : get_file_fingerprint(file) for file in xml_files }
+    
+    # Reuse cached patients whose XML file hasn't changed
+    start_time = time.time()
+    path_to_cache: str = os.path.join(get_rel_path(PATH_TO_N2C22018_CACHE_DIR), PARSE_CACHE_FILENAME)
+    cache: Dict[str, Tuple[Tuple[float, int], Patient]] = load_parse_cache(path_to_cache)
+    stale_files: List[Path] = [ 
+        file for file in xml_files 
+        if str(file) not in cache or cache[str(file)][0] != file_2_fingerprint[str(file)] 
+    ]
+    timings['cache_read'] = time.time() - start_time
+    
+    # Parse new/changed files across a process pool
+    start_time = time.time()
+    if len(stale_files) > 0:
+        parsed_patients: List[Optional[Patient]] = run_in_parallel(parse_patient_xml, 
+                                                                   [ (file, ) for file in stale_files ], 
+                                                                   max_workers=max(1, min(N2C22018_N_WORKERS, len(stale_files))), 
+                                                                   pool_strat='process', 
+                                                                   merge_strat='append')
+        for file, patient in zip(stale_files, parsed_patients):
+            if patient is None:
+                logger.error(f"Failed to parse {file}")
+                continue
+            cache[str(file)] = (file_2_fingerprint[str(file)], patient)
+    timings['parse'] = time.time() - start_time
+    
+    # Persist cache (dropping entries for XML files that no longer exist)
+    start_time = time.time()
+    removed_files: List[str] = [ file for file in cache if not os.path.exists(file) ]
+    for file in removed_files:
+        del cache[file]
+    if len(stale_files) > 0 or len(removed_files) > 0:
+        save_parse_cache(path_to_cache, cache)
+    timings['cache_write'] = time.time() - start_time
+
+    patients: List[Patient] = [ cache[file][1] for file in file_2_fingerprint if file in cache ]
+    return patients, len(stale_files)
+
+def get_dated_notes(notes: List[Note]) -> Tuple[List[Note], np.ndarray]:
+    """Notes with a chartdatetime, sorted ascending, along with their dates as a sorted datetime64 array"""
+    dated_notes: List[Note] = sorted([ note for note in notes if note.chartdatetime is not None ], key=lambda x: x.chartdatetime)
+    return dated_notes, np.array([ note.chartdatetime for note in dated_notes ], dtype='datetime64[us]')
 
 class N2C22018CTMatchingDatabase(BaseDatabase):
     name: str = "n2c2-2018"
     _instance: Optional['N2C22018CTMatchingDatabase'] = None
     patients: Dict[int, Patient] = {}
+    # Map of patient_id => inverted index over that patient's notes (built at load time, since the corpus is small)
+    patient_id_2_note_index: Dict[str, NoteIndex] = {}
+    # Map of patient_id => { note_id => MinHash signature } of that patient's notes
+    patient_id_2_note_signatures: Dict[str, Dict[str, np.ndarray]] = {}
+    # Map of patient_id => (that patient's dated notes sorted by chartdatetime ascending, their sorted datetime64 dates)
+    patient_id_2_dated_notes: Dict[str, Tuple[List[Note], np.ndarray]] = {}
 
     def load_data(self) -> None:
-        """Load all XML files into memory"""
+        """Load all XML files into memory, only re-parsing files that changed since the last load"""
+        timings: Dict[str, float] = {}
+        
+        start_time = time.time()
         data_dir = get_rel_path(PATH_TO_N2C22018_DIR)
         xml_files = sorted(list(Path(data_dir).glob('*.xml')))
         logger.info(f"Found {len(xml_files)} XML files from {data_dir}")
@@ -110,11 +205,22 @@ class N2C22018CTMatchingDatabase(BaseDatabase):
         if IS_DEBUG:
             # Limit to top 10 if IS_DEBUG is True
             xml_files = xml_files[:10]
+        timings['discover'] = time.time() - start_time
         
-        for file in tqdm(xml_files, desc="Loading patients"):
-            patient = parse_patient_xml(file)
+        patients, n_parsed = load_patients(xml_files, timings=timings)
+        for patient in patients:
             self.patients[patient.id] = patient
-        logger.info(f"Loaded {len(self.patients)} patients")
+        
+        # Build per-patient inverted indexes for pre-filtering
+        start_time = time.time()
+        self.patient_id_2_note_index = { patient_id : NoteIndex(patient.notes) for patient_id, patient in self.patients.items() }
+        timings['index'] = time.time() - start_time
+        # Note signatures are computed at parse time (so they're in the parse cache)
+        self.patient_id_2_note_signatures = { patient_id : patient.note_signatures for patient_id, patient in self.patients.items() }
+        # Sorted date arrays for binary searching time windows
+        self.patient_id_2_dated_notes = { patient_id : get_dated_notes(patient.notes) for patient_id, patient in self.patients.items() }
+        logger.info(f"Loaded {len(self.patients)} patients ({n_parsed} parsed, {len(xml_files) - n_parsed} from cache)")
+        logger.info(f"Load timings: " + " | ".join([ f"{phase}: {seconds:.2f}s" for phase, seconds in timings.items() ]))
         logger.info(f"First 10 patient IDs: {list(self.patients.keys())[:10]}")
 
     def is_patient_exists(self, patient_id: str) -> bool:
@@ -140,10 +246,30 @@ class N2C22018CTMatchingDatabase(BaseDatabase):
             "mrn" : patient_id,
         }
     
-    def get_patient_notes(self, patient_id: str) -> List[Note]:
+    def get_patient_note_index(self, patient_id: str) -> NoteIndex:
+        return self.patient_id_2_note_index[patient_id]
+
+    def get_patient_note_signatures(self, patient_id: str) -> Dict[str, np.ndarray]:
+        return self.patient_id_2_note_signatures[patient_id]
+
+    def get_patient_notes(self, patient_id: str, note_filter: Optional[NoteFilter] = None) -> List[Note]:
         patient = self.get_patient(patient_id)
-        # Sort notes by chartdatetime in descending order
-        return sorted(patient.notes, key=lambda x: x.chartdatetime, reverse=True)
+        if note_filter is None:
+            # Sort notes by chartdatetime in descending order
+            return sorted(patient.notes, key=lambda x: x.chartdatetime, reverse=True)
+        if note_filter.is_date_bounded():
+            # Binary search the window, then reverse so that the most recent note is first
+            dated_notes, dates = self.patient_id_2_dated_notes[patient_id]
+            start: int = np.searchsorted(dates, np.datetime64(note_filter.start_datetime), side='left') if note_filter.start_datetime is not None else 0
+            end: int = np.searchsorted(dates, np.datetime64(note_filter.end_datetime), side='right') if note_filter.end_datetime is not None else len(dates)
+            notes: List[Note] = dated_notes[start:end][::-1]
+        else:
+            notes: List[Note] = sorted(patient.notes, key=lambda x: x.chartdatetime, reverse=True)
+        return [ note for note in notes if note_filter.matches(note) ]
+
+    def get_patient_latest_note_datetime(self, patient_id: str) -> Optional[datetime]:
+        dated_notes, _ = self.patient_id_2_dated_notes[patient_id]
+        return dated_notes[-1].chartdatetime if len(dated_notes) > 0 else None
 
 # Example usage
 if __name__ == "__main__":
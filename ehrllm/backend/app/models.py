@@ -9,4 +9,27 @@ class Note:
     note_type: Optional[str] = None
     chartdatetime: Optional[datetime.datetime] = None
     hadm_id: Optional[str] = None
-    patient_id: Optional[str] = None
\ No newline at end of file
+    patient_id: Optional[str] = None
+
+@dataclass(frozen=True)
+class NoteFilter:
+    """Which of a patient's notes to load. Datetime bounds are inclusive; None => unbounded.
+        Notes without a chartdatetime never match a date bound."""
+    start_datetime: Optional[datetime.datetime] = None
+    end_datetime: Optional[datetime.datetime] = None
+    hadm_id: Optional[str] = None
+
+    def is_date_bounded(self) -> bool:
+        return self.start_datetime is not None or self.end_datetime is not None
+
+    def matches(self, note: Note) -> bool:
+        if self.hadm_id is not None and note.hadm_id != self.hadm_id:
+            return False
+        if self.is_date_bounded():
+            if note.chartdatetime is None:
+                return False
+            if self.start_datetime is not None and note.chartdatetime < self.start_datetime:
+                return False
+            if self.end_datetime is not None and note.chartdatetime > self.end_datetime:
+                return False
+        return True
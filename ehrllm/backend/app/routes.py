@@ -1,20 +1,45 @@
-import os
-import random
+import datetime
+import functools
+import queue
+import threading
 import time
 from ehrllm.backend.app.databases.base import BaseDatabase
-from ehrllm.backend.app.services.chat import aggregate_responses, run_query_over_notes
+from ehrllm.backend.app.models import Note, NoteFilter
+from ehrllm.backend.app.services.chat import aggregate_responses, answer_follow_up, run_query_over_notes, triage_notes
+from ehrllm.backend.app.services.conversations import (
+    FOLLOW_UP_SCOPE_ALL_NOTES, 
+    FOLLOW_UP_SCOPE_EVIDENCE, 
+    FOLLOW_UP_SCOPE_RELEVANT_NOTES, 
+    ConversationTurn, 
+    get_conversation_store, 
+    get_previous_turn, 
+    merge_turn_responses
+)
+from ehrllm.backend.app.services.dedup import NoteDedupPlan, plan_note_dedup
+from ehrllm.backend.app.services.jobs import JOB_STATUSES, MAX_JOBS_LIST_LIMIT, Job, JobRun, get_job_queue
+from ehrllm.backend.app.services.metrics import render_metrics
+from ehrllm.backend.app.services.prefilter import prefilter_notes
+from ehrllm.backend.app.services.response_cache import get_response_cache, get_response_cache_key
+from ehrllm.backend.app.services.search import SEARCH_INDEX_DATABASES, SearchIndexNotBuiltError, get_search_index
+from ehrllm.backend.app.config import (
+    IS_FOLLOW_UP_REUSE_ENABLED, 
+    IS_NOTE_DEDUP_ENABLED, 
+    IS_PREFILTER_ENABLED, 
+    JOB_NOTE_BATCH_SIZE,
+    PATH_TO_TRACE_FILE, 
+    TRIAGE_MIN_CONFIDENCE, 
+    TRIAGE_MODEL
+)
 from ehrllm.llms.models import LLM_ChatCompletionResponse, LLM_AggregateChatCompletionResponse
 from ehrllm.llms.utils import DEFAULT_MODEL
-from flask import Blueprint, json, jsonify, request
-from ehrllm.utils import get_rel_path, hash_str
+from flask import Blueprint, Response, json, jsonify, request
+from ehrllm.telemetry import Trace, get_current_trace, span
 from .databases.mimiciv import MIMICIVNotesDatabase
 from .databases.n2c22018 import N2C22018CTMatchingDatabase
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from loguru import logger
 import uuid
 
-PATH_TO_CACHE: str = get_rel_path("cache/api_responses")
-
 api = Blueprint('api', __name__)
 
 def get_db(settings: Dict[str, Any]) -> BaseDatabase:
@@ -26,7 +51,214 @@ def get_db(settings: Dict[str, Any]) -> BaseDatabase:
         logger.error(f"Invalid database: {settings.get('database')}")
         raise ValueError(f"Invalid database: {settings.get('database')}")
 
+def traced(route: str) -> Callable:
+    """Run the decorated view inside a `Trace` named `route`, which is tagged with the response's HTTP status"""
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            data: Dict[str, Any] = request.get_json(silent=True) or {}
+            with Trace(route, 
+                       path_to_trace_file=PATH_TO_TRACE_FILE, 
+                       patient_id=kwargs.get('patient_id', data.get('patientId')), 
+                       database=(data.get('settings') or {}).get('database')) as trace:
+                result = func(*args, **kwargs)
+                trace.attributes['status'] = result[1] if isinstance(result, tuple) else 200
+                return result
+        return wrapper
+    return decorator
+
+def get_trace_stats() -> Dict[str, Any]:
+    """Trace ID + LLM usage so far of the current request, to return alongside its response"""
+    trace: Optional[Trace] = get_current_trace()
+    if trace is None:
+        return {}
+    return { "trace_id": trace.trace_id, "llm_usage": trace.to_dict()['llm_usage'] }
+
+def parse_datetime_setting(settings: Dict[str, Any], key: str, is_end_of_day: bool = False) -> Optional[datetime.datetime]:
+    """Parse an ISO date / datetime setting. If `is_end_of_day`, a bare date (e.g. '2180-07-01') covers that whole day."""
+    value: Optional[str] = settings.get(key)
+    if value is None or value == '':
+        return None
+    try:
+        parsed: datetime.datetime = datetime.datetime.fromisoformat(str(value))
+    except ValueError:
+        raise ValueError(f"Invalid {key}: '{value}'. Must be an ISO date (YYYY-MM-DD) or datetime")
+    if parsed.tzinfo is not None:
+        # Note timestamps are naive
+        parsed = parsed.replace(tzinfo=None)
+    if is_end_of_day and len(str(value)) == 10:
+        parsed = parsed + datetime.timedelta(days=1) - datetime.timedelta(microseconds=1)
+    return parsed
+
+def get_note_filter(db: BaseDatabase, patient_id: str, settings: Dict[str, Any]) -> Optional[NoteFilter]:
+    """Build the `NoteFilter` for a chat request from its settings (None if it doesn't restrict the notes):
+        - `start_date` / `end_date`: absolute, inclusive ISO dates / datetimes
+        - `lookback_days`: only notes from the `lookback_days` days up to `anchor_date`, which defaults to the date 
+            of the patient's most recent note (e.g. 180 for "in the past 6 months"). Ignored if `start_date` is set.
+        - `hadm_id`: only notes from that hospital admission (e.g. "this admission")
+        Raises a ValueError on invalid settings."""
+    start_datetime: Optional[datetime.datetime] = parse_datetime_setting(settings, 'start_date')
+    end_datetime: Optional[datetime.datetime] = parse_datetime_setting(settings, 'end_date', is_end_of_day=True)
+    lookback_days: Optional[Any] = settings.get('lookback_days')
+    if lookback_days is not None and lookback_days != '' and start_datetime is None:
+        try:
+            lookback_days = int(lookback_days)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid lookback_days: '{lookback_days}'. Must be an integer")
+        if lookback_days < 0:
+            raise ValueError(f"Invalid lookback_days: '{lookback_days}'. Must be >= 0")
+        anchor_datetime: Optional[datetime.datetime] = parse_datetime_setting(settings, 'anchor_date') or db.get_patient_latest_note_datetime(patient_id)
+        if anchor_datetime is not None:
+            # Whole days, e.g. 180 days back from 2180-07-01 => 2180-01-02 00:00:00 through 2180-07-01 23:59:59.999999
+            anchor_end_datetime = datetime.datetime.combine(anchor_datetime.date(), datetime.time.max)
+            start_datetime = datetime.datetime.combine(anchor_datetime.date() - datetime.timedelta(days=lookback_days), datetime.time.min)
+            end_datetime = min(end_datetime, anchor_end_datetime) if end_datetime is not None else anchor_end_datetime
+    if start_datetime is not None and end_datetime is not None and start_datetime > end_datetime:
+        raise ValueError(f"Invalid date range: start ({start_datetime}) is after end ({end_datetime})")
+    hadm_id: Optional[str] = str(settings['hadm_id']) if settings.get('hadm_id') not in [ None, '' ] else None
+    note_filter = NoteFilter(start_datetime=start_datetime, end_datetime=end_datetime, hadm_id=hadm_id)
+    return note_filter if note_filter.is_date_bounded() or hadm_id is not None else None
+
+def get_triage_settings(settings: Dict[str, Any]) -> Tuple[Optional[str], float]:
+    """Model cascade settings of a chat request: (`triage_model` (None => no triage), `triage_min_confidence`).
+        Both default to the server's `TRIAGE_MODEL` / `TRIAGE_MIN_CONFIDENCE`. Raises a ValueError on invalid settings."""
+    triage_model: Optional[Any] = settings.get('triage_model', TRIAGE_MODEL)
+    if triage_model is not None and not isinstance(triage_model, str):
+        raise ValueError(f"Invalid triage_model: '{triage_model}'. Must be a model name")
+    value: Any = settings.get('triage_min_confidence', TRIAGE_MIN_CONFIDENCE)
+    try:
+        min_confidence: float = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid triage_min_confidence: '{value}'. Must be a number")
+    if not 0 <= min_confidence <= 1:
+        raise ValueError(f"Invalid triage_min_confidence: '{value}'. Must be between 0 and 1")
+    return (triage_model or None), min_confidence
+
+def get_effective_settings(settings: Dict[str, Any]) -> Dict[str, Any]:
+    """`settings` of a chat request with the server's defaults filled in for every setting that changes the answer, 
+        so that e.g. the response cache key changes when an operator changes a default. Raises a ValueError on invalid settings."""
+    triage_model, triage_min_confidence = get_triage_settings(settings)
+    return {
+        **settings,
+        'model' : settings.get('model', DEFAULT_MODEL),
+        'prefilter' : settings.get('prefilter', IS_PREFILTER_ENABLED),
+        'dedup' : settings.get('dedup', IS_NOTE_DEDUP_ENABLED),
+        'follow_up' : settings.get('follow_up', IS_FOLLOW_UP_REUSE_ENABLED),
+        'triage_model' : triage_model,
+        'triage_min_confidence' : triage_min_confidence,
+    }
+
+def load_notes_for_query(db: BaseDatabase, 
+                         patient_id: str, 
+                         query: str, 
+                         settings: Dict[str, Any], 
+                         note_filter: Optional[NoteFilter] = None,
+                         note_ids: Optional[List[str]] = None) -> Tuple[List[Note], Optional[NoteDedupPlan], Dict[str, Any]]:
+    """Load the patient's notes that should be sent to the LLM for `query` (only those matching `note_filter`, if provided). 
+        If `note_ids` is provided, only those notes are loaded (and they aren't pre-filtered), e.g. to re-query the 
+        notes that a previous turn found relevant.
+        Returns (notes, plan for collapsing near-duplicate notes (if enabled), stats about notes that were skipped)."""
+    with span('load_notes'):
+        notes: List[Note] = db.load_patient_notes(patient_id, note_filter)
+        if note_ids is not None:
+            note_ids_set: set = set(note_ids)
+            notes = [ note for note in notes if note.note_id in note_ids_set ]
+    stats: Dict[str, Any] = { "n_notes": len(notes) }
+    if note_filter is not None:
+        stats['note_filter'] = {
+            'start_datetime' : note_filter.start_datetime.isoformat() if note_filter.start_datetime is not None else None,
+            'end_datetime' : note_filter.end_datetime.isoformat() if note_filter.end_datetime is not None else None,
+            'hadm_id' : note_filter.hadm_id,
+        }
+        logger.info(f"load_notes_for_query() -- note filter {stats['note_filter']} matched {len(notes)} notes")
+    
+    # Prune notes that are clearly irrelevant to the query
+    if settings.get('prefilter', IS_PREFILTER_ENABLED) and note_ids is None:
+        with span('prefilter'):
+            notes, stats['prefilter'] = prefilter_notes(query, notes, db.get_patient_note_index(patient_id))
+        logger.info(f"load_notes_for_query() -- pre-filter skipped {stats['prefilter']['n_skipped']} / {stats['prefilter']['n_notes']} notes")
+    
+    # Model cascade: a cheap model triages notes for relevance, so that the main model only reads the ones it escalates
+    triage_model, triage_min_confidence = get_triage_settings(settings)
+    if triage_model is not None:
+        notes, stats['triage'] = triage_notes(query, notes, triage_model, min_confidence=triage_min_confidence)
+    
+    # Collapse near-duplicate notes + copied-forward sections into a single LLM call
+    dedup_plan: Optional[NoteDedupPlan] = None
+    if settings.get('dedup', IS_NOTE_DEDUP_ENABLED):
+        with span('dedup'):
+            dedup_plan = plan_note_dedup(notes, db.get_patient_note_signatures(patient_id), model=settings.get('model', DEFAULT_MODEL))
+        stats['dedup'] = dedup_plan.stats
+        logger.info(f"load_notes_for_query() -- dedup collapsed {dedup_plan.stats['n_near_duplicates']} notes + {dedup_plan.stats['n_sections_elided']} sections, saving {dedup_plan.stats['n_tokens_saved']} tokens")
+    
+    stats['n_llm_notes'] = len(dedup_plan.units) if dedup_plan is not None else len(notes)
+    return notes, dedup_plan, stats
+
+def get_follow_up(db: BaseDatabase, 
+                  patient_id: str, 
+                  messages: List[Dict[str, Any]], 
+                  settings: Dict[str, Any], 
+                  note_filter: Optional[NoteFilter], 
+                  model: str) -> Tuple[Optional[ConversationTurn], str, Optional[LLM_AggregateChatCompletionResponse]]:
+    """If `messages` continues a conversation whose previous turn is still stored (and reuse is enabled via `settings.follow_up`),
+        try to answer it from that turn's per-note responses (see `answer_follow_up()`).
+        Returns (previous turn, scope, response), where response is only set if scope is FOLLOW_UP_SCOPE_EVIDENCE.
+        Returns (None, FOLLOW_UP_SCOPE_ALL_NOTES, None) for the first turn of a conversation."""
+    if not settings.get('follow_up', IS_FOLLOW_UP_REUSE_ENABLED):
+        return None, FOLLOW_UP_SCOPE_ALL_NOTES, None
+    previous_turn: Optional[ConversationTurn] = get_previous_turn(get_conversation_store(), messages, db.name, patient_id, note_filter)
+    if previous_turn is None:
+        return None, FOLLOW_UP_SCOPE_ALL_NOTES, None
+    scope, response = answer_follow_up(messages, previous_turn.query, previous_turn.note_responses, model=model)
+    get_conversation_store().record_follow_up(scope)
+    logger.info(f"get_follow_up() -- follow-up to '{previous_turn.query}' with {len(previous_turn.get_relevant_note_ids())} relevant notes => {scope}")
+    return previous_turn, scope, response
+
+def load_notes_for_turn(db: BaseDatabase, 
+                        patient_id: str, 
+                        query: str, 
+                        settings: Dict[str, Any], 
+                        note_filter: Optional[NoteFilter],
+                        previous_turn: Optional[ConversationTurn],
+                        scope: str) -> Tuple[List[Note], Optional[NoteDedupPlan], Dict[str, Any]]:
+    """`load_notes_for_query()`, restricted to the notes a follow-up's `scope` needs re-queried"""
+    if scope == FOLLOW_UP_SCOPE_EVIDENCE:
+        notes, dedup_plan, stats = [], None, { "n_notes": 0, "n_llm_notes": 0 }
+    elif scope == FOLLOW_UP_SCOPE_RELEVANT_NOTES:
+        notes, dedup_plan, stats = load_notes_for_query(db, patient_id, query, settings, note_filter=note_filter, note_ids=previous_turn.get_relevant_note_ids())
+    else:
+        notes, dedup_plan, stats = load_notes_for_query(db, patient_id, query, settings, note_filter=note_filter)
+    if previous_turn is not None:
+        stats['follow_up'] = {
+            "scope": scope,
+            "n_reused_responses": max(0, len(previous_turn.note_responses) - len(notes)) if scope != FOLLOW_UP_SCOPE_ALL_NOTES else 0,
+            "n_requeried_notes": len(notes),
+        }
+    return notes, dedup_plan, stats
+
+def save_turn(turn_key: str, 
+              db: BaseDatabase, 
+              patient_id: str, 
+              query: str, 
+              note_filter: Optional[NoteFilter], 
+              previous_turn: Optional[ConversationTurn], 
+              scope: str,
+              notes: List[Note], 
+              note_responses: List[LLM_ChatCompletionResponse]) -> None:
+    """Store the per-note responses behind this turn's answer, so that follow-ups can reuse them"""
+    note_ids: List[str] = [ note.note_id for note in notes ]
+    if previous_turn is not None and scope != FOLLOW_UP_SCOPE_ALL_NOTES:
+        # Notes that weren't re-queried keep their previous responses
+        note_ids, note_responses = merge_turn_responses(previous_turn, note_ids, note_responses)
+    get_conversation_store().set_turn(turn_key, ConversationTurn(database=db.name, 
+                                                                 patient_id=patient_id, 
+                                                                 query=query, 
+                                                                 note_filter=note_filter, 
+                                                                 note_ids=note_ids, 
+                                                                 note_responses=note_responses))
+
 @api.route('/patient/<patient_id>', methods=['POST'])
+@traced('patient')
 def get_patient_info(patient_id: str):
     patient_id = str(patient_id) # ! force cast, otherwise downstream polars will fail
     data = request.json
@@ -38,12 +270,15 @@ def get_patient_info(patient_id: str):
     logger.info(f"get_patient_info() -- patient_id: {patient_id}")
 
     # Confirm patient exists
-    if not db.is_patient_exists(patient_id):
+    with span('db_lookup'):
+        is_patient_exists: bool = db.is_patient_exists(patient_id)
+    if not is_patient_exists:
         return jsonify({"error": f"Patient with ID '{patient_id}' not found in database '{db.name}'"}), 400
 
     # Get patient data
-    metadata: Dict[str, Any] = db.get_patient_metadata(patient_id)
-    notes: List[Dict[str, Any]] = db.get_patient_notes(patient_id)
+    with span('load_notes'):
+        metadata: Dict[str, Any] = db.get_patient_metadata(patient_id)
+        notes: List[Note] = db.load_patient_notes(patient_id)
 
     return jsonify({
         "data": {
@@ -56,26 +291,13 @@ def get_patient_info(patient_id: str):
     })
 
 @api.route('/chat', methods=['POST'])
+@traced('chat')
 def chat():
     data = request.json
     patient_id: str = data.get('patientId')
     messages: List[Dict[str, Any]] = data.get('messages', [])
     settings: Dict[str, Any] = data.get('settings', {})
     is_use_cache: bool = data.get('isUseCache', False)
-    
-    # Cache response
-    unique_hash: str = hash_str(f"{patient_id}_{messages[-1]['content']}")
-    path_to_cached_json: str = os.path.join(PATH_TO_CACHE, unique_hash + ".json")
-    os.makedirs(PATH_TO_CACHE, exist_ok=True)
-    if is_use_cache:
-        if os.path.exists(path_to_cached_json):
-            logger.info(f"chat() -- cache hit for {unique_hash}")
-            # Sleep for 1 - 2.5 seconds
-            time.sleep(random.uniform(1, 2.5))
-            with open(path_to_cached_json, 'r') as f:
-                return jsonify({"data": json.load(f)}), 200
-        else:
-            logger.info(f"chat() -- cache miss for {unique_hash}")
 
     # Initialize database
     db: BaseDatabase = get_db(settings)
@@ -85,46 +307,390 @@ def chat():
     if not patient_id or len(messages) == 0:
         return jsonify({"error": "Missing Patient ID or messages"}), 400
     patient_id = str(patient_id)
-    if not db.is_patient_exists(patient_id):
+    with span('db_lookup'):
+        is_patient_exists: bool = db.is_patient_exists(patient_id)
+    if not is_patient_exists:
         logger.error(f"chat() -- patient_id: {patient_id} not found in database '{db.name}' | type: {type(patient_id)}")
         return jsonify({"error": f"Patient with ID '{patient_id}' not found in database '{db.name}'"}), 400
     if messages[-1]['role'] != 'user':
         return jsonify({"error": "Last message must be a user message"}), 400
 
+    try:
+        note_filter: Optional[NoteFilter] = get_note_filter(db, patient_id, settings)
+        settings = get_effective_settings(settings)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
     # Get query from last message
     query: str = messages[-1]['content']
+
+    # Key for this request in the response cache (and for this turn in the conversation store), which covers the server's defaults too
+    cache_key: str = get_response_cache_key(db.name, patient_id, model, messages, settings)
+
+    def run_pipeline() -> Tuple[int, Dict[str, Any]]:
+        """Returns (HTTP status, `data` payload on success or `error` payload on failure)"""
+        # Follow-ups try to reuse the previous turn's per-note responses first
+        previous_turn, scope, response = get_follow_up(db, patient_id, messages, settings, note_filter, model)
+        
+        # Load patient notes
+        notes, dedup_plan, stats = load_notes_for_turn(db, patient_id, query, settings, note_filter, previous_turn, scope)
+        
+        # Run query over notes
+        note_responses: List[LLM_ChatCompletionResponse] = []
+        if scope != FOLLOW_UP_SCOPE_EVIDENCE:
+            note_responses = run_query_over_notes(messages, notes, dedup_plan=dedup_plan, model=model)
+            if note_responses is None:
+                return 500, { "error": "Failed to run query over notes" }
+            logger.info(f"chat() -- received {len(note_responses)} note_responses")
+
+            # Synthesize `note_responses` across notes
+            response = aggregate_responses(messages, note_responses, model=model)
+            logger.info(f"chat() -- response: {response}")
+            if response is None:
+                return 500, { "error": "Failed to aggregate responses" }
+        save_turn(cache_key, db, patient_id, query, note_filter, previous_turn, scope, notes, note_responses)
+        return 200, {
+            "patient_id": patient_id,
+            "query": query,
+            "response": response.model_dump(),
+            "stats": stats,
+        }
+
+    # Serve from the response cache, or run the pipeline (once, even if identical requests arrive concurrently)
+    with span('response_cache') as span_attributes:
+        status, payload, source = get_response_cache().get_or_compute(cache_key, run_pipeline, is_read_cache=is_use_cache)
+        span_attributes['source'] = source
+    logger.info(f"chat() -- response cache {source} for {cache_key}")
+    if status != 200:
+        return jsonify(payload), status
+
+    # Follow-ups to this answer will find its turn via its message_id
+    message_id: str = str(uuid.uuid4())
+    get_conversation_store().link_message(message_id, cache_key)
+    return jsonify({
+        "data": {
+            **payload,
+            "message_id": message_id,
+            "stats": { **payload['stats'], **get_trace_stats(), "cache": source },
+        }
+    })
+
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    """Format a server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@api.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Streaming version of /chat. Returns a `text/event-stream` of server-sent events:
+        - `start`: { n_notes, stats } once the patient's notes are loaded
+        - `note`: { note_id, n_completed, n_total, response } as each note-level response finishes (in completion order)
+        - `aggregating`: { n_relevant } once all notes are done and the final aggregation starts
+        - `result`: same payload as the `data` field of /chat
+        - `error`: { error } if anything fails (the stream ends after this)
+    """
+    data = request.json
+    patient_id: str = data.get('patientId')
+    messages: List[Dict[str, Any]] = data.get('messages', [])
+    settings: Dict[str, Any] = data.get('settings', {})
+
+    # Initialize database
+    db: BaseDatabase = get_db(settings)
+    model: str = settings.get('model', DEFAULT_MODEL)
+    
+    # Validate data
+    if not patient_id or len(messages) == 0:
+        return jsonify({"error": "Missing Patient ID or messages"}), 400
+    patient_id = str(patient_id)
+    if not db.is_patient_exists(patient_id):
+        logger.error(f"chat_stream() -- patient_id: {patient_id} not found in database '{db.name}' | type: {type(patient_id)}")
+        return jsonify({"error": f"Patient with ID '{patient_id}' not found in database '{db.name}'"}), 400
+    if messages[-1]['role'] != 'user':
+        return jsonify({"error": "Last message must be a user message"}), 400
+    try:
+        note_filter: Optional[NoteFilter] = get_note_filter(db, patient_id, settings)
+        get_triage_settings(settings)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    query: str = messages[-1]['content']
+    
+    # Run the pipeline in a background thread, which pushes events onto `events` for the response generator to yield
+    events: queue.Queue = queue.Queue()
+    
+    def run_pipeline():
+        with Trace('chat_stream', path_to_trace_file=PATH_TO_TRACE_FILE, patient_id=patient_id, database=db.name) as trace:
+            trace.attributes['status'] = run_pipeline_traced()
+    
+    def run_pipeline_traced() -> int:
+        """Returns the HTTP status that /chat would have returned"""
+        try:
+            previous_turn, scope, response = get_follow_up(db, patient_id, messages, settings, note_filter, model)
+            notes, dedup_plan, stats = load_notes_for_turn(db, patient_id, query, settings, note_filter, previous_turn, scope)
+            events.put(format_sse('start', { "n_notes": len(notes), "stats": stats }))
+            
+            n_completed: int = 0
+            n_completed_lock = threading.Lock()
+            def on_note_response(idx: int, response: LLM_ChatCompletionResponse):
+                nonlocal n_completed
+                with n_completed_lock:
+                    n_completed += 1
+                    events.put(format_sse('note', {
+                        "note_id": notes[idx].note_id,
+                        "n_completed": n_completed,
+                        "n_total": len(notes),
+                        "response": response.model_dump(),
+                    }))
+            
+            note_responses: List[LLM_ChatCompletionResponse] = []
+            if scope != FOLLOW_UP_SCOPE_EVIDENCE:
+                note_responses = run_query_over_notes(messages, notes, on_note_response=on_note_response, dedup_plan=dedup_plan, model=model)
+                if note_responses is None:
+                    events.put(format_sse('error', { "error": "Failed to run query over notes" }))
+                    return 500
+                
+                events.put(format_sse('aggregating', { "n_relevant": sum([ r.is_relevant for r in note_responses ]) }))
+                response = aggregate_responses(messages, note_responses, model=model)
+                if response is None:
+                    events.put(format_sse('error', { "error": "Failed to aggregate responses" }))
+                    return 500
+            
+            # Follow-ups to this answer will find its turn via its message_id
+            message_id: str = str(uuid.uuid4())
+            save_turn(message_id, db, patient_id, query, note_filter, previous_turn, scope, notes, note_responses)
+            get_conversation_store().link_message(message_id, message_id)
+            events.put(format_sse('result', {
+                "patient_id": patient_id,
+                "query": query,
+                "message_id" : message_id,
+                "response": response.model_dump(),
+                "stats": { **stats, **get_trace_stats() },
+            }))
+            return 200
+        except Exception as e:
+            logger.error(f"chat_stream() -- error: {e}")
+            events.put(format_sse('error', { "error": str(e) }))
+            return 500
+        finally:
+            events.put(None)
+    
+    threading.Thread(target=run_pipeline, daemon=True).start()
+    
+    def generate():
+        while True:
+            event: Optional[str] = events.get()
+            if event is None:
+                break
+            yield event
+    
+    return Response(generate(), mimetype='text/event-stream', headers={ 'Cache-Control' : 'no-cache', 'X-Accel-Buffering' : 'no' })
+
+def run_chat_job(run: JobRun) -> Dict[str, Any]:
+    """Run a /jobs job: the same pipeline as /chat, except that notes are queried in batches (checking for cancellation
+        in between), each note-level response is saved as it arrives, and notes with a saved response (from an earlier,
+        interrupted attempt) are skipped. Returns the same payload as the `data` field of /chat.
+        
+        Near-duplicate notes are only collapsed within a batch, which catches most copy-forward since batches are in recency order."""
+    patient_id: str = str(run.job.request['patientId'])
+    messages: List[Dict[str, Any]] = run.job.request['messages']
+    settings: Dict[str, Any] = run.job.request.get('settings', {})
+    db: BaseDatabase = get_db(settings)
+    model: str = settings.get('model', DEFAULT_MODEL)
+    query: str = messages[-1]['content']
+    note_filter: Optional[NoteFilter] = get_note_filter(db, patient_id, settings)
     
     # Load patient notes
-    notes: List[Dict[str, Any]] = db.get_patient_notes(patient_id)
+    notes, _, stats = load_notes_for_query(db, patient_id, query, { **settings, 'dedup' : False }, note_filter=note_filter)
+    run.set_n_notes(len(notes))
+    note_id_2_response: Dict[str, LLM_ChatCompletionResponse] = { 
+        note_id : LLM_ChatCompletionResponse(**response) 
+        for note_id, response in run.get_note_responses().items() 
+    }
+    pending_notes: List[Note] = [ note for note in notes if note.note_id not in note_id_2_response ]
+    stats['n_resumed_notes'] = len(notes) - len(pending_notes)
+    stats['n_llm_notes'] = 0
+    if stats['n_resumed_notes'] > 0:
+        logger.info(f"run_chat_job() -- job {run.job.job_id} resuming with {stats['n_resumed_notes']} / {len(notes)} notes already done")
     
-    # Run query over notes
-    note_responses: Optional[List[LLM_ChatCompletionResponse]] = run_query_over_notes(messages, notes, model=model)
-    if note_responses is None:
-        return jsonify({"error": "Failed to run query over notes"}), 500
-    logger.info(f"chat() -- received {len(note_responses)} note_responses")
+    # Run query over notes, one batch at a time
+    for start in range(0, len(pending_notes), JOB_NOTE_BATCH_SIZE):
+        run.check_cancelled()
+        batch: List[Note] = pending_notes[start:start + JOB_NOTE_BATCH_SIZE]
+        dedup_plan: Optional[NoteDedupPlan] = None
+        if settings.get('dedup', IS_NOTE_DEDUP_ENABLED):
+            with span('dedup'):
+                dedup_plan = plan_note_dedup(batch, db.get_patient_note_signatures(patient_id), model=model)
+        stats['n_llm_notes'] += len(dedup_plan.units) if dedup_plan is not None else len(batch)
+        def on_note_response(idx: int, response: LLM_ChatCompletionResponse, batch: List[Note] = batch):
+            run.save_note_response(batch[idx].note_id, response.model_dump())
+        batch_responses: Optional[List[LLM_ChatCompletionResponse]] = run_query_over_notes(messages, batch, on_note_response=on_note_response, dedup_plan=dedup_plan, model=model)
+        if batch_responses is None:
+            raise RuntimeError("Failed to run query over notes")
+        note_id_2_response.update(zip([ note.note_id for note in batch ], batch_responses))
+        run.flush()
+    run.check_cancelled()
 
-    # Synthesize `note_responses` across notes
+    # Synthesize note-level responses across notes (in the same recency order as /chat)
+    note_responses: List[LLM_ChatCompletionResponse] = [ note_id_2_response[note.note_id] for note in notes ]
     response: Optional[LLM_AggregateChatCompletionResponse] = aggregate_responses(messages, note_responses, model=model)
-    logger.info(f"chat() -- response: {response}")
     if response is None:
-        return jsonify({"error": "Failed to aggregate responses"}), 500
+        raise RuntimeError("Failed to aggregate responses")
+    
+    # Follow-ups to this answer (in this process) can reuse its note-level responses
+    message_id: str = str(uuid.uuid4())
+    save_turn(message_id, db, patient_id, query, note_filter, None, FOLLOW_UP_SCOPE_ALL_NOTES, notes, note_responses)
+    get_conversation_store().link_message(message_id, message_id)
+    return {
+        "patient_id": patient_id,
+        "query": query,
+        "message_id": message_id,
+        "response": response.model_dump(),
+        "stats": { **stats, **get_trace_stats() },
+    }
+
+@api.route('/jobs', methods=['POST'])
+def submit_job():
+    """Queue a chart review to run in the background. Same body as /chat. 
+        Returns 202 with the job (whose `job_id` can be polled via GET /jobs/<job_id> or streamed via GET /jobs/<job_id>/stream)."""
+    data = request.json
+    patient_id: str = data.get('patientId')
+    messages: List[Dict[str, Any]] = data.get('messages', [])
+    settings: Dict[str, Any] = data.get('settings', {})
+
+    # Validate data
+    if not patient_id or len(messages) == 0:
+        return jsonify({"error": "Missing Patient ID or messages"}), 400
+    patient_id = str(patient_id)
+    try:
+        db: BaseDatabase = get_db(settings)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not db.is_patient_exists(patient_id):
+        return jsonify({"error": f"Patient with ID '{patient_id}' not found in database '{db.name}'"}), 400
+    if messages[-1]['role'] != 'user':
+        return jsonify({"error": "Last message must be a user message"}), 400
+    try:
+        get_note_filter(db, patient_id, settings)
+        get_triage_settings(settings)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    job: Job = get_job_queue().submit({ 'patientId' : patient_id, 'messages' : messages, 'settings' : settings })
+    logger.info(f"submit_job() -- job_id: {job.job_id} | patient_id: {patient_id}")
+    return jsonify({ "data": job.to_dict() }), 202
+
+@api.route('/jobs', methods=['GET'])
+def list_jobs():
+    """Most recently submitted jobs (without their results). Query params: status?, limit?"""
+    status: Optional[str] = request.args.get('status')
+    if status is not None and status not in JOB_STATUSES:
+        return jsonify({"error": f"Invalid status: {status}. Must be one of {JOB_STATUSES}"}), 400
+    try:
+        limit: int = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({"error": f"Invalid limit: {request.args.get('limit')}"}), 400
+    if not 1 <= limit <= MAX_JOBS_LIST_LIMIT:
+        return jsonify({"error": f"Invalid limit: {limit}. Must be between 1 and {MAX_JOBS_LIST_LIMIT}"}), 400
+    jobs: List[Job] = get_job_queue().list_jobs(status=status, limit=limit)
+    return jsonify({ "data": { "jobs": [ job.to_dict(is_include_result=False) for job in jobs ] } })
+
+@api.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id: str):
+    """Status + progress of a job, and its `result` (same as the `data` field of /chat) once it has succeeded"""
+    job: Optional[Job] = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify({"error": f"Job '{job_id}' not found"}), 404
+    return jsonify({ "data": job.to_dict() })
+
+@api.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id: str):
+    """Cancel a job. Queued jobs are cancelled immediately, running jobs after their current batch of notes."""
+    job: Optional[Job] = get_job_queue().cancel(job_id)
+    if job is None:
+        return jsonify({"error": f"Job '{job_id}' not found"}), 404
+    logger.info(f"cancel_job() -- job_id: {job_id} | status: {job.status}")
+    return jsonify({ "data": job.to_dict(is_include_result=False) })
+
+@api.route('/jobs/<job_id>/stream', methods=['GET'])
+def stream_job(job_id: str):
+    """Stream a job's progress as server-sent events until it finishes:
+        - `progress`: the job (without its result) whenever its status or # of completed notes changes
+        - `result`: the job, including its result, once it has succeeded
+        - `error`: the job once it has failed or been cancelled (see its `status` + `error`)
+    """
+    if get_job_queue().get(job_id) is None:
+        return jsonify({"error": f"Job '{job_id}' not found"}), 404
     
-    response = response.model_dump()
+    def generate():
+        last_progress: Optional[Tuple] = None
+        while True:
+            job: Optional[Job] = get_job_queue().get(job_id)
+            if job is None:
+                yield format_sse('error', { "error": f"Job '{job_id}' not found" })
+                return
+            if (job.status, job.n_notes, job.n_completed) != last_progress:
+                last_progress = (job.status, job.n_notes, job.n_completed)
+                yield format_sse('progress', job.to_dict(is_include_result=False))
+            if job.is_finished():
+                yield format_sse('result' if job.result is not None else 'error', job.to_dict())
+                return
+            time.sleep(0.5)
     
-    # Save to cache
-    with open(path_to_cached_json, 'w') as f:
-        json.dump({
-            "patient_id": patient_id,
-            "query": query,
-            "message_id" : uuid.uuid4(),
-            "response": response,
-        }, f, indent=2)
+    return Response(generate(), mimetype='text/event-stream', headers={ 'Cache-Control' : 'no-cache', 'X-Accel-Buffering' : 'no' })
+
+@api.route('/search', methods=['POST'])
+@traced('search')
+def search():
+    """Cohort-wide full-text search over all notes.
+        Body: { query, settings: { database? }, groupBy?: 'patient' | 'note', patientId?, limit?, offset? }"""
+    data = request.json
+    query: str = data.get('query', '')
+    settings: Dict[str, Any] = data.get('settings', {})
+    group_by: str = data.get('groupBy', 'patient')
+    database: Optional[str] = settings.get('database')
+    
+    # Validate data
+    if not query.strip():
+        return jsonify({"error": "Missing query"}), 400
+    try:
+        limit: int = int(data.get('limit', 50))
+    except (TypeError, ValueError):
+        return jsonify({"error": f"Invalid limit: {data.get('limit')}"}), 400
+    try:
+        offset: int = int(data.get('offset', 0))
+    except (TypeError, ValueError):
+        return jsonify({"error": f"Invalid offset: {data.get('offset')}"}), 400
+    if limit < 1:
+        return jsonify({"error": f"Invalid limit: {limit}. Must be >= 1"}), 400
+    if offset < 0:
+        return jsonify({"error": f"Invalid offset: {offset}. Must be >= 0"}), 400
+    if database is not None and database not in SEARCH_INDEX_DATABASES:
+        return jsonify({"error": f"Invalid database: {database}"}), 400
+    if group_by not in [ 'patient', 'note' ]:
+        return jsonify({"error": f"Invalid groupBy: {group_by}"}), 400
+    
+    start_time = time.time()
+    try:
+        if group_by == 'patient':
+            results: List[Dict[str, Any]] = get_search_index().search_patients(query, database=database, limit=limit, offset=offset)
+        else:
+            results: List[Dict[str, Any]] = get_search_index().search_notes(query, database=database, patient_id=data.get('patientId'), limit=limit, offset=offset)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except SearchIndexNotBuiltError as e:
+        logger.error(f"search() -- {e}")
+        return jsonify({"error": str(e)}), 503
+    elapsed_ms: float = (time.time() - start_time) * 1000
+    logger.info(f"search() -- query: {query} | {len(results)} results in {elapsed_ms:.1f}ms")
 
     return jsonify({
         "data": {
-            "patient_id": patient_id,
             "query": query,
-            "message_id" : uuid.uuid4(),
-            "response": response,
+            "group_by": group_by,
+            "results": results,
+            "elapsed_ms": elapsed_ms,
         }
     })
+
+@api.route('/metrics', methods=['GET'])
+def metrics():
+    """Request / span / LLM call latencies, LLM token + cost + retry counters, and LLM cache stats (Prometheus text format)"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
@@ -1,22 +1,87 @@
-from typing import Any, Dict, List, Optional
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+from pydantic import BaseModel
 from ehrllm.backend.app.models import Note
 from loguru import logger
-from ehrllm.llms.models import LLM_ChatCompletionResponse, LLM_AggregateChatCompletionResponse
+from ehrllm.llms.models import (
+    LLM_ChatCompletionResponse, 
+    LLM_AggregateChatCompletionResponse, 
+    LLM_FollowUpChatCompletionResponse,
+    LLM_MultiNoteChatCompletionResponse, 
+    LLM_MultiQuestionChatCompletionResponse,
+    LLM_RelevanceTriageResponse
+)
 from ehrllm.llms.prompts import (
     CHAT_SYSTEM_PROMPT, 
+    CHAT_ONE_NOTE_CONTEXT_PROMPT,
+    CHAT_MULTIPLE_NOTES_CONTEXT_PROMPT,
     CHAT_USER_QUERY_OVER_ONE_NOTE_PROMPT, 
-    CHAT_USER_QUERY_AGGREGATE_RESPONSES_PROMPT
+    CHAT_USER_QUERY_OVER_MULTIPLE_NOTES_PROMPT,
+    CHAT_USER_QUERIES_OVER_ONE_NOTE_PROMPT,
+    CHAT_USER_QUERY_AGGREGATE_RESPONSES_PROMPT,
+    CHAT_USER_QUERY_FOLLOW_UP_PROMPT,
+    CHAT_USER_QUERY_TRIAGE_PROMPT
+)
+from ehrllm.llms.utils import (
+    DEFAULT_MODEL,
+    acall_llm_with_retries, 
+    call_llm_with_retries, 
+    count_tokens,
+    run_in_parallel, 
+    run_in_parallel_async
 )
-from ehrllm.llms.utils import call_llm_with_retries, run_in_parallel
+from ehrllm.llms.usage import get_usage_tracker
+from ehrllm.telemetry import get_metrics_registry, span
+from ehrllm.backend.app.config import AGGREGATION_TOKEN_BUDGET, LLM_EXECUTION_ENGINE, NOTE_PACKING_TOKEN_BUDGET, TRIAGE_MIN_CONFIDENCE
+from ehrllm.backend.app.services.conversations import FOLLOW_UP_SCOPE_ALL_NOTES, FOLLOW_UP_SCOPE_EVIDENCE, FOLLOW_UP_SCOPE_RELEVANT_NOTES
+from ehrllm.backend.app.services.chunking import chunk_note, get_note_chunk_token_budget, merge_chunk_responses
+from ehrllm.backend.app.services.dedup import NoteDedupPlan, get_deduped_note_response, get_deduped_note_responses
+
 
+def group_responses(responses: List[LLM_ChatCompletionResponse], token_budget: int, model: str = DEFAULT_MODEL) -> List[List[LLM_ChatCompletionResponse]]:
+    """Greedily group consecutive responses (preserving recency order) into groups of at most `token_budget` tokens.
+        Every group has at least 2 responses (if possible), so that each round of aggregation shrinks the list."""
+    groups: List[List[LLM_ChatCompletionResponse]] = []
+    group_n_tokens: int = 0
+    for r in responses:
+        n_tokens: int = count_tokens(str(r), model=model)
+        if len(groups) == 0 or (len(groups[-1]) >= 2 and group_n_tokens + n_tokens > token_budget):
+            groups.append([])
+            group_n_tokens = 0
+        groups[-1].append(r)
+        group_n_tokens += n_tokens
+    if len(groups) > 1 and len(groups[-1]) == 1:
+        groups[-2] += groups.pop()
+    return groups
+
+def create_aggregate_prompt(query: str, responses: List[LLM_ChatCompletionResponse]) -> List[Dict[str, Any]]:
+    return [
+        { 'role' : 'system', 'content' : CHAT_SYSTEM_PROMPT() },
+        { 'role' : 'user', 'content' : CHAT_USER_QUERY_AGGREGATE_RESPONSES_PROMPT(query, responses) },
+    ]
 
-def aggregate_responses(messages: List[Dict[str, Any]], responses: List[LLM_ChatCompletionResponse], **kwargs) -> Optional[LLM_AggregateChatCompletionResponse]:
+def aggregate_responses(messages: List[Dict[str, Any]], 
+                        responses: List[LLM_ChatCompletionResponse], 
+                        aggregation_token_budget: int = AGGREGATION_TOKEN_BUDGET,
+                        response_format: Type[BaseModel] = LLM_AggregateChatCompletionResponse,
+                        **kwargs) -> Optional[LLM_AggregateChatCompletionResponse]:
     """Given a list of LLM_ChatCompletionResponse objects (actually dicts), 
-        aggregate them into a single response"""
+        aggregate them into a single response.
+        
+        If the relevant responses are too long to fit in one aggregation call (more than 
+        `aggregation_token_budget` tokens), they are first tree-reduced: consecutive groups of 
+        responses are aggregated in parallel, and the group-level results are aggregated again, 
+        until they fit.
+        
+        `response_format` (a subclass of LLM_AggregateChatCompletionResponse) is only used for the final
+        aggregation call, e.g. to also extract a structured verdict."""
     query: str = messages[-1]['content']
     if messages[-1]['role'] != 'user':
         logger.error(f"Most recent message must be a user message. Instead got: {messages[-1]}")
         return None
+    model: str = kwargs.get('model', DEFAULT_MODEL)
+    if aggregation_token_budget <= 0:
+        aggregation_token_budget = get_note_chunk_token_budget(model)
 
     # Remove responses that are `is_relevant == False`
     logger.info(f"aggregate_responses() -- received {len(responses)} responses")
@@ -24,54 +89,402 @@ def aggregate_responses(messages: List[Dict[str, Any]], responses: List[LLM_Chat
     logger.info(f"aggregate_responses() -- filtered to {len(responses)} relevant responses")
     
     try:
-        prompts = [
-            { 'role' : 'system', 'content' : CHAT_SYSTEM_PROMPT() },
-            { 'role' : 'user', 'content' : CHAT_USER_QUERY_AGGREGATE_RESPONSES_PROMPT(query, responses) },
-        ]
-        response = call_llm_with_retries(prompts, response_format=LLM_AggregateChatCompletionResponse, **kwargs)
+        # Tree-reduce until all responses fit into one aggregation call
+        level: int = 0
+        while len(responses) > 1 and count_tokens(str(responses), model=model) > aggregation_token_budget:
+            groups: List[List[LLM_ChatCompletionResponse]] = group_responses(responses, aggregation_token_budget, model=model)
+            level += 1
+            logger.info(f"aggregate_responses() -- level {level}: aggregating {len(responses)} responses in {len(groups)} groups")
+            with span('aggregation', level=level, n_groups=len(groups)):
+                results: List[Optional[LLM_AggregateChatCompletionResponse]] = run_llm_calls(
+                    [ (create_aggregate_prompt(query, group), ) for group in groups ],
+                    [ { **kwargs, 'response_format' : LLM_AggregateChatCompletionResponse } for _ in groups ]
+                )
+            if any([ r is None for r in results ]):
+                logger.error(f"aggregate_responses() -- failed to aggregate {sum([ r is None for r in results ])} groups at level {level}")
+                return None
+            # Group-level aggregates become the (still recency-ordered) inputs to the next level
+            responses = [ LLM_ChatCompletionResponse(**r.model_dump(), is_relevant=True) for r in results ]
+
+        with span('aggregation', level=level + 1, n_groups=1):
+            response = call_llm_with_retries(create_aggregate_prompt(query, responses), response_format=response_format, **kwargs)
         return response
     except Exception as e:
         logger.error(f"Error aggregating responses: {e}")
         return None
 
-def run_query_over_notes(messages: List[Dict[str, Any]], notes: List[Note], **kwargs) -> Optional[List[LLM_ChatCompletionResponse]]:
+def answer_follow_up(messages: List[Dict[str, Any]], 
+                     previous_query: str,
+                     previous_responses: List[LLM_ChatCompletionResponse], 
+                     **kwargs) -> Tuple[str, Optional[LLM_AggregateChatCompletionResponse]]:
+    """Try to answer a follow-up query (the last message in `messages`) from the note-level responses of the 
+        previous turn, in a single LLM call that also decides how much re-reading the query needs.
+        
+        Returns (scope, response), where scope is one of:
+            - FOLLOW_UP_SCOPE_EVIDENCE: answered from `previous_responses`, i.e. `response` is the final answer
+            - FOLLOW_UP_SCOPE_RELEVANT_NOTES: the notes behind the relevant `previous_responses` should be re-queried
+            - FOLLOW_UP_SCOPE_ALL_NOTES: every note should be re-queried (also returned if the call fails)"""
+    query: str = messages[-1]['content']
+    relevant_responses: List[LLM_ChatCompletionResponse] = [ r for r in previous_responses if r.is_relevant ]
+    model: str = kwargs.get('model', DEFAULT_MODEL)
+    aggregation_token_budget: int = AGGREGATION_TOKEN_BUDGET if AGGREGATION_TOKEN_BUDGET > 0 else get_note_chunk_token_budget(model)
+    if count_tokens(str(relevant_responses), model=model) > aggregation_token_budget:
+        # Too much evidence to reason over in one call => at least re-read the relevant notes
+        logger.info(f"answer_follow_up() -- {len(relevant_responses)} previous responses exceed the aggregation token budget")
+        return FOLLOW_UP_SCOPE_RELEVANT_NOTES if len(relevant_responses) > 0 else FOLLOW_UP_SCOPE_ALL_NOTES, None
+    prompt: List[Dict[str, Any]] = [
+        { 'role' : 'system', 'content' : CHAT_SYSTEM_PROMPT() },
+        *[ 
+            { 'role' : message['role'], 'content' : message['content'] } 
+            for message in messages[:-1] # Conversation history, excluding the most recent message (user's query)
+        ],
+        { 'role' : 'user', 'content' : CHAT_USER_QUERY_FOLLOW_UP_PROMPT(previous_query, query, relevant_responses) },
+    ]
+    try:
+        with span('follow_up', n_previous_responses=len(relevant_responses)):
+            response: Optional[LLM_FollowUpChatCompletionResponse] = call_llm_with_retries(prompt, response_format=LLM_FollowUpChatCompletionResponse, **kwargs)
+    except Exception as e:
+        logger.error(f"Error answering follow-up: {e}")
+        response = None
+    if response is None:
+        return FOLLOW_UP_SCOPE_ALL_NOTES, None
+    if response.is_answerable_from_evidence:
+        return FOLLOW_UP_SCOPE_EVIDENCE, LLM_AggregateChatCompletionResponse(**response.model_dump(exclude={ 'is_answerable_from_evidence', 'is_new_notes_needed' }))
+    if response.is_new_notes_needed or len(relevant_responses) == 0:
+        return FOLLOW_UP_SCOPE_ALL_NOTES, None
+    return FOLLOW_UP_SCOPE_RELEVANT_NOTES, None
+
+def run_llm_calls(args_list: List[Tuple], 
+                  kwargs_list: List[Dict[str, Any]], 
+                  on_result: Optional[Callable[[int, Any], None]] = None) -> List[Any]:
+    """Fan out LLM calls using the configured execution engine. Failed calls return None."""
+    if len(args_list) == 0:
+        return []
+    if LLM_EXECUTION_ENGINE == 'async':
+        return run_in_parallel_async(acall_llm_with_retries, args_list, kwargs_list=kwargs_list, on_result=on_result)
+    return run_in_parallel(call_llm_with_retries, 
+                           args_list, 
+                           kwargs_list=kwargs_list, 
+                           max_workers=min(10, len(args_list)), 
+                           pool_strat='thread', 
+                           merge_strat='append',
+                           on_result=on_result)
+
+def pack_notes(notes: List[Note], token_budget: int, model: str = DEFAULT_MODEL) -> List[List[int]]:
+    """Greedily group consecutive notes into batches of at most `token_budget` note tokens.
+        Notes that are larger than `token_budget` by themselves get their own batch.
+        Returns a list of batches, where each batch is a list of indices into `notes`."""
+    batches: List[List[int]] = []
+    batch_n_tokens: int = 0
+    for idx, note in enumerate(notes):
+        n_tokens: int = count_tokens(note.text, model=model)
+        if len(batches) == 0 or batch_n_tokens + n_tokens > token_budget:
+            batches.append([])
+            batch_n_tokens = 0
+        batches[-1].append(idx)
+        batch_n_tokens += n_tokens
+    return batches
+
+def log_prompt_cache_usage(func_name: str, usage_start: Dict[str, Any]) -> None:
+    """Log prompt tokens sent (and how many were read from the provider's prompt cache) since `usage_start`.
+        NOTE: Usage is tracked process-wide, so this also includes any concurrent requests."""
+    usage_end: Dict[str, Any] = get_usage_tracker().get_totals()
+    prompt_tokens: int = usage_end['prompt_tokens'] - usage_start['prompt_tokens']
+    cached_prompt_tokens: int = usage_end['cached_prompt_tokens'] - usage_start['cached_prompt_tokens']
+    logger.info(f"{func_name}() -- {prompt_tokens} prompt tokens, {cached_prompt_tokens} ({cached_prompt_tokens / max(1, prompt_tokens):.0%}) read from provider prompt cache")
+
+def split_notes_into_units(notes: List[Note], chunk_token_budget: int, model: str = DEFAULT_MODEL) -> Tuple[List[Note], List[int]]:
+    """Split notes longer than `chunk_token_budget` into chunks. 
+        Returns (units, index into `notes` of each unit's note), where each unit is a whole note or one chunk of a note."""
+    units: List[Note] = []
+    unit_2_note_idx: List[int] = []
+    for idx, note in enumerate(notes):
+        for chunk in chunk_note(note, chunk_token_budget, model=model):
+            units.append(chunk)
+            unit_2_note_idx.append(idx)
+    if len(units) > len(notes):
+        logger.info(f"split_notes_into_units() -- split {len(notes)} notes into {len(units)} chunks")
+    return units, unit_2_note_idx
+
+def create_query_prompt(messages: List[Dict[str, Any]], context_prompt: str, user_prompt: str) -> List[Dict[str, Any]]:
+    """System prompt => `context_prompt` (the note(s)) => conversation history => `user_prompt` (which replaces the most recent user message).
+        
+        Everything up to and including `context_prompt` is independent of the query, so it is marked with `cache_control`
+        to let providers reuse it across queries over the same note (stripped for providers that don't need it)."""
+    return [
+        { 'role' : 'system', 'content' : CHAT_SYSTEM_PROMPT() },
+        { 'role' : 'user', 'content' : [ { 'type' : 'text', 'text' : context_prompt, 'cache_control' : { 'type' : 'ephemeral' } } ] },
+        *[
+            { 'role' : message['role'], 'content' : message['content'] } 
+            for message in messages[:-1] # Exclude the most recent message (user's query)
+        ],
+        { 'role' : 'user', 'content' : user_prompt } 
+    ]
+
+def triage_notes(query: str, 
+                 notes: List[Note], 
+                 model: str, 
+                 min_confidence: float = TRIAGE_MIN_CONFIDENCE,
+                 **kwargs) -> Tuple[List[Note], Dict[str, Any]]:
+    """First stage of the model cascade: ask a cheap `model` whether each note is relevant to `query` at all,
+        using a minimal relevance-only schema, so that the (expensive) main model only reads the notes that it escalates.
+        
+        A note is escalated if any of its chunks is marked relevant, is marked irrelevant with a confidence below
+        `min_confidence`, or fails to get a triage response (i.e. triage only ever skips notes it is sure about).
+        Returns (escalated notes in their original order, stats)."""
+    units, unit_2_note_idx = split_notes_into_units(notes, get_note_chunk_token_budget(model), model=model)
+    with span('triage', model=model, n_notes=len(notes), n_units=len(units)):
+        results: List[Optional[LLM_RelevanceTriageResponse]] = run_llm_calls(
+            [ (create_query_prompt([ { 'role' : 'user', 'content' : query } ], CHAT_ONE_NOTE_CONTEXT_PROMPT(unit.text), CHAT_USER_QUERY_TRIAGE_PROMPT(query)), ) for unit in units ],
+            [ { **kwargs, 'model' : model, 'max_retries' : 2, 'response_format' : LLM_RelevanceTriageResponse } for _ in units ]
+        )
+    
+    # note_idx => why it was escalated (if it was), keeping the strongest reason across its chunks
+    reason_2_priority: Dict[str, int] = { 'relevant' : 2, 'low_confidence' : 1, 'failed' : 0 }
+    note_idx_2_reason: Dict[int, str] = {}
+    for note_idx, result in zip(unit_2_note_idx, results):
+        if result is None:
+            reason = 'failed'
+        elif result.is_relevant:
+            reason = 'relevant'
+        elif result.confidence < min_confidence:
+            reason = 'low_confidence'
+        else:
+            continue
+        if note_idx not in note_idx_2_reason or reason_2_priority[reason] > reason_2_priority[note_idx_2_reason[note_idx]]:
+            note_idx_2_reason[note_idx] = reason
+    escalated_notes: List[Note] = [ note for idx, note in enumerate(notes) if idx in note_idx_2_reason ]
+    
+    stats: Dict[str, Any] = {
+        'model' : model,
+        'min_confidence' : min_confidence,
+        'n_notes' : len(notes),
+        'n_escalated' : len(escalated_notes),
+        'n_skipped' : len(notes) - len(escalated_notes),
+        **{ f'n_escalated_{reason}' : sum([ r == reason for r in note_idx_2_reason.values() ]) for reason in [ 'relevant', 'low_confidence', 'failed' ] },
+        'escalation_rate' : len(escalated_notes) / len(notes) if len(notes) > 0 else 0.0,
+    }
+    for result in [ 'skipped', 'escalated_relevant', 'escalated_low_confidence', 'escalated_failed' ]:
+        get_metrics_registry().inc('ehrllm_triage_notes_total', stats[f'n_{result}'], help="Notes triaged by the cascade's cheap model, by outcome", model=model, result=result)
+    logger.info(f"triage_notes() -- {model} escalated {stats['n_escalated']} / {stats['n_notes']} notes ({stats['n_escalated_relevant']} relevant, {stats['n_escalated_low_confidence']} low confidence, {stats['n_escalated_failed']} failed)")
+    return escalated_notes, stats
+
+def run_query_over_notes(messages: List[Dict[str, Any]], 
+                         notes: List[Note], 
+                         packing_token_budget: int = NOTE_PACKING_TOKEN_BUDGET,
+                         on_note_response: Optional[Callable[[int, LLM_ChatCompletionResponse], None]] = None,
+                         dedup_plan: Optional[NoteDedupPlan] = None,
+                         **kwargs) -> Optional[List[LLM_ChatCompletionResponse]]:
     """Given a list of messages and notes, run the conversation over each individual 
-        note and return the responses"""
+        note and return the responses (one per note, in the same order as `notes`).
+        
+        If `dedup_plan` (see `plan_note_dedup()`) is provided, only its units are sent to the LLM, and each 
+        note's response is rebuilt from the responses of the units it depends on.
+        
+        Notes too long for the model's context window are split into overlapping chunks on section 
+        boundaries, queried in parallel, and their chunk-level responses merged back into one response.
+        
+        If `packing_token_budget > 0`, short notes are packed together into a single LLM call 
+        (up to `packing_token_budget` note tokens per call), but each note still gets its own response.
+        
+        If `on_note_response` is provided, it is called with (index into `notes`, response) as soon as
+        each note's response is ready (possibly from another thread), e.g. to stream progress."""
     query: str = messages[-1]['content']
     if messages[-1]['role'] != 'user':
         logger.error(f"Most recent message must be a user message. Instead got: {messages[-1]}")
         return None
+    if dedup_plan is not None:
+        return run_query_over_deduped_notes(messages, notes, dedup_plan, packing_token_budget=packing_token_budget, on_note_response=on_note_response, **kwargs)
+    model: str = kwargs.get('model', DEFAULT_MODEL)
+    usage_start: Dict[str, Any] = get_usage_tracker().get_totals()
     
-    # Create prompts
-    prompts: List[List[Dict[str, Any]]] = [ 
-        [
-            { 'role' : 'system', 'content' : CHAT_SYSTEM_PROMPT() },
-            *[
-                { 'role' : message['role'], 'content' : message['content'] } 
-                for message in messages[:-1] # Exclude the most recent message (user's query)
-            ],
-            { 'role' : 'user', 'content' : CHAT_USER_QUERY_OVER_ONE_NOTE_PROMPT(query, note.text) } 
-        ]
-        for note in notes 
-    ]
+    # Split notes that don't fit in the model's context window into chunks.
+    # Each "unit" (a whole note or one chunk of a note) gets its own response.
+    chunk_token_budget: int = get_note_chunk_token_budget(model)
+    units, unit_2_note_idx = split_notes_into_units(notes, chunk_token_budget, model=model)
+    
+    # Group units into batches that share one LLM call
+    if packing_token_budget > 0:
+        batches: List[List[int]] = pack_notes(units, min(packing_token_budget, chunk_token_budget), model=model)
+    else:
+        batches: List[List[int]] = [ [ idx ] for idx in range(len(units)) ]
+    logger.info(f"run_query_over_notes() -- packed {len(units)} notes into {len(batches)} LLM calls")
+    
+    # Track which units are still outstanding for each note, so that `on_note_response` can 
+    # fire as soon as a note's last unit finishes
+    unit_responses: List[Optional[LLM_ChatCompletionResponse]] = [ None ] * len(units)
+    note_idx_2_unit_idxs: Dict[int, List[int]] = {}
+    for unit_idx, note_idx in enumerate(unit_2_note_idx):
+        note_idx_2_unit_idxs.setdefault(note_idx, []).append(unit_idx)
+    note_idx_2_n_pending: Dict[int, int] = { note_idx : len(unit_idxs) for note_idx, unit_idxs in note_idx_2_unit_idxs.items() }
+    lock = threading.Lock()
+
+    def get_note_response(note_idx: int) -> LLM_ChatCompletionResponse:
+        """Merge chunk-level responses into one response for the note + add citation note_ids"""
+        response: LLM_ChatCompletionResponse = merge_chunk_responses([ unit_responses[unit_idx] for unit_idx in note_idx_2_unit_idxs[note_idx] ])
+        for evidence in response.evidence:
+            for quote in evidence.quotes:
+                quote.source = notes[note_idx].note_id
+        return response
+
+    def set_unit_response(unit_idx: int, response: LLM_ChatCompletionResponse) -> None:
+        with lock:
+            if unit_responses[unit_idx] is not None:
+                return
+            unit_responses[unit_idx] = response
+            note_idx: int = unit_2_note_idx[unit_idx]
+            note_idx_2_n_pending[note_idx] -= 1
+            is_note_done: bool = note_idx_2_n_pending[note_idx] == 0
+        if is_note_done and on_note_response is not None:
+            on_note_response(note_idx, get_note_response(note_idx))
+
+    def on_batch_result(batch: List[int], result: Any) -> None:
+        """Unpack a (possibly batched) LLM response into one response per unit"""
+        if result is None:
+            return
+        if len(batch) == 1:
+            set_unit_response(batch[0], result)
+            return
+        for r in result.responses:
+            if 0 <= r.note_index < len(batch):
+                set_unit_response(batch[r.note_index], LLM_ChatCompletionResponse(**r.model_dump(exclude={ 'note_index' })))
     
     try:
         # Send chat completion requests
-        args_list = [ (p, ) for p in prompts ]
-        kwargs_list = [ { **kwargs, 'max_retries' : 2, 'response_format' : LLM_ChatCompletionResponse } for _ in prompts ]
-        responses: List[LLM_ChatCompletionResponse] = run_in_parallel(call_llm_with_retries, 
-                                                                    args_list, 
-                                                                    kwargs_list=kwargs_list, 
-                                                                    max_workers=min(10, len(prompts)), 
-                                                                    pool_strat='thread', 
-                                                                    merge_strat='append')
-        # Collect responses + add citation note_ids
-        for idx, r in enumerate(responses):
-            for evidence in r.evidence:
-                for quote in evidence.quotes:
-                    quote.source = notes[idx].note_id
-
-        return responses
+        args_list: List[Tuple] = []
+        kwargs_list: List[Dict[str, Any]] = []
+        for batch in batches:
+            if len(batch) == 1:
+                args_list.append((create_query_prompt(messages, CHAT_ONE_NOTE_CONTEXT_PROMPT(units[batch[0]].text), CHAT_USER_QUERY_OVER_ONE_NOTE_PROMPT(query)), ))
+                kwargs_list.append({ **kwargs, 'max_retries' : 2, 'response_format' : LLM_ChatCompletionResponse })
+            else:
+                args_list.append((create_query_prompt(messages, CHAT_MULTIPLE_NOTES_CONTEXT_PROMPT([ units[idx].text for idx in batch ]), CHAT_USER_QUERY_OVER_MULTIPLE_NOTES_PROMPT(query)), ))
+                kwargs_list.append({ **kwargs, 'max_retries' : 2, 'response_format' : LLM_MultiNoteChatCompletionResponse })
+        with span('note_fanout', n_notes=len(notes), n_units=len(units), n_llm_calls=len(batches)):
+            run_llm_calls(args_list, kwargs_list, on_result=lambda idx, result: on_batch_result(batches[idx], result))
+        
+        # Units that the LLM skipped within a batch get their own call
+        missing_idxs: List[int] = [ idx for batch in batches if len(batch) > 1 for idx in batch if unit_responses[idx] is None ]
+        if len(missing_idxs) > 0:
+            logger.warning(f"run_query_over_notes() -- re-running {len(missing_idxs)} notes missing from batched responses")
+            with span('note_fanout_fallback', n_llm_calls=len(missing_idxs)):
+                run_llm_calls([ (create_query_prompt(messages, CHAT_ONE_NOTE_CONTEXT_PROMPT(units[idx].text), CHAT_USER_QUERY_OVER_ONE_NOTE_PROMPT(query)), ) for idx in missing_idxs ],
+                              [ { **kwargs, 'max_retries' : 2, 'response_format' : LLM_ChatCompletionResponse } for _ in missing_idxs ],
+                              on_result=lambda idx, result: on_batch_result([ missing_idxs[idx] ], result))
+        
+        # Merge chunk-level responses into one response per note
+        log_prompt_cache_usage("run_query_over_notes", usage_start)
+        return [ get_note_response(idx) for idx in range(len(notes)) ]
     except Exception as e:
         logger.error(f"Error running query over notes: {e}")
-        return None
\ No newline at end of file
+        return None
+
+def run_query_over_deduped_notes(messages: List[Dict[str, Any]], 
+                                 notes: List[Note], 
+                                 dedup_plan: NoteDedupPlan,
+                                 on_note_response: Optional[Callable[[int, LLM_ChatCompletionResponse], None]] = None,
+                                 **kwargs) -> Optional[List[LLM_ChatCompletionResponse]]:
+    """`run_query_over_notes()` over the units of `dedup_plan`, expanded back into one response per note in `notes`.
+        `on_note_response` fires for a note once every unit it depends on has finished."""
+    logger.info(f"run_query_over_deduped_notes() -- querying {len(dedup_plan.units)} deduplicated notes for {len(notes)} notes")
+    
+    # Track which units are still outstanding for each note
+    unit_idx_2_note_idxs: Dict[int, List[int]] = {}
+    note_idx_2_n_pending: Dict[int, int] = {}
+    for note_idx in range(len(notes)):
+        unit_idxs: set = set(dedup_plan.note_idx_2_source_unit_idxs[note_idx])
+        if dedup_plan.note_idx_2_unit_idx[note_idx] is not None:
+            unit_idxs.add(dedup_plan.note_idx_2_unit_idx[note_idx])
+        for unit_idx in unit_idxs:
+            unit_idx_2_note_idxs.setdefault(unit_idx, []).append(note_idx)
+        note_idx_2_n_pending[note_idx] = len(unit_idxs)
+    unit_responses: List[Optional[LLM_ChatCompletionResponse]] = [ None ] * len(dedup_plan.units)
+    lock = threading.Lock()
+
+    def on_unit_response(unit_idx: int, response: LLM_ChatCompletionResponse) -> None:
+        with lock:
+            unit_responses[unit_idx] = response
+            done_note_idxs: List[int] = []
+            for note_idx in unit_idx_2_note_idxs.get(unit_idx, []):
+                note_idx_2_n_pending[note_idx] -= 1
+                if note_idx_2_n_pending[note_idx] == 0:
+                    done_note_idxs.append(note_idx)
+        for note_idx in done_note_idxs:
+            on_note_response(note_idx, get_deduped_note_response(dedup_plan, notes, note_idx, unit_responses))
+
+    responses: Optional[List[LLM_ChatCompletionResponse]] = run_query_over_notes(messages, 
+                                                                                 dedup_plan.units, 
+                                                                                 on_note_response=on_unit_response if on_note_response is not None else None, 
+                                                                                 **kwargs)
+    if responses is None:
+        return None
+    return get_deduped_note_responses(dedup_plan, notes, responses)
+
+def run_queries_over_notes(messages: List[Dict[str, Any]], 
+                           queries: List[str], 
+                           notes: List[Note], 
+                           **kwargs) -> Optional[List[List[LLM_ChatCompletionResponse]]]:
+    """Answer several independent `queries` over each note in a single pass, i.e. with one LLM call per note
+        (or chunk of a note) instead of one call per note per query. `messages` is the conversation history
+        that precedes the queries (may be empty).
+        
+        Returns one list of per-note responses per query, i.e. `result[query_idx][note_idx]`, each of 
+        which can be passed to `aggregate_responses()` like the output of `run_query_over_notes()`.
+        Queries that the LLM skipped for a given note fall back to a single-query call."""
+    model: str = kwargs.get('model', DEFAULT_MODEL)
+    usage_start: Dict[str, Any] = get_usage_tracker().get_totals()
+    units, unit_2_note_idx = split_notes_into_units(notes, get_note_chunk_token_budget(model), model=model)
+    logger.info(f"run_queries_over_notes() -- running {len(queries)} queries over {len(units)} notes in {len(units)} LLM calls")
+    
+    # (query_idx, unit_idx) => response
+    responses: Dict[Tuple[int, int], LLM_ChatCompletionResponse] = {}
+    lock = threading.Lock()
+
+    def on_unit_result(unit_idx: int, result: Optional[LLM_MultiQuestionChatCompletionResponse]) -> None:
+        if result is None:
+            return
+        with lock:
+            for r in result.responses:
+                if 0 <= r.question_index < len(queries):
+                    responses.setdefault((r.question_index, unit_idx), LLM_ChatCompletionResponse(**r.model_dump(exclude={ 'question_index' })))
+
+    try:
+        # NOTE: `create_query_prompt()` replaces the last message with the note-level prompt
+        with span('note_fanout', n_notes=len(notes), n_units=len(units), n_llm_calls=len(units), n_queries=len(queries)):
+            run_llm_calls([ (create_query_prompt([ *messages, { 'role' : 'user', 'content' : "\n".join(queries) } ], CHAT_ONE_NOTE_CONTEXT_PROMPT(unit.text), CHAT_USER_QUERIES_OVER_ONE_NOTE_PROMPT(queries)), ) for unit in units ],
+                          [ { **kwargs, 'max_retries' : 2, 'response_format' : LLM_MultiQuestionChatCompletionResponse } for _ in units ],
+                          on_result=on_unit_result)
+        
+        # Queries that the LLM skipped within a unit get their own call
+        missing: List[Tuple[int, int]] = [ (query_idx, unit_idx) for unit_idx in range(len(units)) for query_idx in range(len(queries)) if (query_idx, unit_idx) not in responses ]
+        if len(missing) > 0:
+            logger.warning(f"run_queries_over_notes() -- re-running {len(missing)} (query, note) pairs missing from multi-query responses")
+            with span('note_fanout_fallback', n_llm_calls=len(missing)):
+                results: List[Optional[LLM_ChatCompletionResponse]] = run_llm_calls(
+                    [ (create_query_prompt([ *messages, { 'role' : 'user', 'content' : queries[query_idx] } ], CHAT_ONE_NOTE_CONTEXT_PROMPT(units[unit_idx].text), CHAT_USER_QUERY_OVER_ONE_NOTE_PROMPT(queries[query_idx])), ) for query_idx, unit_idx in missing ],
+                    [ { **kwargs, 'max_retries' : 2, 'response_format' : LLM_ChatCompletionResponse } for _ in missing ]
+                )
+            for (query_idx, unit_idx), result in zip(missing, results):
+                if result is None:
+                    logger.error(f"run_queries_over_notes() -- failed to get a response for query {query_idx} over note {notes[unit_2_note_idx[unit_idx]].note_id}")
+                    return None
+                responses[(query_idx, unit_idx)] = result
+        
+        # Merge chunk-level responses into one response per (query, note)
+        note_idx_2_unit_idxs: Dict[int, List[int]] = {}
+        for unit_idx, note_idx in enumerate(unit_2_note_idx):
+            note_idx_2_unit_idxs.setdefault(note_idx, []).append(unit_idx)
+        query_responses: List[List[LLM_ChatCompletionResponse]] = []
+        for query_idx in range(len(queries)):
+            query_responses.append([])
+            for note_idx in range(len(notes)):
+                response: LLM_ChatCompletionResponse = merge_chunk_responses([ responses[(query_idx, unit_idx)] for unit_idx in note_idx_2_unit_idxs[note_idx] ])
+                for evidence in response.evidence:
+                    for quote in evidence.quotes:
+                        quote.source = notes[note_idx].note_id
+                query_responses[-1].append(response)
+        log_prompt_cache_usage("run_queries_over_notes", usage_start)
+        return query_responses
+    except Exception as e:
+        logger.error(f"Error running queries over notes: {e}")
+        return None
@@ -0,0 +1,91 @@
+import re
+import dataclasses
+from typing import List
+from ehrllm.backend.app.models import Note
+from ehrllm.backend.app.config import NOTE_CHUNK_CONTEXT_FRACTION, NOTE_CHUNK_OVERLAP_TOKENS
+from ehrllm.llms.models import LLM_ChatCompletionResponse, LLM_Evidence
+from ehrllm.llms.utils import DEFAULT_MODEL, count_tokens, get_model_max_input_tokens
+
+# Section headers in MIMIC-IV / n2c2 notes, e.g. "History of Present Illness:" or "PHYSICAL EXAM:" at the start of a line
+SECTION_HEADER_REGEX = re.compile(r'^[ \t]*[A-Z][A-Za-z0-9 /&,()\'-]{1,60}:', re.MULTILINE)
+
+def get_note_chunk_token_budget(model: str = DEFAULT_MODEL) -> int:
+    """Max # of note tokens to send in one LLM call, leaving the rest of `model`'s context
+        window for the system prompt, conversation history, and response"""
+    return int(get_model_max_input_tokens(model) * NOTE_CHUNK_CONTEXT_FRACTION)
+
+def split_into_segments(text: str, max_chars: int) -> List[str]:
+    """Split `text` on section headers, then split any section longer than `max_chars`
+        on blank lines, then on newlines, then at hard character boundaries"""
+    starts: List[int] = sorted(set([ 0 ] + [ m.start() for m in SECTION_HEADER_REGEX.finditer(text) ]))
+    segments: List[str] = [ text[start:end] for start, end in zip(starts, starts[1:] + [ len(text) ]) ]
+    for separator in [ '\n\n', '\n', None ]:
+        if all([ len(s) <= max_chars for s in segments ]):
+            break
+        split_segments: List[str] = []
+        for segment in segments:
+            if len(segment) <= max_chars:
+                split_segments.append(segment)
+            elif separator is None:
+                split_segments += [ segment[i:i + max_chars] for i in range(0, len(segment), max_chars) ]
+            else:
+                parts: List[str] = segment.split(separator)
+                split_segments += [ part + separator for part in parts[:-1] ] + [ parts[-1] ]
+        segments = split_segments
+    return [ s for s in segments if s ]
+
+def chunk_note(note: Note, max_tokens: int, overlap_tokens: int = NOTE_CHUNK_OVERLAP_TOKENS, model: str = DEFAULT_MODEL) -> List[Note]:
+    """Split `note` into chunks of at most ~`max_tokens` tokens on section boundaries, where each chunk
+        after the first also repeats the last ~`overlap_tokens` tokens of the previous chunk.
+        Returns `[ note ]` if it already fits. Chunks keep the note's `note_id` (and other metadata)."""
+    n_tokens: int = count_tokens(note.text, model=model)
+    if n_tokens <= max_tokens:
+        return [ note ]
+
+    # Work in characters (using this note's chars/token ratio) to avoid re-tokenizing every candidate chunk
+    chars_per_token: float = len(note.text) / max(1, n_tokens)
+    overlap_chars: int = int(min(overlap_tokens, max_tokens // 4) * chars_per_token)
+    max_chars: int = max(1, int(max_tokens * chars_per_token) - overlap_chars)
+
+    chunks: List[str] = []
+    for segment in split_into_segments(note.text, max_chars):
+        if len(chunks) > 0 and len(chunks[-1]) + len(segment) <= max_chars:
+            chunks[-1] += segment
+        else:
+            chunks.append(segment)
+
+    # Prefix each chunk with the tail of the previous chunk (starting at a line boundary, if possible)
+    texts: List[str] = [ chunks[0] ]
+    for prev_chunk, chunk in zip(chunks, chunks[1:]):
+        overlap: str = prev_chunk[-overlap_chars:] if overlap_chars > 0 else ''
+        line_start: int = overlap.find('\n', 0, len(overlap.rstrip('\n')))
+        if line_start != -1:
+            overlap = overlap[line_start + 1:]
+        texts.append(overlap + chunk)
+    return [ dataclasses.replace(note, text=text) for text in texts ]
+
+def merge_chunk_responses(responses: List[LLM_ChatCompletionResponse]) -> LLM_ChatCompletionResponse:
+    """Merge the responses for each chunk of a note into one response for the whole note.
+        The note is relevant if any chunk is, and evidence is unioned across relevant chunks
+        (dropping quotes repeated due to chunk overlap)."""
+    if len(responses) == 1:
+        return responses[0]
+    relevant_responses: List[LLM_ChatCompletionResponse] = [ r for r in responses if r.is_relevant ]
+
+    seen_quotes: set = set()
+    evidence: List[LLM_Evidence] = []
+    for r in relevant_responses:
+        for e in r.evidence:
+            quotes = [ q for q in e.quotes if q.quote not in seen_quotes ]
+            seen_quotes.update([ q.quote for q in quotes ])
+            if len(quotes) > 0 or len(e.quotes) == 0:
+                evidence.append(LLM_Evidence(claim=e.claim, quotes=quotes))
+
+    answers: List[str] = [ r.answer for r in relevant_responses if r.answer ]
+    return LLM_ChatCompletionResponse(
+        thinking="\n\n".join([ f"[Part {idx + 1}/{len(responses)}] {r.thinking}" for idx, r in enumerate(responses) ]),
+        reflection="\n\n".join([ f"[Part {idx + 1}/{len(responses)}] {r.reflection}" for idx, r in enumerate(responses) ]),
+        is_relevant=len(relevant_responses) > 0,
+        evidence=evidence,
+        answer="\n\n".join(answers) if len(answers) > 0 else None,
+    )
@@ -0,0 +1,146 @@
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, asdict, field
+from typing import Any, Dict, List, Optional, Tuple
+from ehrllm.backend.app.config import CONVERSATION_MAX_AGE_SECONDS, CONVERSATION_STORE_N_ENTRIES
+from ehrllm.backend.app.models import NoteFilter
+from ehrllm.llms.models import LLM_ChatCompletionResponse
+
+########################################################
+# Per-conversation state: the per-note responses behind each answer, so that follow-up turns can reuse them
+########################################################
+
+# How a follow-up turn was answered
+FOLLOW_UP_SCOPE_EVIDENCE: str = 'evidence' # From the previous turn's per-note evidence alone (one LLM call)
+FOLLOW_UP_SCOPE_RELEVANT_NOTES: str = 'relevant_notes' # By re-querying only the notes the previous turn found relevant
+FOLLOW_UP_SCOPE_ALL_NOTES: str = 'all_notes' # By re-scanning every note, same as a first turn
+
+@dataclass
+class ConversationTurn:
+    """The per-note responses that one assistant answer was built from"""
+    database: str
+    patient_id: str
+    query: str
+    note_filter: Optional[NoteFilter]
+    note_ids: List[str] # Notes that have a response, most recent first
+    note_responses: List[LLM_ChatCompletionResponse] # Aligned with `note_ids`
+    created_at: float = field(default_factory=time.time)
+
+    def get_relevant_note_ids(self) -> List[str]:
+        return [ note_id for note_id, response in zip(self.note_ids, self.note_responses) if response.is_relevant ]
+
+    def get_relevant_note_responses(self) -> List[LLM_ChatCompletionResponse]:
+        return [ response for response in self.note_responses if response.is_relevant ]
+
+    def get_note_id_2_response(self) -> Dict[str, LLM_ChatCompletionResponse]:
+        return dict(zip(self.note_ids, self.note_responses))
+
+@dataclass
+class ConversationStoreStats:
+    hits: int = 0
+    misses: int = 0
+    writes: int = 0
+    n_follow_ups_by_scope: Dict[str, int] = field(default_factory=dict)
+
+class ConversationStore:
+    """Maps the `message_id` of each assistant answer => the `ConversationTurn` it was built from.
+
+    The frontend sends the whole conversation (including each assistant message's `id`) with every request,
+    so a follow-up finds its previous turn via the id of the last assistant message -- no extra client state.
+    Turns are stored under a `turn_key` (e.g. the response cache key) that several message_ids can point to,
+    since a cached response is served under a new message_id each time.
+
+    Kept in memory (LRU of the `n_entries` most recently used turns): a miss just means a full re-scan.
+    """
+
+    def __init__(self, n_entries: int = 1024, max_age_seconds: Optional[float] = None):
+        self.n_entries = n_entries
+        self.max_age_seconds = max_age_seconds
+        self.stats = ConversationStoreStats()
+        self._turns: 'OrderedDict[str, ConversationTurn]' = OrderedDict()
+        self._message_id_2_turn_key: 'OrderedDict[str, str]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set_turn(self, turn_key: str, turn: ConversationTurn) -> None:
+        with self._lock:
+            self._turns[turn_key] = turn
+            self._turns.move_to_end(turn_key)
+            while len(self._turns) > self.n_entries:
+                self._turns.popitem(last=False)
+            self.stats.writes += 1
+
+    def link_message(self, message_id: str, turn_key: str) -> None:
+        """Record that the assistant message `message_id` was answered from the turn stored under `turn_key`"""
+        with self._lock:
+            if turn_key not in self._turns:
+                return
+            self._message_id_2_turn_key[message_id] = turn_key
+            self._message_id_2_turn_key.move_to_end(message_id)
+            # Several message_ids can point to the same turn, so allow a few per turn before evicting
+            while len(self._message_id_2_turn_key) > 4 * self.n_entries:
+                self._message_id_2_turn_key.popitem(last=False)
+
+    def get_turn(self, message_id: str) -> Optional[ConversationTurn]:
+        with self._lock:
+            turn_key: Optional[str] = self._message_id_2_turn_key.get(message_id)
+            turn: Optional[ConversationTurn] = self._turns.get(turn_key) if turn_key is not None else None
+            if turn is not None and self.max_age_seconds is not None and time.time() - turn.created_at > self.max_age_seconds:
+                del self._turns[turn_key]
+                turn = None
+            if turn is None:
+                self.stats.misses += 1
+                return None
+            self._turns.move_to_end(turn_key)
+            self.stats.hits += 1
+            return turn
+
+    def record_follow_up(self, scope: str) -> None:
+        with self._lock:
+            self.stats.n_follow_ups_by_scope[scope] = self.stats.n_follow_ups_by_scope.get(scope, 0) + 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = asdict(self.stats)
+            stats['n_entries'] = len(self._turns)
+        return stats
+
+def get_previous_turn(store: ConversationStore,
+                      messages: List[Dict[str, Any]],
+                      database: str,
+                      patient_id: str,
+                      note_filter: Optional[NoteFilter]) -> Optional[ConversationTurn]:
+    """The turn behind the last assistant answer in `messages` (which ends with the new user query), if it is still
+        stored and was over the same patient + notes. Returns None for the first turn of a conversation."""
+    previous_messages: List[Dict[str, Any]] = messages[:-1]
+    if len(previous_messages) < 2 or previous_messages[-1].get('role') != 'assistant' or previous_messages[-2].get('role') != 'user':
+        return None
+    message_id: Optional[str] = previous_messages[-1].get('id')
+    if not message_id:
+        return None
+    turn: Optional[ConversationTurn] = store.get_turn(str(message_id))
+    if turn is None:
+        return None
+    if (turn.database, turn.patient_id, turn.note_filter, turn.query) != (database, patient_id, note_filter, previous_messages[-2].get('content')):
+        return None
+    return turn
+
+def merge_turn_responses(previous_turn: ConversationTurn,
+                         note_ids: List[str],
+                         note_responses: List[LLM_ChatCompletionResponse]) -> Tuple[List[str], List[LLM_ChatCompletionResponse]]:
+    """Responses of the previous turn, with the notes that were re-queried this turn (`note_ids`) replaced by their new responses"""
+    note_id_2_response: Dict[str, LLM_ChatCompletionResponse] = { **previous_turn.get_note_id_2_response(), **dict(zip(note_ids, note_responses)) }
+    previous_note_ids: set = set(previous_turn.note_ids)
+    merged_note_ids: List[str] = previous_turn.note_ids + [ note_id for note_id in note_ids if note_id not in previous_note_ids ]
+    return merged_note_ids, [ note_id_2_response[note_id] for note_id in merged_note_ids ]
+
+_conversation_store: Optional[ConversationStore] = None
+_conversation_store_lock = threading.Lock()
+
+def get_conversation_store() -> ConversationStore:
+    """Process-wide store of conversation turns"""
+    global _conversation_store
+    with _conversation_store_lock:
+        if _conversation_store is None:
+            _conversation_store = ConversationStore(n_entries=CONVERSATION_STORE_N_ENTRIES, max_age_seconds=CONVERSATION_MAX_AGE_SECONDS)
+    return _conversation_store
@@ -0,0 +1,223 @@
+import dataclasses
+import functools
+import hashlib
+import re
+import zlib
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from ehrllm.backend.app.models import Note
+from ehrllm.backend.app.config import (
+    NOTE_DEDUP_MIN_SECTION_CHARS,
+    NOTE_DEDUP_N_PERMUTATIONS,
+    NOTE_DEDUP_SHINGLE_SIZE,
+    NOTE_DEDUP_THRESHOLD,
+)
+from ehrllm.llms.models import LLM_ChatCompletionResponse, LLM_Evidence, LLM_Quote
+from ehrllm.llms.utils import DEFAULT_MODEL, count_tokens
+
+########################################################
+# Near-duplicate / copy-forward detection over a patient's notes, so that repeated text is only sent to the LLM once.
+#
+# Every note gets a MinHash signature over its word shingles at load time. At query time, notes whose signatures
+# are close to a newer note's are collapsed into that note's LLM call, and sections copied forward verbatim from a
+# newer note are elided. Evidence is then attributed back to every note that contains the quoted text.
+########################################################
+
+TOKEN_REGEX = re.compile(r'[a-z0-9]+')
+# Mersenne prime 2^31 - 1, so that (a * hash + b) never overflows uint64
+MINHASH_PRIME: int = (1 << 31) - 1
+# Blank lines separate sections (n2c2 notes are normalized to this at parse time; MIMIC-IV sections follow the same layout)
+SECTION_SEPARATOR_REGEX = re.compile(r'(\n\s*\n)')
+ELIDED_SECTION_PLACEHOLDER: str = "[Section omitted: repeated verbatim in another note]"
+
+@functools.lru_cache(maxsize=None)
+def get_minhash_permutations(n_permutations: int) -> Tuple[np.ndarray, np.ndarray]:
+    """(a, b) of the hash functions (a * x + b) % MINHASH_PRIME. Seeded, so that signatures are comparable across processes / snapshots."""
+    rng = np.random.RandomState(0)
+    a: np.ndarray = rng.randint(1, MINHASH_PRIME, size=n_permutations).astype(np.uint64)
+    b: np.ndarray = rng.randint(0, MINHASH_PRIME, size=n_permutations).astype(np.uint64)
+    return a, b
+
+def get_shingle_hashes(text: str, shingle_size: int = NOTE_DEDUP_SHINGLE_SIZE) -> np.ndarray:
+    """Unique hashes of every run of `shingle_size` consecutive (lowercased, alphanumeric) words in `text`"""
+    tokens: List[str] = TOKEN_REGEX.findall(text.lower())
+    if len(tokens) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    token_hashes: np.ndarray = np.array([ zlib.crc32(t.encode('utf-8')) for t in tokens ], dtype=np.uint64)
+    shingle_size = min(shingle_size, len(tokens))
+    n_shingles: int = len(tokens) - shingle_size + 1
+    # Polynomial hash over each window of `shingle_size` token hashes
+    shingle_hashes: np.ndarray = np.zeros(n_shingles, dtype=np.uint64)
+    for offset in range(shingle_size):
+        shingle_hashes = (shingle_hashes * np.uint64(1_000_003) + token_hashes[offset:offset + n_shingles]) % np.uint64(MINHASH_PRIME)
+    return np.unique(shingle_hashes)
+
+def compute_minhash(text: str,
+                    shingle_size: int = NOTE_DEDUP_SHINGLE_SIZE,
+                    n_permutations: int = NOTE_DEDUP_N_PERMUTATIONS) -> np.ndarray:
+    """MinHash signature (`n_permutations` uint32s) of the word shingles of `text`"""
+    a, b = get_minhash_permutations(n_permutations)
+    shingle_hashes: np.ndarray = get_shingle_hashes(text, shingle_size)
+    if len(shingle_hashes) == 0:
+        return np.full(n_permutations, MINHASH_PRIME, dtype=np.uint32)
+    return ((a[:, None] * shingle_hashes[None, :] + b[:, None]) % np.uint64(MINHASH_PRIME)).min(axis=1).astype(np.uint32)
+
+def compute_minhashes(texts: List[str],
+                      shingle_size: int = NOTE_DEDUP_SHINGLE_SIZE,
+                      n_permutations: int = NOTE_DEDUP_N_PERMUTATIONS) -> np.ndarray:
+    """MinHash signatures of `texts`, as a (len(texts), n_permutations) uint32 array"""
+    signatures: np.ndarray = np.zeros((len(texts), n_permutations), dtype=np.uint32)
+    for idx, text in enumerate(texts):
+        signatures[idx] = compute_minhash(text, shingle_size=shingle_size, n_permutations=n_permutations)
+    return signatures
+
+def get_note_signatures(notes: List[Note]) -> Dict[str, np.ndarray]:
+    """note_id => MinHash signature of each of `notes`"""
+    signatures: np.ndarray = compute_minhashes([ note.text for note in notes ])
+    return { note.note_id : signature for note, signature in zip(notes, signatures) }
+
+def normalize_for_matching(text: str) -> str:
+    """Lowercase + collapse whitespace, so that quotes still match across reformatted copies of the same text"""
+    return " ".join(text.lower().split())
+
+def hash_section(text: str) -> str:
+    return hashlib.sha1(normalize_for_matching(text).encode('utf-8')).hexdigest()
+
+@dataclass
+class NoteDedupPlan:
+    """How a patient's notes are collapsed before being sent to the LLM.
+
+    Each note either has its own unit (the note, minus any sections copied forward from a newer note),
+    or is a near-duplicate of a newer note and shares that note's unit. `note_idx_2_source_unit_idxs` lists
+    the other units whose evidence is attributed back to each note (if it contains the quoted text): the units
+    that its elided sections were copied from, or -- for a near-duplicate -- the newer note's unit (first,
+    which is also where its answer comes from) plus that note's sources.
+    """
+    units: List[Note]
+    note_idx_2_unit_idx: List[Optional[int]]
+    note_idx_2_source_unit_idxs: List[List[int]]
+    stats: Dict[str, Any]
+
+def elide_copied_sections(note: Note,
+                          unit_idx: int,
+                          section_hash_2_unit_idx: Dict[str, int],
+                          min_section_chars: int) -> Tuple[str, List[int], int]:
+    """Replace each section of `note` that is already in a unit with a placeholder, and register its other sections as being in `unit_idx`.
+        Returns (elided text, units that sections were elided in favor of, # of sections elided)."""
+    parts: List[str] = SECTION_SEPARATOR_REGEX.split(note.text)
+    source_unit_idxs: List[int] = []
+    n_elided: int = 0
+    # Even parts are sections, odd parts are the separators between them
+    for idx in range(0, len(parts), 2):
+        if len(parts[idx].strip()) < min_section_chars:
+            continue
+        section_hash: str = hash_section(parts[idx])
+        if section_hash in section_hash_2_unit_idx:
+            if section_hash_2_unit_idx[section_hash] not in source_unit_idxs:
+                source_unit_idxs.append(section_hash_2_unit_idx[section_hash])
+            parts[idx] = ELIDED_SECTION_PLACEHOLDER
+            n_elided += 1
+        else:
+            section_hash_2_unit_idx[section_hash] = unit_idx
+    return "".join(parts), source_unit_idxs, n_elided
+
+def plan_note_dedup(notes: List[Note],
+                    note_id_2_signature: Dict[str, np.ndarray],
+                    threshold: float = NOTE_DEDUP_THRESHOLD,
+                    min_section_chars: int = NOTE_DEDUP_MIN_SECTION_CHARS,
+                    model: str = DEFAULT_MODEL) -> NoteDedupPlan:
+    """Collapse near-duplicate notes and elide copied-forward sections. `notes` are processed in order
+        (i.e. newest first, for both databases), so the newest copy of any repeated text is the one that's kept."""
+    units: List[Note] = []
+    note_idx_2_unit_idx: List[Optional[int]] = []
+    note_idx_2_source_unit_idxs: List[List[int]] = []
+    # Signatures of the notes that have their own unit, and the index into `notes` of each
+    rep_signatures: List[np.ndarray] = []
+    rep_note_idxs: List[int] = []
+    section_hash_2_unit_idx: Dict[str, int] = {}
+    n_near_duplicates: int = 0
+    n_sections_elided: int = 0
+    for note_idx, note in enumerate(notes):
+        signature: Optional[np.ndarray] = note_id_2_signature.get(note.note_id)
+        if signature is not None and len(rep_signatures) > 0:
+            similarities: np.ndarray = (np.stack(rep_signatures) == signature).mean(axis=1)
+            best_idx: int = int(similarities.argmax())
+            if similarities[best_idx] >= threshold:
+                # Share the newer note's unit (and anything attributed to it)
+                rep_note_idx: int = rep_note_idxs[best_idx]
+                note_idx_2_unit_idx.append(None)
+                note_idx_2_source_unit_idxs.append([ note_idx_2_unit_idx[rep_note_idx], *note_idx_2_source_unit_idxs[rep_note_idx] ])
+                n_near_duplicates += 1
+                continue
+        text, source_unit_idxs, n_elided = elide_copied_sections(note, len(units), section_hash_2_unit_idx, min_section_chars)
+        n_sections_elided += n_elided
+        note_idx_2_unit_idx.append(len(units))
+        note_idx_2_source_unit_idxs.append(source_unit_idxs)
+        units.append(dataclasses.replace(note, text=text) if n_elided > 0 else note)
+        if signature is not None:
+            rep_signatures.append(signature)
+            rep_note_idxs.append(note_idx)
+
+    n_tokens: int = sum([ count_tokens(note.text, model=model) for note in notes ])
+    n_llm_tokens: int = sum([ count_tokens(unit.text, model=model) for unit in units ])
+    return NoteDedupPlan(
+        units=units,
+        note_idx_2_unit_idx=note_idx_2_unit_idx,
+        note_idx_2_source_unit_idxs=note_idx_2_source_unit_idxs,
+        stats={
+            'n_notes' : len(notes),
+            'n_llm_notes' : len(units),
+            'n_near_duplicates' : n_near_duplicates,
+            'n_sections_elided' : n_sections_elided,
+            'n_tokens' : n_tokens,
+            'n_llm_tokens' : n_llm_tokens,
+            'n_tokens_saved' : n_tokens - n_llm_tokens,
+            'note_dedup_ratio' : n_near_duplicates / max(1, len(notes)),
+            'token_dedup_ratio' : (n_tokens - n_llm_tokens) / max(1, n_tokens),
+        },
+    )
+
+def attribute_evidence(evidence: List[LLM_Evidence], note: Note) -> List[LLM_Evidence]:
+    """The parts of `evidence` (from another note's response) whose quotes appear in `note`, re-cited to `note`"""
+    text: str = normalize_for_matching(note.text)
+    attributed: List[LLM_Evidence] = []
+    for e in evidence:
+        quotes: List[LLM_Quote] = [ LLM_Quote(quote=q.quote, source=note.note_id) for q in e.quotes if normalize_for_matching(q.quote) in text ]
+        if len(quotes) > 0:
+            attributed.append(LLM_Evidence(claim=e.claim, quotes=quotes))
+    return attributed
+
+def get_deduped_note_response(plan: NoteDedupPlan,
+                              notes: List[Note],
+                              note_idx: int,
+                              unit_responses: List[LLM_ChatCompletionResponse]) -> LLM_ChatCompletionResponse:
+    """Response for `notes[note_idx]`, built from the responses to the units it depends on (see `NoteDedupPlan`)"""
+    note: Note = notes[note_idx]
+    unit_idx: Optional[int] = plan.note_idx_2_unit_idx[note_idx]
+    source_unit_idxs: List[int] = plan.note_idx_2_source_unit_idxs[note_idx]
+    attributed: List[LLM_Evidence] = []
+    for source_unit_idx in source_unit_idxs:
+        attributed += attribute_evidence(unit_responses[source_unit_idx].evidence, note)
+
+    if unit_idx is not None:
+        # The note was sent to the LLM (possibly minus some copied-forward sections) => add evidence from the sections that were elided
+        response: LLM_ChatCompletionResponse = unit_responses[unit_idx]
+        if len(attributed) == 0:
+            return response
+        seen_quotes: set = set([ q.quote for e in response.evidence for q in e.quotes ])
+        attributed = [ LLM_Evidence(claim=e.claim, quotes=[ q for q in e.quotes if q.quote not in seen_quotes ]) for e in attributed ]
+        attributed = [ e for e in attributed if len(e.quotes) > 0 ]
+        return response.model_copy(update={ 'is_relevant' : response.is_relevant or len(attributed) > 0, 'evidence' : [ *response.evidence, *attributed ] })
+
+    # Near-duplicate => same answer as the newer note, plus quoted evidence from any of its sources that this note actually contains
+    # (e.g. from a section that the newer note had elided as copied forward from yet another note)
+    primary: LLM_ChatCompletionResponse = unit_responses[source_unit_idxs[0]]
+    return primary.model_copy(update={
+        'is_relevant' : primary.is_relevant or len(attributed) > 0,
+        'evidence' : [ *attributed, *[ e for e in primary.evidence if len(e.quotes) == 0 ] ],
+    })
+
+def get_deduped_note_responses(plan: NoteDedupPlan, notes: List[Note], unit_responses: List[LLM_ChatCompletionResponse]) -> List[LLM_ChatCompletionResponse]:
+    """One response per note in `notes`, given one response per unit in `plan.units`"""
+    return [ get_deduped_note_response(plan, notes, note_idx, unit_responses) for note_idx in range(len(notes)) ]
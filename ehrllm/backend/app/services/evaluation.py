@@ -0,0 +1,230 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional, Set, Tuple
+from loguru import logger
+from tqdm import tqdm
+from ehrllm.backend.app.models import Note
+from ehrllm.backend.app.databases.n2c22018 import LABEL_2_DEFINITION, N2C22018CTMatchingDatabase, Patient
+from ehrllm.backend.app.services.chat import aggregate_responses, run_queries_over_notes, run_query_over_notes
+from ehrllm.llms.models import LLM_ChatCompletionResponse, LLM_CriterionAggregateChatCompletionResponse
+from ehrllm.llms.prompts import CRITERION_QUERY_PROMPT
+from ehrllm.llms.retry import get_retry_scheduler
+from ehrllm.llms.usage import get_usage_tracker
+from ehrllm.llms.utils import DEFAULT_MODEL, run_in_parallel
+
+########################################################
+# Batch evaluation of every (patient, criterion) pair in n2c2 2018 against the gold labels
+########################################################
+
+CHECKPOINT_FILENAME: str = "predictions.jsonl"
+RESULTS_FILENAME: str = "results.json"
+
+class Checkpoint:
+    """Append-only JSONL file of completed (patient, criterion) predictions, so that a crashed run can resume"""
+
+    def __init__(self, path_to_file: str):
+        self.path_to_file = path_to_file
+        self._lock = threading.Lock()
+
+    def load(self) -> List[Dict[str, Any]]:
+        """All predictions written so far (ignoring a partially written last line from a crash)"""
+        if not os.path.exists(self.path_to_file):
+            return []
+        predictions: List[Dict[str, Any]] = []
+        with open(self.path_to_file, 'r') as f:
+            for line in f:
+                try:
+                    predictions.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logger.warning(f"Checkpoint.load() -- skipping unreadable line in {self.path_to_file}")
+        return predictions
+
+    def append(self, prediction: Dict[str, Any]) -> None:
+        with self._lock:
+            with open(self.path_to_file, 'a') as f:
+                f.write(json.dumps(prediction) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+def aggregate_criterion(patient: Patient, notes: List[Note], criterion: str, note_responses: List[LLM_ChatCompletionResponse], **kwargs) -> Optional[Dict[str, Any]]:
+    """Aggregate one criterion's note-level responses into a prediction for `patient`. Returns None on failure."""
+    messages: List[Dict[str, Any]] = [ { 'role' : 'user', 'content' : CRITERION_QUERY_PROMPT(criterion, LABEL_2_DEFINITION[criterion]) } ]
+    response: Optional[LLM_CriterionAggregateChatCompletionResponse] = aggregate_responses(messages,
+                                                                                           note_responses,
+                                                                                           response_format=LLM_CriterionAggregateChatCompletionResponse,
+                                                                                           **kwargs)
+    if response is None:
+        return None
+    labels: Dict[str, bool] = { label.name : label.is_met for label in patient.labels }
+    return {
+        'patient_id' : patient.id,
+        'criterion' : criterion,
+        'is_met' : response.is_met,
+        'is_met_gold' : labels.get(criterion),
+        'answer' : response.answer,
+        'n_notes' : len(notes),
+        'n_relevant_notes' : sum([ r.is_relevant for r in note_responses ]),
+    }
+
+def evaluate_patient_criteria(patient: Patient, notes: List[Note], criteria: List[str], is_single_pass: bool = False, **kwargs) -> List[Optional[Dict[str, Any]]]:
+    """Run `criteria` over one patient's notes through the chat pipeline. Returns one prediction per criterion (None on failure).
+
+    If `is_single_pass`, each note is read once for all criteria (see `run_queries_over_notes()`) and only
+    aggregation is done per criterion. Otherwise, each criterion is run over every note separately."""
+    start_time = time.time()
+    queries: List[str] = [ CRITERION_QUERY_PROMPT(criterion, LABEL_2_DEFINITION[criterion]) for criterion in criteria ]
+    if is_single_pass:
+        criterion_note_responses: Optional[List[List[LLM_ChatCompletionResponse]]] = run_queries_over_notes([], queries, notes, **kwargs)
+    else:
+        criterion_note_responses = [ run_query_over_notes([ { 'role' : 'user', 'content' : query } ], notes, **kwargs) for query in queries ]
+    if criterion_note_responses is None:
+        return [ None ] * len(criteria)
+
+    predictions: List[Optional[Dict[str, Any]]] = run_in_parallel(lambda criterion, note_responses: aggregate_criterion(patient, notes, criterion, note_responses, **kwargs) if note_responses is not None else None,
+                                                                  list(zip(criteria, criterion_note_responses)),
+                                                                  max_workers=len(criteria),
+                                                                  pool_strat='thread',
+                                                                  merge_strat='append')
+    for prediction in predictions:
+        if prediction is not None:
+            prediction['elapsed_seconds'] = time.time() - start_time
+            prediction['is_single_pass'] = is_single_pass
+    return predictions
+
+def compute_metrics(predictions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Accuracy / precision / recall / F1 per criterion, plus micro- and macro-averaged F1 across criteria"""
+    def get_scores(preds: List[Dict[str, Any]]) -> Dict[str, Any]:
+        tp: int = sum([ p['is_met'] and p['is_met_gold'] for p in preds ])
+        fp: int = sum([ p['is_met'] and not p['is_met_gold'] for p in preds ])
+        fn: int = sum([ not p['is_met'] and p['is_met_gold'] for p in preds ])
+        precision: float = tp / (tp + fp) if tp + fp > 0 else 0.0
+        recall: float = tp / (tp + fn) if tp + fn > 0 else 0.0
+        return {
+            'n' : len(preds),
+            'accuracy' : sum([ p['is_met'] == p['is_met_gold'] for p in preds ]) / max(1, len(preds)),
+            'precision' : precision,
+            'recall' : recall,
+            'f1' : 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0,
+        }
+    predictions = [ p for p in predictions if p['is_met_gold'] is not None ]
+    criterion_2_scores: Dict[str, Dict[str, Any]] = {
+        criterion : get_scores([ p for p in predictions if p['criterion'] == criterion ])
+        for criterion in sorted(set([ p['criterion'] for p in predictions ]))
+    }
+    return {
+        'overall' : {
+            **get_scores(predictions),
+            'macro_f1' : sum([ s['f1'] for s in criterion_2_scores.values() ]) / max(1, len(criterion_2_scores)),
+        },
+        'per_criterion' : criterion_2_scores,
+    }
+
+def run_evaluation(output_dir: str,
+                   criteria: Optional[List[str]] = None,
+                   patient_ids: Optional[List[str]] = None,
+                   n_workers: int = 8,
+                   is_single_pass: bool = False,
+                   model: str = DEFAULT_MODEL,
+                   **kwargs) -> Dict[str, Any]:
+    """Evaluate every criterion x patient, resuming from the checkpoint in `output_dir` if one exists.
+
+    (Patient, criterion) pairs run concurrently on `n_workers` threads, but all of their LLM calls
+    share the process-wide concurrency / rate limits (see `LLM_MAX_CONCURRENCY`), so `n_workers` only
+    needs to be large enough to keep that budget saturated. Each patient's notes are loaded once and
+    shared by all of its criteria. Failed pairs aren't checkpointed, so they are retried on resume.
+    
+    If `is_single_pass`, each patient is one task that reads each note once for all of its criteria
+    (roughly dividing input tokens by the # of criteria), instead of one task per (patient, criterion).
+
+    Returns:
+        Dict[str, Any]: Metrics vs. the gold labels, plus throughput / token / cost stats for this run.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    db: N2C22018CTMatchingDatabase = N2C22018CTMatchingDatabase.instance()
+    criteria = criteria or list(LABEL_2_DEFINITION.keys())
+    patient_ids = patient_ids or list(db.patients.keys())
+
+    # Skip pairs that were already completed by a previous run
+    checkpoint = Checkpoint(os.path.join(output_dir, CHECKPOINT_FILENAME))
+    patient_id_set, criterion_set = set(patient_ids), set(criteria)
+    predictions: List[Dict[str, Any]] = [ p for p in checkpoint.load() if p['patient_id'] in patient_id_set and p['criterion'] in criterion_set ]
+    done: Set[Tuple[str, str]] = set([ (p['patient_id'], p['criterion']) for p in predictions ])
+    tasks: List[Tuple[str, str]] = [ (patient_id, criterion) for patient_id in patient_ids for criterion in criteria if (patient_id, criterion) not in done ]
+    logger.info(f"run_evaluation() -- {len(done)} pairs already done, {len(tasks)} remaining ({len(patient_ids)} patients x {len(criteria)} criteria)")
+
+    # Load each patient's notes once
+    patient_id_2_notes: Dict[str, List[Note]] = { patient_id : db.get_patient_notes(patient_id) for patient_id in set([ patient_id for patient_id, _ in tasks ]) }
+
+    usage_start: Dict[str, Any] = get_usage_tracker().get_totals()
+    model_2_usage_start: Dict[str, Dict[str, Any]] = get_usage_tracker().get_stats()
+    retries_start: Dict[str, Any] = get_retry_scheduler().get_stats()
+    start_time = time.time()
+    n_failed: int = 0
+    n_notes_processed: int = 0
+    # One task per (patient, criterion), or per patient (covering all of its remaining criteria) if `is_single_pass`
+    if is_single_pass:
+        patient_id_2_criteria: Dict[str, List[str]] = {}
+        for patient_id, criterion in tasks:
+            patient_id_2_criteria.setdefault(patient_id, []).append(criterion)
+        task_groups: List[Tuple[str, List[str]]] = list(patient_id_2_criteria.items())
+    else:
+        task_groups: List[Tuple[str, List[str]]] = [ (patient_id, [ criterion ]) for patient_id, criterion in tasks ]
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        futures = {
+            executor.submit(evaluate_patient_criteria, db.get_patient(patient_id), patient_id_2_notes[patient_id], task_criteria, is_single_pass=is_single_pass, model=model, **kwargs) : (patient_id, task_criteria)
+            for patient_id, task_criteria in task_groups
+        }
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Evaluating"):
+            patient_id, task_criteria = futures[future]
+            try:
+                task_predictions: List[Optional[Dict[str, Any]]] = future.result()
+            except Exception as e:
+                logger.error(f"run_evaluation() -- error on patient {patient_id} / {task_criteria}: {e}")
+                task_predictions = [ None ] * len(task_criteria)
+            for prediction in task_predictions:
+                if prediction is None:
+                    n_failed += 1
+                    continue
+                checkpoint.append(prediction)
+                predictions.append(prediction)
+                n_notes_processed += prediction['n_notes']
+    elapsed_seconds: float = time.time() - start_time
+
+    usage_end: Dict[str, Any] = get_usage_tracker().get_totals()
+    retries_end: Dict[str, Any] = get_retry_scheduler().get_stats()
+    # Models that were actually called, so that usage / cost is never silently attributed to the wrong model
+    model_2_n_calls: Dict[str, int] = { 
+        m : stats['n_calls'] - model_2_usage_start.get(m, {}).get('n_calls', 0) 
+        for m, stats in get_usage_tracker().get_stats().items() 
+    }
+    model_2_n_calls = { m : n for m, n in model_2_n_calls.items() if n > 0 }
+    if any([ m != model for m in model_2_n_calls ]):
+        logger.warning(f"run_evaluation() -- requested model '{model}', but LLM calls were made to {model_2_n_calls}")
+    n_completed: int = len(tasks) - n_failed
+    results: Dict[str, Any] = {
+        'model' : model,
+        'is_single_pass' : is_single_pass,
+        'metrics' : compute_metrics(predictions),
+        'run' : {
+            'n_pairs' : len(patient_ids) * len(criteria),
+            'n_resumed' : len(done),
+            'n_completed' : n_completed,
+            'n_failed' : n_failed,
+            'elapsed_seconds' : elapsed_seconds,
+            'pairs_per_second' : n_completed / elapsed_seconds if elapsed_seconds > 0 else 0.0,
+            'notes_per_second' : n_notes_processed / elapsed_seconds if elapsed_seconds > 0 else 0.0,
+            'n_llm_calls' : usage_end['n_calls'] - usage_start['n_calls'],
+            'n_llm_calls_by_model' : model_2_n_calls,
+            'prompt_tokens' : usage_end['prompt_tokens'] - usage_start['prompt_tokens'],
+            'completion_tokens' : usage_end['completion_tokens'] - usage_start['completion_tokens'],
+            'cached_prompt_tokens' : usage_end['cached_prompt_tokens'] - usage_start['cached_prompt_tokens'],
+            'cost_usd' : usage_end['cost_usd'] - usage_start['cost_usd'],
+            'n_llm_retries' : sum(retries_end['n_retries'].values()) - sum(retries_start['n_retries'].values()),
+        },
+    }
+    with open(os.path.join(output_dir, RESULTS_FILENAME), 'w') as f:
+        json.dump(results, f, indent=2)
+    return results
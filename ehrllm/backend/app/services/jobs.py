@@ -0,0 +1,366 @@
+import os
+import json
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from loguru import logger
+from ehrllm.backend.app.config import (
+    JOB_LEASE_SECONDS,
+    JOB_MAX_ATTEMPTS,
+    JOB_N_WORKERS,
+    PATH_TO_JOBS_DB,
+    PATH_TO_TRACE_FILE,
+)
+from ehrllm.telemetry import Trace
+
+########################################################
+# Durable background job queue (SQLite) for chart reviews that are too long to run inside one HTTP request
+########################################################
+
+JOB_STATUS_QUEUED: str = 'queued'
+JOB_STATUS_RUNNING: str = 'running'
+JOB_STATUS_SUCCEEDED: str = 'succeeded'
+JOB_STATUS_FAILED: str = 'failed'
+JOB_STATUS_CANCELLED: str = 'cancelled'
+JOB_STATUSES: List[str] = [ JOB_STATUS_QUEUED, JOB_STATUS_RUNNING, JOB_STATUS_SUCCEEDED, JOB_STATUS_FAILED, JOB_STATUS_CANCELLED ]
+# Jobs in these states never change again
+TERMINAL_JOB_STATUSES: List[str] = [ JOB_STATUS_SUCCEEDED, JOB_STATUS_FAILED, JOB_STATUS_CANCELLED ]
+# Most jobs `list_jobs()` can return at once
+MAX_JOBS_LIST_LIMIT: int = 1000
+
+class JobCancelledError(Exception):
+    pass
+
+@dataclass
+class Job:
+    job_id: str
+    status: str
+    request: Dict[str, Any] # Same body as a POST /api/chat request
+    result: Optional[Dict[str, Any]] = None # Same payload as the `data` field of a /api/chat response
+    error: Optional[str] = None
+    is_cancel_requested: bool = False
+    n_notes: Optional[int] = None # None until the job's notes are loaded
+    n_completed: int = 0 # Notes with a saved note-level response (including ones from earlier attempts)
+    n_attempts: int = 0
+    worker_id: Optional[str] = None
+    created_at: float = 0.0
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    heartbeat_at: Optional[float] = None
+
+    def is_finished(self) -> bool:
+        return self.status in TERMINAL_JOB_STATUSES
+
+    def to_dict(self, is_include_result: bool = True) -> Dict[str, Any]:
+        job: Dict[str, Any] = asdict(self)
+        del job['request']
+        if not is_include_result:
+            del job['result']
+        job['patient_id'] = self.request.get('patientId')
+        job['database'] = (self.request.get('settings') or {}).get('database')
+        return job
+
+class JobRun:
+    """Handle passed to a job's runner, through which it saves progress and checks for cancellation"""
+
+    def __init__(self, queue: 'JobQueue', job: Job):
+        self.queue = queue
+        self.job = job
+        self._pending_writes: List[Future] = []
+
+    def get_note_responses(self) -> Dict[str, Dict[str, Any]]:
+        """note_id => note-level response saved by this or an earlier attempt at the job"""
+        return self.queue.get_note_responses(self.job.job_id)
+
+    def save_note_response(self, note_id: str, response: Dict[str, Any]) -> None:
+        """Returns right away: the write (a SQLite commit) runs on the queue's writer thread, so this is safe to call
+            from the event loop that LLM calls run on. Call `flush()` to wait for it."""
+        self._pending_writes.append(self.queue.save_note_response_in_background(self.job.job_id, note_id, response))
+
+    def flush(self) -> None:
+        """Wait until every note-level response passed to `save_note_response()` is saved (re-raising the first failed write)"""
+        pending_writes, self._pending_writes = self._pending_writes, []
+        for future in pending_writes:
+            future.result()
+
+    def set_n_notes(self, n_notes: int) -> None:
+        self.queue.set_n_notes(self.job.job_id, n_notes)
+
+    def check_cancelled(self) -> None:
+        """Raise a JobCancelledError if the job has been cancelled"""
+        if self.queue.is_cancel_requested(self.job.job_id):
+            raise JobCancelledError(f"Job {self.job.job_id} was cancelled")
+
+# Runs a job, returning its result (or raising an Exception if it failed)
+JobRunner = Callable[[JobRun], Dict[str, Any]]
+
+class JobQueue:
+    """Jobs + their saved note-level responses in a single SQLite file (WAL mode), safe to share across threads and processes.
+
+    Every process that calls `start()` runs a pool of `n_workers` threads that claim queued jobs, so many patients'
+    reviews run at once -- and since they share the process-wide LLM execution engine, all of their LLM calls stay
+    within one global concurrency limit. Each note-level response is saved as soon as it arrives.
+
+    Running jobs are kept alive with a heartbeat. If a process dies (or is restarted), its jobs' heartbeats go stale,
+    and after `lease_seconds` they are claimed again by any worker, which skips the notes that already have a saved response.
+    """
+    # Columns of `jobs`, in the order that `_row_to_job()` expects
+    _JOB_COLUMNS: str = "job_id, status, request, result, error, is_cancel_requested, n_notes, n_attempts, worker_id, created_at, started_at, finished_at, heartbeat_at"
+
+    def __init__(self, path_to_db: str, n_workers: int = 4, lease_seconds: float = 60, max_attempts: int = 3, poll_interval_seconds: float = 1.0):
+        self.path_to_db = path_to_db
+        self.n_workers = n_workers
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval_seconds = poll_interval_seconds
+        # Identifies this process's workers in the `jobs` table
+        self.worker_id: str = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        os.makedirs(os.path.dirname(self.path_to_db), exist_ok=True)
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='job-writer')
+        self._conn = sqlite3.connect(self.path_to_db, timeout=30, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    request TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    is_cancel_requested INTEGER NOT NULL DEFAULT 0,
+                    n_notes INTEGER,
+                    n_attempts INTEGER NOT NULL DEFAULT 0,
+                    worker_id TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    heartbeat_at REAL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created_at ON jobs (status, created_at)")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS job_note_responses (
+                    job_id TEXT NOT NULL,
+                    note_id TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (job_id, note_id)
+                )
+            """)
+        # IDs of the jobs this process is running
+        self._running_job_ids: set = set()
+        self._is_started: bool = False
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def _row_to_job(self, row: Tuple, n_completed: int) -> Job:
+        return Job(job_id=row[0],
+                   status=row[1],
+                   request=json.loads(row[2]),
+                   result=json.loads(row[3]) if row[3] is not None else None,
+                   error=row[4],
+                   is_cancel_requested=bool(row[5]),
+                   n_notes=row[6],
+                   n_completed=n_completed,
+                   n_attempts=row[7],
+                   worker_id=row[8],
+                   created_at=row[9],
+                   started_at=row[10],
+                   finished_at=row[11],
+                   heartbeat_at=row[12])
+
+    ########################################################
+    # API
+    ########################################################
+
+    def submit(self, request: Dict[str, Any]) -> Job:
+        job_id: str = uuid.uuid4().hex
+        with self._lock:
+            self._conn.execute("INSERT INTO jobs (job_id, status, request, created_at) VALUES (?, ?, ?, ?)", (job_id, JOB_STATUS_QUEUED, json.dumps(request), time.time()))
+        self._wake_event.set()
+        logger.info(f"JobQueue.submit() -- queued job {job_id}")
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            row = self._conn.execute(f"SELECT {self._JOB_COLUMNS} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            n_completed: int = self._conn.execute("SELECT COUNT(*) FROM job_note_responses WHERE job_id = ?", (job_id,)).fetchone()[0]
+        return self._row_to_job(row, n_completed)
+
+    def list_jobs(self, status: Optional[str] = None, limit: int = 50) -> List[Job]:
+        """Most recently submitted jobs first"""
+        with self._lock:
+            rows = self._conn.execute(f"""
+                SELECT {self._JOB_COLUMNS}, (SELECT COUNT(*) FROM job_note_responses r WHERE r.job_id = jobs.job_id)
+                FROM jobs WHERE ? IS NULL OR status = ? ORDER BY created_at DESC LIMIT ?
+            """, (status, status, limit)).fetchall()
+        return [ self._row_to_job(row, row[-1]) for row in rows ]
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """Queued jobs are cancelled immediately. Running jobs stop at their next cancellation check (see `JobRun.check_cancelled()`)."""
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET is_cancel_requested = 1 WHERE job_id = ? AND status NOT IN (?, ?, ?)", (job_id, *TERMINAL_JOB_STATUSES))
+            self._conn.execute("UPDATE jobs SET status = ?, finished_at = ? WHERE job_id = ? AND status = ?", (JOB_STATUS_CANCELLED, time.time(), job_id, JOB_STATUS_QUEUED))
+        return self.get(job_id)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+            n_running_here: int = len(self._running_job_ids)
+        status_2_n_jobs: Dict[str, int] = { status : 0 for status in JOB_STATUSES }
+        status_2_n_jobs.update(dict(rows))
+        return { 'n_jobs_by_status' : status_2_n_jobs, 'n_running_in_process' : n_running_here, 'n_workers' : self.n_workers if self._is_started else 0 }
+
+    ########################################################
+    # Progress (called by job runners via `JobRun`)
+    ########################################################
+
+    def get_note_responses(self, job_id: str) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT note_id, response FROM job_note_responses WHERE job_id = ?", (job_id,)).fetchall()
+        return { note_id : json.loads(response) for note_id, response in rows }
+
+    def save_note_response(self, job_id: str, note_id: str, response: Dict[str, Any]) -> None:
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO job_note_responses (job_id, note_id, response, created_at) VALUES (?, ?, ?, ?)", (job_id, note_id, json.dumps(response), time.time()))
+
+    def save_note_response_in_background(self, job_id: str, note_id: str, response: Dict[str, Any]) -> Future:
+        """Same as `save_note_response()`, but on a single background writer thread"""
+        return self._writer.submit(self.save_note_response, job_id, note_id, response)
+
+    def set_n_notes(self, job_id: str, n_notes: int) -> None:
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET n_notes = ? WHERE job_id = ?", (n_notes, job_id))
+
+    def is_cancel_requested(self, job_id: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT is_cancel_requested FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row is not None and bool(row[0])
+
+    ########################################################
+    # Workers
+    ########################################################
+
+    def start(self, runner: JobRunner) -> None:
+        """Start this process's worker threads (+ heartbeat thread), which run claimed jobs with `runner`. Idempotent."""
+        with self._lock:
+            if self._is_started or self.n_workers <= 0:
+                return
+            self._is_started = True
+        for idx in range(self.n_workers):
+            self._threads.append(threading.Thread(target=self._work, args=(runner,), daemon=True, name=f"job-worker-{idx}"))
+        self._threads.append(threading.Thread(target=self._heartbeat, daemon=True, name="job-heartbeat"))
+        for thread in self._threads:
+            thread.start()
+        logger.info(f"JobQueue.start() -- started {self.n_workers} job workers ({self.worker_id})")
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._wake_event.set()
+        for thread in self._threads:
+            thread.join()
+
+    def _claim(self) -> Optional[Job]:
+        """Atomically claim the oldest queued job, or a running job whose heartbeat has gone stale"""
+        now: float = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Stale jobs that have used up their attempts are given up on
+                self._conn.execute("""
+                    UPDATE jobs SET status = ?, error = ?, finished_at = ?
+                    WHERE status = ? AND heartbeat_at < ? AND n_attempts >= ?
+                """, (JOB_STATUS_FAILED, f"Abandoned after {self.max_attempts} attempts", now, JOB_STATUS_RUNNING, now - self.lease_seconds, self.max_attempts))
+                row = self._conn.execute("""
+                    SELECT job_id FROM jobs
+                    WHERE is_cancel_requested = 0 AND (status = ? OR (status = ? AND heartbeat_at < ?))
+                    ORDER BY created_at LIMIT 1
+                """, (JOB_STATUS_QUEUED, JOB_STATUS_RUNNING, now - self.lease_seconds)).fetchone()
+                if row is None:
+                    # Stale jobs that were cancelled while their process was down
+                    self._conn.execute("""
+                        UPDATE jobs SET status = ?, finished_at = ? WHERE status = ? AND heartbeat_at < ? AND is_cancel_requested = 1
+                    """, (JOB_STATUS_CANCELLED, now, JOB_STATUS_RUNNING, now - self.lease_seconds))
+                    self._conn.execute("COMMIT")
+                    return None
+                job_id: str = row[0]
+                self._conn.execute("""
+                    UPDATE jobs SET status = ?, worker_id = ?, n_attempts = n_attempts + 1, started_at = COALESCE(started_at, ?), heartbeat_at = ?
+                    WHERE job_id = ?
+                """, (JOB_STATUS_RUNNING, self.worker_id, now, now, job_id))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._running_job_ids.add(job_id)
+        return self.get(job_id)
+
+    def _finish(self, job_id: str, status: str, result: Optional[Dict[str, Any]] = None, error: Optional[str] = None) -> None:
+        with self._lock:
+            # Only if this process still owns the job (another worker may have claimed it after a stalled heartbeat)
+            self._conn.execute("""
+                UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE job_id = ? AND worker_id = ? AND status = ?
+            """, (status, json.dumps(result, default=str) if result is not None else None, error, time.time(), job_id, self.worker_id, JOB_STATUS_RUNNING))
+            self._running_job_ids.discard(job_id)
+
+    def _run(self, runner: JobRunner, job: Job) -> None:
+        logger.info(f"JobQueue._run() -- running job {job.job_id} (attempt {job.n_attempts})")
+        with Trace('job', path_to_trace_file=PATH_TO_TRACE_FILE, job_id=job.job_id, patient_id=job.request.get('patientId'), database=(job.request.get('settings') or {}).get('database')) as trace:
+            run = JobRun(self, job)
+            try:
+                try:
+                    result: Dict[str, Any] = runner(run)
+                finally:
+                    # Whatever the outcome, keep every note-level response the runner got (so that a retry can resume from them)
+                    run.flush()
+                self._finish(job.job_id, JOB_STATUS_SUCCEEDED, result=result)
+                trace.attributes['status'] = JOB_STATUS_SUCCEEDED
+            except JobCancelledError:
+                self._finish(job.job_id, JOB_STATUS_CANCELLED)
+                trace.attributes['status'] = JOB_STATUS_CANCELLED
+            except Exception as e:
+                logger.error(f"JobQueue._run() -- job {job.job_id} failed: {e}")
+                self._finish(job.job_id, JOB_STATUS_FAILED, error=str(e))
+                trace.attributes['status'] = JOB_STATUS_FAILED
+        logger.info(f"JobQueue._run() -- job {job.job_id} {trace.attributes['status']} in {trace.duration_seconds:.2f}s")
+
+    def _work(self, runner: JobRunner) -> None:
+        while not self._stop_event.is_set():
+            try:
+                job: Optional[Job] = self._claim()
+            except Exception as e:
+                logger.error(f"JobQueue._work() -- failed to claim a job: {e}")
+                job = None
+            if job is None:
+                # Sleep until a job is submitted (to this process) or it's time to poll again (for other processes' jobs / stale jobs)
+                self._wake_event.wait(self.poll_interval_seconds)
+                self._wake_event.clear()
+                continue
+            self._run(runner, job)
+
+    def _heartbeat(self) -> None:
+        while not self._stop_event.wait(self.lease_seconds / 4):
+            with self._lock:
+                job_ids: List[str] = list(self._running_job_ids)
+                for job_id in job_ids:
+                    self._conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE job_id = ? AND worker_id = ?", (time.time(), job_id, self.worker_id))
+
+_job_queue: Optional[JobQueue] = None
+_job_queue_lock = threading.Lock()
+
+def get_job_queue() -> JobQueue:
+    """Process-wide job queue backed by `PATH_TO_JOBS_DB`"""
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue(PATH_TO_JOBS_DB, n_workers=JOB_N_WORKERS, lease_seconds=JOB_LEASE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS)
+    return _job_queue
@@ -0,0 +1,99 @@
+from typing import Any, Dict, Optional
+from ehrllm.inflight import get_all_inflight_deduplicators
+from ehrllm.llms.cache import BaseLLMCache, get_llm_cache
+from ehrllm.llms.retry import get_retry_scheduler
+from ehrllm.llms.usage import get_usage_tracker
+from ehrllm.backend.app.services.conversations import get_conversation_store
+from ehrllm.backend.app.services.jobs import get_job_queue
+from ehrllm.backend.app.services.response_cache import get_response_cache
+from ehrllm.telemetry import format_prometheus_metric, get_metrics_registry
+
+########################################################
+# Prometheus exposition of all backend metrics (for /api/metrics)
+########################################################
+
+def render_llm_usage_metrics() -> str:
+    """Per-model token / cost counters"""
+    model_2_stats: Dict[str, Dict[str, Any]] = get_usage_tracker().get_stats()
+    return "".join([
+        format_prometheus_metric(name, 'counter', help, [ ({ 'model' : model }, stats[field]) for model, stats in sorted(model_2_stats.items()) ])
+        for field, name, help in [
+            ('n_calls', 'ehrllm_llm_responses_total', "LLM provider calls that returned a response"),
+            ('prompt_tokens', 'ehrllm_llm_prompt_tokens_total', "Prompt tokens sent to the LLM provider"),
+            ('completion_tokens', 'ehrllm_llm_completion_tokens_total', "Completion tokens returned by the LLM provider"),
+            ('cached_prompt_tokens', 'ehrllm_llm_cached_prompt_tokens_total', "Prompt tokens read from the LLM provider's prompt cache"),
+            ('cost_usd', 'ehrllm_llm_cost_usd_total', "Estimated LLM provider cost in USD"),
+        ]
+    ])
+
+def render_llm_retry_metrics() -> str:
+    """Retry / failure counters, by error class"""
+    stats: Dict[str, Any] = get_retry_scheduler().get_stats()
+    return "".join([
+        format_prometheus_metric('ehrllm_llm_attempts_total', 'counter', "LLM provider calls attempted (incl. retries)", [ ({}, stats['n_calls']) ]),
+        format_prometheus_metric('ehrllm_llm_retries_total', 'counter', "LLM calls retried, by error class", [ ({ 'error_class' : k }, v) for k, v in sorted(stats['n_retries'].items()) ]),
+        format_prometheus_metric('ehrllm_llm_failures_total', 'counter', "LLM calls that failed after all retries, by error class", [ ({ 'error_class' : k }, v) for k, v in sorted(stats['n_failures'].items()) ]),
+        format_prometheus_metric('ehrllm_llm_json_repairs_total', 'counter', "Unparseable LLM responses fixed locally", [ ({}, stats['n_json_repairs']) ]),
+        format_prometheus_metric('ehrllm_llm_global_backoffs_total', 'counter', "Rate limits that paused all LLM calls", [ ({}, stats['n_global_backoffs']) ]),
+        format_prometheus_metric('ehrllm_llm_backoff_wait_seconds_total', 'counter', "Time spent waiting to retry LLM calls", [ ({}, stats['wait_seconds']) ]),
+    ])
+
+def render_llm_cache_metrics() -> str:
+    """LLM response cache hit / miss counters"""
+    cache: Optional[BaseLLMCache] = get_llm_cache()
+    if cache is None:
+        return ""
+    stats: Dict[str, Any] = cache.get_stats()
+    return "".join([
+        format_prometheus_metric(f"ehrllm_llm_cache_{field}_total", 'counter', f"LLM response cache {field}", [ ({ 'backend' : cache.name }, stats[field]) ])
+        for field in [ 'hits', 'misses', 'writes', 'evictions' ]
+    ])
+
+def render_response_cache_metrics() -> str:
+    """/chat response cache hit / miss / coalescing counters"""
+    stats: Dict[str, Any] = get_response_cache().get_stats()
+    return "".join([
+        format_prometheus_metric('ehrllm_response_cache_lookups_total', 'counter', "/chat response cache lookups, by result", [ ({ 'result' : field }, stats[field]) for field in [ 'memory_hits', 'disk_hits', 'misses' ] ]),
+        format_prometheus_metric('ehrllm_response_cache_coalesced_total', 'counter', "/chat requests that waited on an identical in-flight request", [ ({}, stats['coalesced']) ]),
+        format_prometheus_metric('ehrllm_response_cache_writes_total', 'counter', "/chat responses written to the response cache", [ ({}, stats['writes']) ]),
+        format_prometheus_metric('ehrllm_response_cache_memory_entries', 'gauge', "/chat responses held in memory", [ ({}, stats['memory_n_entries']) ]),
+    ])
+
+def render_conversation_metrics() -> str:
+    """Follow-up turns, by how much of the previous turn's per-note responses they reused"""
+    stats: Dict[str, Any] = get_conversation_store().get_stats()
+    return "".join([
+        format_prometheus_metric('ehrllm_conversation_lookups_total', 'counter', "Lookups of a follow-up's previous turn, by result", [ ({ 'result' : field }, stats[field]) for field in [ 'hits', 'misses' ] ]),
+        format_prometheus_metric('ehrllm_conversation_follow_ups_total', 'counter', "Follow-up turns, by scope (evidence | relevant_notes | all_notes)", [ ({ 'scope' : scope }, n) for scope, n in sorted(stats['n_follow_ups_by_scope'].items()) ]),
+        format_prometheus_metric('ehrllm_conversation_turns', 'gauge', "Conversation turns held in memory", [ ({}, stats['n_entries']) ]),
+    ])
+
+def render_job_metrics() -> str:
+    """Background jobs by status"""
+    stats: Dict[str, Any] = get_job_queue().get_stats()
+    return "".join([
+        format_prometheus_metric('ehrllm_jobs', 'gauge', "Background jobs in the job queue, by status", [ ({ 'status' : status }, n) for status, n in stats['n_jobs_by_status'].items() ]),
+        format_prometheus_metric('ehrllm_jobs_running_in_process', 'gauge', "Jobs this process is running", [ ({}, stats['n_running_in_process']) ]),
+    ])
+
+def render_inflight_metrics() -> str:
+    """In-flight deduplication counters (identical concurrent LLM calls / patient loads that were joined)"""
+    name_2_stats: Dict[str, Dict[str, Any]] = { name : deduplicator.get_stats() for name, deduplicator in sorted(get_all_inflight_deduplicators().items()) }
+    return "".join([
+        format_prometheus_metric('ehrllm_inflight_calls_total', 'counter', "Deduplicated calls that ran, by kind of call", [ ({ 'name' : name }, stats['n_calls']) for name, stats in name_2_stats.items() ]),
+        format_prometheus_metric('ehrllm_inflight_shared_total', 'counter', "Calls that joined an identical in-flight call instead of running, by kind of call", [ ({ 'name' : name }, stats['n_shared']) for name, stats in name_2_stats.items() ]),
+        format_prometheus_metric('ehrllm_inflight_calls', 'gauge', "Deduplicated calls currently running, by kind of call", [ ({ 'name' : name }, stats['n_in_flight']) for name, stats in name_2_stats.items() ]),
+    ])
+
+def render_metrics() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    return "".join([
+        get_metrics_registry().render_prometheus(),
+        render_llm_usage_metrics(),
+        render_llm_retry_metrics(),
+        render_llm_cache_metrics(),
+        render_response_cache_metrics(),
+        render_conversation_metrics(),
+        render_job_metrics(),
+        render_inflight_metrics(),
+    ])
@@ -0,0 +1,139 @@
+import math
+import re
+from collections import Counter
+from typing import Any, Dict, List, Tuple
+from ehrllm.backend.app.models import Note
+from ehrllm.backend.app.config import PREFILTER_RECALL, PREFILTER_TOP_K
+
+########################################################
+# Cheap lexical (BM25) pre-filter that prunes notes before they are sent to the LLM
+########################################################
+
+TOKEN_REGEX = re.compile(r'[a-z0-9]+')
+
+STOPWORDS = set([
+    'a', 'an', 'and', 'any', 'are', 'as', 'at', 'be', 'been', 'by', 'did', 'do', 'does', 'for', 'from', 'had', 'has', 'have',
+    'he', 'her', 'his', 'if', 'in', 'is', 'it', 'its', 'me', 'of', 'on', 'or', 'she', 'that', 'the', 'their', 'there', 'they',
+    'this', 'to', 'was', 'were', 'what', 'when', 'which', 'who', 'with', 'patient', 'pt', 'please', 'tell', 'show', 'evidence',
+])
+
+# Clinical abbreviations / synonyms used to expand queries, so that e.g. "history of MI" also matches "myocardial infarction"
+SYNONYMS: List[List[str]] = [
+    [ 'mi', 'myocardial infarction', 'heart attack', 'stemi', 'nstemi' ],
+    [ 'cad', 'coronary artery disease', 'ischemic heart disease' ],
+    [ 'chf', 'hf', 'heart failure', 'congestive heart failure' ],
+    [ 'htn', 'hypertension', 'high blood pressure' ],
+    [ 'dm', 'diabetes', 'diabetic', 'dm2', 't2dm', 'iddm', 'niddm' ],
+    [ 'hba1c', 'a1c', 'hemoglobin a1c' ],
+    [ 'dka', 'ketoacidosis' ],
+    [ 'cr', 'creatinine' ],
+    [ 'ckd', 'chronic kidney disease', 'renal insufficiency', 'nephropathy' ],
+    [ 'asa', 'aspirin' ],
+    [ 'etoh', 'alcohol', 'drinks', 'drinking', 'alcoholism' ],
+    [ 'ivdu', 'drug abuse', 'substance abuse', 'cocaine', 'heroin', 'opioid' ],
+    [ 'cabg', 'bypass' ],
+    [ 'pci', 'stent', 'angioplasty' ],
+    [ 'afib', 'af', 'atrial fibrillation' ],
+    [ 'copd', 'emphysema', 'chronic obstructive pulmonary disease' ],
+    [ 'pe', 'pulmonary embolism' ],
+    [ 'dvt', 'deep vein thrombosis' ],
+    [ 'cva', 'stroke', 'tia' ],
+    [ 'ca', 'cancer', 'carcinoma', 'malignancy', 'tumor', 'neoplasm' ],
+    [ 'sob', 'dyspnea', 'shortness of breath' ],
+    [ 'cp', 'chest pain', 'angina' ],
+    [ 'supplement', 'supplements', 'multivitamin', 'mvi', 'vitamin', 'fish oil', 'calcium' ],
+]
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase alphanumeric tokens, minus stopwords"""
+    return [ t for t in TOKEN_REGEX.findall(text.lower()) if t not in STOPWORDS ]
+
+# Synonym tokens shorter than this (e.g. 'ca', 'pe', 'cr') are ambiguous and match many unrelated notes (e.g. 'Ca' = calcium),
+# so they are only searched for if the query itself contains them -- never added as an expansion of another term
+MIN_EXPANSION_TOKEN_LENGTH: int = 3
+
+def build_synonym_index() -> Dict[str, List[str]]:
+    """Map of token => tokens of all its synonyms (excluding ambiguous short abbreviations)"""
+    token_2_synonyms: Dict[str, List[str]] = {}
+    for group in SYNONYMS:
+        group_tokens: List[str] = sorted(set([ t for phrase in group for t in tokenize(phrase) if len(t) >= MIN_EXPANSION_TOKEN_LENGTH ]))
+        for phrase in group:
+            for t in tokenize(phrase):
+                token_2_synonyms.setdefault(t, [])
+                token_2_synonyms[t] += [ s for s in group_tokens if s not in token_2_synonyms[t] ]
+    return token_2_synonyms
+
+TOKEN_2_SYNONYMS: Dict[str, List[str]] = build_synonym_index()
+
+def expand_query(query: str) -> List[str]:
+    """Tokenize `query` and expand it with synonyms"""
+    tokens: List[str] = tokenize(query)
+    expanded: List[str] = list(tokens)
+    for t in tokens:
+        expanded += [ s for s in TOKEN_2_SYNONYMS.get(t, []) if s not in expanded ]
+    return expanded
+
+class NoteIndex:
+    """Inverted index (term => { note_id => term frequency }) over a set of notes, scored with BM25"""
+
+    def __init__(self, notes: List[Note], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.note_ids: List[str] = [ note.note_id for note in notes ]
+        self.note_id_2_length: Dict[str, int] = {}
+        self.postings: Dict[str, Dict[str, int]] = {}
+        for note in notes:
+            tokens: List[str] = tokenize(note.text)
+            self.note_id_2_length[note.note_id] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                self.postings.setdefault(term, {})[note.note_id] = tf
+        self.avg_length: float = sum(self.note_id_2_length.values()) / max(1, len(self.note_ids))
+
+    def score(self, terms: List[str]) -> Dict[str, float]:
+        """BM25 score of every note for the query `terms`"""
+        scores: Dict[str, float] = { note_id : 0.0 for note_id in self.note_ids }
+        n_notes: int = len(self.note_ids)
+        for term in set(terms):
+            postings: Dict[str, int] = self.postings.get(term, {})
+            if len(postings) == 0:
+                continue
+            idf: float = math.log(1 + (n_notes - len(postings) + 0.5) / (len(postings) + 0.5))
+            for note_id, tf in postings.items():
+                length_norm: float = 1 - self.b + self.b * self.note_id_2_length[note_id] / max(1e-9, self.avg_length)
+                scores[note_id] += idf * tf * (self.k1 + 1) / (tf + self.k1 * length_norm)
+        return scores
+
+def prefilter_notes(query: str,
+                    notes: List[Note],
+                    index: NoteIndex,
+                    recall: float = PREFILTER_RECALL,
+                    top_k: int = PREFILTER_TOP_K) -> Tuple[List[Note], Dict[str, Any]]:
+    """Prune `notes` down to those most lexically relevant to `query`.
+
+    Keeps the highest-scoring notes that together account for `recall` of the total BM25 score mass
+    (capped at `top_k` notes if `top_k > 0`), and drops notes that share no terms with the (synonym-expanded)
+    query. If no note matches the query at all (e.g. "Summarize this patient"), nothing is pruned.
+
+    Returns:
+        Tuple[List[Note], Dict[str, Any]]: The kept notes (in their original order) and stats about what was skipped.
+    """
+    note_id_2_score: Dict[str, float] = index.score(expand_query(query))
+    scores: List[float] = [ note_id_2_score.get(note.note_id, 0.0) for note in notes ]
+    total_score: float = sum(scores)
+    if total_score <= 0:
+        kept_idxs: List[int] = list(range(len(notes)))
+    else:
+        kept_idxs: List[int] = []
+        cumulative_score: float = 0.0
+        for idx in sorted(range(len(notes)), key=lambda idx: scores[idx], reverse=True):
+            if scores[idx] <= 0 or cumulative_score >= recall * total_score or (top_k > 0 and len(kept_idxs) >= top_k):
+                break
+            kept_idxs.append(idx)
+            cumulative_score += scores[idx]
+        kept_idxs.sort()
+    return [ notes[idx] for idx in kept_idxs ], {
+        'n_notes' : len(notes),
+        'n_kept' : len(kept_idxs),
+        'n_skipped' : len(notes) - len(kept_idxs),
+        'is_fallback' : total_score <= 0,
+    }
@@ -0,0 +1,197 @@
+import os
+import json
+import inspect
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from loguru import logger
+from ehrllm.backend.app.config import (
+    AGGREGATION_TOKEN_BUDGET,
+    NOTE_CHUNK_CONTEXT_FRACTION,
+    NOTE_CHUNK_OVERLAP_TOKENS,
+    NOTE_DEDUP_MIN_SECTION_CHARS,
+    NOTE_DEDUP_N_PERMUTATIONS,
+    NOTE_DEDUP_SHINGLE_SIZE,
+    NOTE_DEDUP_THRESHOLD,
+    NOTE_PACKING_TOKEN_BUDGET,
+    PATH_TO_CACHE_DIR,
+    PREFILTER_RECALL,
+    PREFILTER_TOP_K,
+    RESPONSE_CACHE_BACKEND,
+    RESPONSE_CACHE_MAX_AGE_SECONDS,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_MEMORY_N_ENTRIES,
+)
+from ehrllm.llms import prompts
+from ehrllm.inflight import InFlightDeduplicator
+from ehrllm.llms.cache import BaseLLMCache, DirectoryLLMCache, SQLiteLLMCache
+from ehrllm.utils import hash_str
+
+########################################################
+# Cache of full /api/chat responses: in-memory LRU in front of an on-disk store, with request coalescing
+########################################################
+
+# Bump whenever the shape of cached responses changes, to invalidate existing entries
+RESPONSE_CACHE_VERSION: int = 1
+# Changes whenever any prompt changes, so edited prompts never serve stale answers
+PROMPT_VERSION: str = hash_str(inspect.getsource(prompts))[:16]
+
+# Server-side config (not overridable per request) that changes the answer
+PIPELINE_CONFIG: Dict[str, Any] = {
+    'note_packing_token_budget' : NOTE_PACKING_TOKEN_BUDGET,
+    'note_chunk_context_fraction' : NOTE_CHUNK_CONTEXT_FRACTION,
+    'note_chunk_overlap_tokens' : NOTE_CHUNK_OVERLAP_TOKENS,
+    'aggregation_token_budget' : AGGREGATION_TOKEN_BUDGET,
+    'prefilter_recall' : PREFILTER_RECALL,
+    'prefilter_top_k' : PREFILTER_TOP_K,
+    'note_dedup_threshold' : NOTE_DEDUP_THRESHOLD,
+    'note_dedup_min_section_chars' : NOTE_DEDUP_MIN_SECTION_CHARS,
+    'note_dedup_shingle_size' : NOTE_DEDUP_SHINGLE_SIZE,
+    'note_dedup_n_permutations' : NOTE_DEDUP_N_PERMUTATIONS,
+}
+
+def get_response_cache_key(database: str, patient_id: str, model: str, messages: List[Dict[str, Any]], settings: Dict[str, Any]) -> str:
+    """Key for a /chat request. Covers everything that determines the answer: the dataset, patient, model,
+        the full conversation (roles + contents only, not client-side ids), settings, the server-side pipeline config, 
+        and the prompt version. `settings` should have the server's defaults filled in (see `get_effective_settings()`)."""
+    return hash_str(json.dumps({
+        'version' : RESPONSE_CACHE_VERSION,
+        'prompt_version' : PROMPT_VERSION,
+        'database' : database,
+        'patient_id' : patient_id,
+        'model' : model,
+        'messages' : [ { 'role' : m.get('role'), 'content' : m.get('content') } for m in messages ],
+        'settings' : { k : v for k, v in settings.items() if k not in [ 'database', 'model' ] },
+        'pipeline_config' : PIPELINE_CONFIG,
+    }, sort_keys=True, default=str))
+
+@dataclass
+class ResponseCacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    coalesced: int = 0 # Requests that waited on an identical in-flight request instead of running the pipeline
+    writes: int = 0
+
+class ResponseCache:
+    """Maps response cache keys (see `get_response_cache_key()`) => JSON-serializable response payloads.
+
+    Lookups check an in-memory LRU of the `memory_n_entries` most recently used entries first, then `disk`
+    (whose own TTL / LRU eviction bounds its size). Writes go to memory immediately and to disk in the
+    background, so a request never waits on disk I/O for its own response.
+
+    `get_or_compute()` also coalesces concurrent requests for the same key: only the first runs `compute`,
+    and the rest wait for (and share) its result.
+    """
+
+    def __init__(self, disk: Optional[BaseLLMCache], memory_n_entries: int = 1024, max_age_seconds: Optional[float] = None):
+        self.disk = disk
+        self.memory_n_entries = memory_n_entries
+        self.max_age_seconds = max_age_seconds
+        self.stats = ResponseCacheStats()
+        # key => (created_at, payload)
+        self._memory: 'OrderedDict[str, Tuple[float, Dict[str, Any]]]' = OrderedDict()
+        # Joins concurrent `compute`s for the same key
+        self._in_flight = InFlightDeduplicator('response_cache')
+        self._lock = threading.Lock()
+        self._disk_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='response-cache-writer')
+
+    def _set_memory(self, key: str, created_at: float, payload: Dict[str, Any]) -> None:
+        with self._lock:
+            self._memory[key] = (created_at, payload)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_n_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """Returns (payload, 'memory' | 'disk'), or (None, None) on a miss"""
+        with self._lock:
+            entry: Optional[Tuple[float, Dict[str, Any]]] = self._memory.get(key)
+            if entry is not None and self.max_age_seconds is not None and time.time() - entry[0] > self.max_age_seconds:
+                del self._memory[key]
+                entry = None
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.stats.memory_hits += 1
+                return entry[1], 'memory'
+        value: Optional[str] = self.disk.get(key) if self.disk is not None else None
+        if value is None:
+            with self._lock:
+                self.stats.misses += 1
+            return None, None
+        entry = json.loads(value)
+        self._set_memory(key, entry['created_at'], entry['payload'])
+        with self._lock:
+            self.stats.disk_hits += 1
+        return entry['payload'], 'disk'
+
+    def set(self, key: str, payload: Dict[str, Any]) -> None:
+        created_at: float = time.time()
+        self._set_memory(key, created_at, payload)
+        with self._lock:
+            self.stats.writes += 1
+        if self.disk is not None:
+            value: str = json.dumps({ 'created_at' : created_at, 'payload' : payload }, default=str)
+            self._disk_writer.submit(self._write_to_disk, key, value)
+
+    def _write_to_disk(self, key: str, value: str) -> None:
+        try:
+            self.disk.set(key, value)
+        except Exception as e:
+            logger.error(f"ResponseCache._write_to_disk() -- failed to write {key}: {e}")
+
+    def get_or_compute(self, key: str, compute: Callable[[], Tuple[int, Dict[str, Any]]], is_read_cache: bool = True) -> Tuple[int, Dict[str, Any], str]:
+        """Return the cached payload for `key`, or run `compute` -- which returns (HTTP status, payload) --
+            and cache its payload if the status is 200.
+
+            If `is_read_cache` is False, the cache is bypassed for reads (but still written to).
+            Returns (HTTP status, payload, source), where source is 'memory' | 'disk' | 'coalesced' | 'computed'."""
+        if is_read_cache:
+            payload, source = self.get(key)
+            if payload is not None:
+                return 200, payload, source
+
+        def compute_and_set() -> Tuple[int, Dict[str, Any]]:
+            status, payload = compute()
+            if status == 200:
+                self.set(key, payload)
+            return status, payload
+        (status, payload), is_shared = self._in_flight.run_with_status(key, compute_and_set)
+        if is_shared:
+            with self._lock:
+                self.stats.coalesced += 1
+            return status, payload, 'coalesced'
+        return status, payload, 'computed'
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = asdict(self.stats)
+            stats['memory_n_entries'] = len(self._memory)
+        n_lookups: int = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['memory_hits'] + stats['disk_hits']) / n_lookups if n_lookups > 0 else 0.0
+        return stats
+
+# On-disk backends selectable via `RESPONSE_CACHE_BACKEND` (same storage as the LLM response cache)
+RESPONSE_CACHE_BACKENDS: Dict[str, Any] = {
+    'directory' : lambda **kwargs: DirectoryLLMCache(os.path.join(PATH_TO_CACHE_DIR, "api_responses"), **kwargs),
+    'sqlite' : lambda **kwargs: SQLiteLLMCache(os.path.join(PATH_TO_CACHE_DIR, "api_responses.sqlite"), **kwargs),
+}
+
+_response_cache: Optional[ResponseCache] = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache() -> ResponseCache:
+    """Process-wide /chat response cache configured by `RESPONSE_CACHE_BACKEND` (memory-only if 'none')"""
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            if RESPONSE_CACHE_BACKEND not in list(RESPONSE_CACHE_BACKENDS.keys()) + [ 'none' ]:
+                raise ValueError(f"Invalid RESPONSE_CACHE_BACKEND: {RESPONSE_CACHE_BACKEND}. Must be one of {list(RESPONSE_CACHE_BACKENDS.keys()) + ['none']}")
+            disk: Optional[BaseLLMCache] = None
+            if RESPONSE_CACHE_BACKEND != 'none':
+                disk = RESPONSE_CACHE_BACKENDS[RESPONSE_CACHE_BACKEND](max_age_seconds=RESPONSE_CACHE_MAX_AGE_SECONDS, max_entries=RESPONSE_CACHE_MAX_ENTRIES)
+            _response_cache = ResponseCache(disk, memory_n_entries=RESPONSE_CACHE_MEMORY_N_ENTRIES, max_age_seconds=RESPONSE_CACHE_MAX_AGE_SECONDS)
+    return _response_cache
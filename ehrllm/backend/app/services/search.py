@@ -0,0 +1,320 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import polars as pl
+from loguru import logger
+from ehrllm.utils import get_rel_path
+from ehrllm.backend.app.config import PATH_TO_MIMICIV_NOTES_DIR, PATH_TO_MIMICIV_SNAPSHOT_DIR, PATH_TO_N2C22018_DIR, PATH_TO_SEARCH_INDEX
+from ehrllm.backend.app.databases.mimiciv import ensure_snapshot, get_source_paths
+from ehrllm.backend.app.databases.n2c22018 import get_file_fingerprint, load_patients
+
+########################################################
+# Cohort-wide full-text search over every note in every database.
+#
+# Notes are stored in an SQLite FTS5 index (i.e. a persisted inverted index of
+# term => positional posting list), which supports phrase / boolean / prefix queries,
+# BM25 ranking, and keyword-in-context snippets at the exact match positions.
+########################################################
+
+# Bump whenever the schema or tokenizer changes, to force a rebuild of existing indexes
+SEARCH_INDEX_VERSION: int = 1
+SEARCH_INDEX_DATABASES: List[str] = [ 'mimiciv-notes', 'n2c2-2018' ]
+# Rows inserted per `executemany()` call while building
+INSERT_BATCH_SIZE: int = 10_000
+
+# Quoted phrases, parentheses, or barewords (which may end in a `*` for prefix matching)
+QUERY_TOKEN_REGEX = re.compile(r'"[^"]*"|\(|\)|[^\s()"]+')
+QUERY_OPERATORS = set([ 'AND', 'OR', 'NOT' ])
+
+def to_fts_query(query: str) -> str:
+    """Convert a user query into FTS5 query syntax.
+        Supports "quoted phrases", AND / OR / NOT (implicit AND between terms), parentheses, and prefix* terms.
+        Barewords are quoted, so that punctuation in e.g. `x-ray` or `s/p` isn't parsed as FTS5 syntax."""
+    fts_tokens: List[str] = []
+    for token in QUERY_TOKEN_REGEX.findall(query):
+        if token in QUERY_OPERATORS or token in [ '(', ')' ]:
+            if token == 'NOT' and len(fts_tokens) > 0 and fts_tokens[-1] == 'AND':
+                # "a AND NOT b" => "a NOT b" (FTS5's NOT is a binary operator)
+                fts_tokens.pop()
+            if token == '(' and len(fts_tokens) > 0 and fts_tokens[-1] not in QUERY_OPERATORS and fts_tokens[-1] != '(':
+                # FTS5 only allows implicit AND between phrases, not around a parenthesized group
+                fts_tokens.append('AND')
+            fts_tokens.append(token)
+            continue
+        if token.startswith('"'):
+            if not token.strip('"').strip():
+                continue
+            fts_token: str = token
+        else:
+            is_prefix: bool = token.endswith('*')
+            term: str = token.rstrip('*').replace('"', '')
+            if not term:
+                continue
+            fts_token: str = f'"{term}"' + ('*' if is_prefix else '')
+        if len(fts_tokens) > 0 and fts_tokens[-1] == ')':
+            fts_tokens.append('AND')
+        fts_tokens.append(fts_token)
+    if len(fts_tokens) == 0:
+        raise ValueError(f"Empty search query: '{query}'")
+    return " ".join(fts_tokens)
+
+########################################################
+# Note sources (yield (note_id, patient_id, note_type, chartdatetime, text) for every note in a database)
+########################################################
+
+def get_mimiciv_fingerprint() -> Optional[str]:
+    """Fingerprint of the MIMIC-IV note CSVs, or None if they don't exist"""
+    source_paths: List[str] = get_source_paths(get_rel_path(PATH_TO_MIMICIV_NOTES_DIR))
+    if not all([ os.path.exists(path) for path in source_paths ]):
+        return None
+    return json.dumps([ (os.path.abspath(path), os.stat(path).st_mtime, os.stat(path).st_size) for path in source_paths ])
+
+def iter_mimiciv_notes() -> Iterator[Tuple[str, str, str, Optional[str], str]]:
+    """All MIMIC-IV notes, streamed from the (memory-mapped) notes snapshot"""
+    path_to_snapshot: str = ensure_snapshot(get_rel_path(PATH_TO_MIMICIV_NOTES_DIR), get_rel_path(PATH_TO_MIMICIV_SNAPSHOT_DIR))
+    df_notes: pl.DataFrame = pl.read_ipc(path_to_snapshot, memory_map=True).select([ 'note_id', 'subject_id', 'note_type', 'charttime', 'text' ])
+    for df_slice in df_notes.iter_slices(n_rows=INSERT_BATCH_SIZE):
+        for note_id, subject_id, note_type, charttime, text in df_slice.iter_rows():
+            yield (str(note_id), str(subject_id), note_type, charttime.isoformat() if charttime is not None else None, text)
+
+def get_n2c22018_xml_files() -> List[Path]:
+    return sorted(list(Path(get_rel_path(PATH_TO_N2C22018_DIR)).glob('*.xml')))
+
+def get_n2c22018_fingerprint() -> Optional[str]:
+    """Fingerprint of the n2c2 2018 XML files, or None if there are none"""
+    xml_files: List[Path] = get_n2c22018_xml_files()
+    if len(xml_files) == 0:
+        return None
+    return hashlib.sha256(json.dumps([ (str(file), *get_file_fingerprint(file)) for file in xml_files ]).encode('utf-8')).hexdigest()
+
+def iter_n2c22018_notes() -> Iterator[Tuple[str, str, str, Optional[str], str]]:
+    """All n2c2 2018 notes (across all XML files, even if IS_DEBUG is True)"""
+    patients, _ = load_patients(get_n2c22018_xml_files())
+    for patient in patients:
+        for note in patient.notes:
+            yield (note.note_id, patient.id, note.note_type, note.chartdatetime.isoformat() if note.chartdatetime is not None else None, note.text)
+
+# Map of database name => (fingerprint function, note iterator)
+SEARCH_INDEX_SOURCES: Dict[str, Tuple[Any, Any]] = {
+    'mimiciv-notes' : (get_mimiciv_fingerprint, iter_mimiciv_notes),
+    'n2c2-2018' : (get_n2c22018_fingerprint, iter_n2c22018_notes),
+}
+
+########################################################
+# Index
+########################################################
+
+class SearchIndexNotBuiltError(Exception):
+    pass
+
+class SearchIndex:
+    """Full-text index over all notes, persisted as an SQLite file at `path_to_db`.
+
+    Tables:
+        notes: rowid => (database, note_id, patient_id, note_type, chartdatetime)
+        notes_fts: FTS5 table over note text (same rowid as `notes`)
+        sources: database => fingerprint of the source files it was indexed from
+    """
+
+    def __init__(self, path_to_db: str):
+        self.path_to_db = path_to_db
+        self._build_lock = threading.Lock()
+
+    def is_built(self) -> bool:
+        return os.path.exists(self.path_to_db)
+
+    def _connect(self, is_read_only: bool = True) -> sqlite3.Connection:
+        if is_read_only:
+            if not self.is_built():
+                raise SearchIndexNotBuiltError(f"Search index not found at {self.path_to_db}. Build it with `python scripts/find_patients.py --build`")
+            return sqlite3.connect(f"file:{self.path_to_db}?mode=ro", uri=True, check_same_thread=False)
+        os.makedirs(os.path.dirname(self.path_to_db), exist_ok=True)
+        conn = sqlite3.connect(self.path_to_db, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _create_tables(self, conn: sqlite3.Connection) -> None:
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is not None and int(row[0]) != SEARCH_INDEX_VERSION:
+            logger.info(f"Search index version changed ({row[0]} => {SEARCH_INDEX_VERSION}), dropping existing index")
+            conn.executescript("DROP TABLE IF EXISTS notes; DROP TABLE IF EXISTS notes_fts; DROP TABLE IF EXISTS sources;")
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (str(SEARCH_INDEX_VERSION),))
+        conn.execute("""CREATE TABLE IF NOT EXISTS notes (
+            rowid INTEGER PRIMARY KEY,
+            database TEXT NOT NULL,
+            note_id TEXT NOT NULL,
+            patient_id TEXT NOT NULL,
+            note_type TEXT,
+            chartdatetime TEXT
+        )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS notes_database_patient_id ON notes (database, patient_id)")
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(text, tokenize='porter unicode61')")
+        conn.execute("CREATE TABLE IF NOT EXISTS sources (database TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, n_notes INTEGER NOT NULL, built_at REAL NOT NULL)")
+
+    def build(self, databases: List[str] = SEARCH_INDEX_DATABASES, is_force: bool = False) -> Dict[str, int]:
+        """(Re)index every database in `databases` whose source files changed since it was last indexed.
+            Returns a map of database => # of notes indexed (only for databases that were re-indexed)."""
+        db_2_n_notes: Dict[str, int] = {}
+        with self._build_lock:
+            conn = self._connect(is_read_only=False)
+            try:
+                self._create_tables(conn)
+                for database in databases:
+                    get_fingerprint, iter_notes = SEARCH_INDEX_SOURCES[database]
+                    fingerprint: Optional[str] = get_fingerprint()
+                    if fingerprint is None:
+                        logger.warning(f"SearchIndex.build() -- no source files found for '{database}', skipping")
+                        continue
+                    row = conn.execute("SELECT fingerprint FROM sources WHERE database = ?", (database,)).fetchone()
+                    if not is_force and row is not None and row[0] == fingerprint:
+                        logger.info(f"SearchIndex.build() -- '{database}' is up-to-date")
+                        continue
+                    db_2_n_notes[database] = self._index_database(conn, database, fingerprint, iter_notes())
+                conn.execute("INSERT INTO notes_fts (notes_fts) VALUES ('optimize')")
+                conn.commit()
+            finally:
+                conn.close()
+        return db_2_n_notes
+
+    def _index_database(self, conn: sqlite3.Connection, database: str, fingerprint: str, notes: Iterator[Tuple[str, str, str, Optional[str], str]]) -> int:
+        """Replace all of `database`'s notes in the index with `notes`, in one transaction"""
+        start_time = time.time()
+        conn.execute("DELETE FROM notes_fts WHERE rowid IN (SELECT rowid FROM notes WHERE database = ?)", (database,))
+        conn.execute("DELETE FROM notes WHERE database = ?", (database,))
+        next_rowid: int = (conn.execute("SELECT MAX(rowid) FROM notes").fetchone()[0] or 0) + 1
+        n_notes: int = 0
+        batch: List[Tuple[str, str, str, Optional[str], str]] = []
+        for note in notes:
+            batch.append(note)
+            if len(batch) >= INSERT_BATCH_SIZE:
+                self._insert_batch(conn, database, next_rowid + n_notes, batch)
+                n_notes += len(batch)
+                batch = []
+        self._insert_batch(conn, database, next_rowid + n_notes, batch)
+        n_notes += len(batch)
+        conn.execute("INSERT OR REPLACE INTO sources (database, fingerprint, n_notes, built_at) VALUES (?, ?, ?, ?)", (database, fingerprint, n_notes, time.time()))
+        conn.commit()
+        logger.info(f"SearchIndex.build() -- indexed {n_notes} notes from '{database}' in {time.time() - start_time:.2f}s")
+        return n_notes
+
+    def _insert_batch(self, conn: sqlite3.Connection, database: str, start_rowid: int, batch: List[Tuple[str, str, str, Optional[str], str]]) -> None:
+        conn.executemany("INSERT INTO notes (rowid, database, note_id, patient_id, note_type, chartdatetime) VALUES (?, ?, ?, ?, ?, ?)", [
+            (start_rowid + idx, database, note_id, patient_id, note_type, chartdatetime)
+            for idx, (note_id, patient_id, note_type, chartdatetime, _) in enumerate(batch)
+        ])
+        conn.executemany("INSERT INTO notes_fts (rowid, text) VALUES (?, ?)", [
+            (start_rowid + idx, text) for idx, (_, _, _, _, text) in enumerate(batch)
+        ])
+
+    def _execute(self, sql: str, params: Tuple) -> List[Tuple]:
+        conn = self._connect()
+        try:
+            return conn.execute(sql, params).fetchall()
+        except sqlite3.OperationalError as e:
+            # FTS5 syntax errors (e.g. unbalanced parentheses or a dangling operator)
+            raise ValueError(f"Invalid search query: {e}")
+        finally:
+            conn.close()
+
+    def search_notes(self,
+                     query: str,
+                     database: Optional[str] = None,
+                     patient_id: Optional[str] = None,
+                     limit: int = 50,
+                     offset: int = 0,
+                     highlight: Tuple[str, str] = ('<mark>', '</mark>'),
+                     snippet_n_tokens: int = 32) -> List[Dict[str, Any]]:
+        """Notes matching `query`, best (BM25) match first, with a keyword-in-context snippet around the matches"""
+        rows = self._execute(f"""
+            SELECT n.database, n.note_id, n.patient_id, n.note_type, n.chartdatetime,
+                snippet(notes_fts, 0, ?, ?, '...', ?), notes_fts.rank
+            FROM notes_fts JOIN notes n ON n.rowid = notes_fts.rowid
+            WHERE notes_fts MATCH ? {'AND n.database = ?' if database else ''} {'AND n.patient_id = ?' if patient_id else ''}
+            ORDER BY notes_fts.rank
+            LIMIT ? OFFSET ?
+        """, (highlight[0], highlight[1], snippet_n_tokens, to_fts_query(query), *([ database ] if database else []), *([ patient_id ] if patient_id else []), limit, offset))
+        return [
+            {
+                'database' : row[0],
+                'note_id' : row[1],
+                'patient_id' : row[2],
+                'note_type' : row[3],
+                'chartdatetime' : row[4],
+                'snippet' : row[5],
+                'score' : -row[6], # FTS5 ranks are negated BM25 scores
+            }
+            for row in rows
+        ]
+
+    def search_patients(self,
+                        query: str,
+                        database: Optional[str] = None,
+                        limit: int = 50,
+                        offset: int = 0,
+                        highlight: Tuple[str, str] = ('<mark>', '</mark>'),
+                        snippet_n_tokens: int = 32) -> List[Dict[str, Any]]:
+        """Patients with at least one note matching `query`, ranked by their best-matching note.
+            Includes the # of matching notes and a snippet from the best-matching note."""
+        fts_query: str = to_fts_query(query)
+        # NOTE: In SQLite, bare columns in an aggregate query with MIN() come from the row with the minimum value,
+        # so `notes_fts.rowid` is the rowid of each patient's best-matching note
+        rows = self._execute(f"""
+            SELECT n.database, n.patient_id, COUNT(*), MIN(notes_fts.rank), notes_fts.rowid
+            FROM notes_fts JOIN notes n ON n.rowid = notes_fts.rowid
+            WHERE notes_fts MATCH ? {'AND n.database = ?' if database else ''}
+            GROUP BY n.database, n.patient_id
+            ORDER BY MIN(notes_fts.rank)
+            LIMIT ? OFFSET ?
+        """, (fts_query, *([ database ] if database else []), limit, offset))
+        if len(rows) == 0:
+            return []
+
+        # Snippets for only the best-matching note of each returned patient
+        rowids: List[int] = [ row[4] for row in rows ]
+        rowid_2_note: Dict[int, Tuple] = {
+            row[0] : row[1:] for row in self._execute(f"""
+                SELECT notes_fts.rowid, n.note_id, n.note_type, n.chartdatetime, snippet(notes_fts, 0, ?, ?, '...', ?)
+                FROM notes_fts JOIN notes n ON n.rowid = notes_fts.rowid
+                WHERE notes_fts MATCH ? AND notes_fts.rowid IN ({', '.join([ '?' ] * len(rowids))})
+            """, (highlight[0], highlight[1], snippet_n_tokens, fts_query, *rowids))
+        }
+        return [
+            {
+                'database' : row[0],
+                'patient_id' : row[1],
+                'n_matching_notes' : row[2],
+                'score' : -row[3],
+                'best_note' : {
+                    'note_id' : rowid_2_note[row[4]][0],
+                    'note_type' : rowid_2_note[row[4]][1],
+                    'chartdatetime' : rowid_2_note[row[4]][2],
+                    'snippet' : rowid_2_note[row[4]][3],
+                },
+            }
+            for row in rows
+        ]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """# of notes indexed per database, and when each was last indexed"""
+        return {
+            row[0] : { 'n_notes' : row[1], 'built_at' : row[2] }
+            for row in self._execute("SELECT database, n_notes, built_at FROM sources", ())
+        }
+
+_search_index: Optional[SearchIndex] = None
+_search_index_lock = threading.Lock()
+
+def get_search_index() -> SearchIndex:
+    """Process-wide search index"""
+    global _search_index
+    with _search_index_lock:
+        if _search_index is None:
+            _search_index = SearchIndex(get_rel_path(PATH_TO_SEARCH_INDEX))
+        return _search_index
@@ -0,0 +1,193 @@
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass, asdict, field
+from typing import Any, Dict, List, Optional
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler, make_server
+
+########################################################
+# Local stand-in for an OpenAI-compatible chat completions API, for benchmarking without a provider
+########################################################
+
+@dataclass
+class MockLLMConfig:
+    latency_seconds: float = 0.5 # Mean latency of each response
+    latency_jitter_seconds: float = 0.1 # Std. dev. of each response's latency
+    seconds_per_1k_prompt_tokens: float = 0.0 # Extra latency per 1k prompt tokens (i.e. prefill time)
+    error_rate: float = 0.0 # Fraction of requests that fail with a 500
+    rate_limit_rate: float = 0.0 # Fraction of requests that fail with a 429
+    max_concurrency: int = 0 # Requests beyond this many in flight fail with a 429 (0 = unlimited)
+    retry_after_seconds: float = 1.0 # `Retry-After` header sent with 429s
+    relevance_rate: float = 0.5 # Probability that any boolean field (e.g. `is_relevant`) is True
+    seed: int = 0
+
+@dataclass
+class MockLLMStats:
+    n_requests: int = 0
+    n_responses: int = 0
+    n_errors: int = 0
+    n_rate_limited: int = 0
+    max_in_flight: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    n_requests_by_schema: Dict[str, int] = field(default_factory=dict)
+
+def count_tokens_approx(text: str) -> int:
+    """~4 characters per token, which is close enough for benchmarking"""
+    return max(1, len(text) // 4)
+
+def get_message_text(message: Dict[str, Any]) -> str:
+    """Text of a chat message, whose `content` is either a string or a list of content parts"""
+    content: Any = message.get('content') or ''
+    if isinstance(content, list):
+        return "\n".join([ part.get('text', '') for part in content if isinstance(part, dict) ])
+    return str(content)
+
+def generate_from_schema(schema: Dict[str, Any], defs: Dict[str, Any], rng: random.Random, config: MockLLMConfig, prompt: str, name: str = '') -> Any:
+    """Generate a random instance of a JSON schema (as produced by pydantic's `model_json_schema()`).
+
+    Arrays get one item, except for a list of objects with a `note_index` / `question_index` field
+    (i.e. a batched response), which gets one item per `note_index="..."` / `question_index="..."` in `prompt`.
+    """
+    if '$ref' in schema:
+        return generate_from_schema(defs[schema['$ref'].split('/')[-1]], defs, rng, config, prompt, name=name)
+    if 'anyOf' in schema:
+        options: List[Dict[str, Any]] = [ s for s in schema['anyOf'] if s.get('type') != 'null' ]
+        return generate_from_schema(options[0], defs, rng, config, prompt, name=name) if len(options) > 0 else None
+    schema_type: Optional[str] = schema.get('type')
+    if schema_type == 'object':
+        return {
+            key : generate_from_schema(value, defs, rng, config, prompt, name=key)
+            for key, value in schema.get('properties', {}).items()
+        }
+    if schema_type == 'array':
+        item_schema: Dict[str, Any] = schema.get('items', {})
+        if '$ref' in item_schema:
+            item_schema = defs[item_schema['$ref'].split('/')[-1]]
+        for index_field in [ 'note_index', 'question_index' ]:
+            if index_field in item_schema.get('properties', {}):
+                idxs: List[int] = sorted(set([ int(idx) for idx in re.findall(index_field + r'="(\d+)"', prompt) ])) or [ 0 ]
+                return [
+                    { **generate_from_schema(item_schema, defs, rng, config, prompt), index_field : idx }
+                    for idx in idxs
+                ]
+        return [ generate_from_schema(item_schema, defs, rng, config, prompt, name=name) ]
+    if schema_type == 'boolean':
+        return rng.random() < config.relevance_rate
+    if schema_type == 'integer':
+        return 0
+    if schema_type == 'number':
+        return 0.0
+    return f"Synthetic {name or 'text'} {rng.randint(0, 1_000_000)}"
+
+def generate_content(body: Dict[str, Any], rng: random.Random, config: MockLLMConfig, prompt: str) -> str:
+    """Content of the assistant message: an instance of the requested JSON schema, if any, else plain text"""
+    response_format: Dict[str, Any] = body.get('response_format') or {}
+    if response_format.get('type') == 'json_schema':
+        schema: Dict[str, Any] = response_format['json_schema']['schema']
+        return json.dumps(generate_from_schema(schema, schema.get('$defs', {}), rng, config, prompt))
+    if response_format.get('type') == 'json_object':
+        return json.dumps({ 'answer' : f"Synthetic answer {rng.randint(0, 1_000_000)}" })
+    return f"Synthetic answer {rng.randint(0, 1_000_000)}"
+
+def create_mock_llm_app(config: MockLLMConfig) -> Flask:
+    """Flask app serving `POST /v1/chat/completions` (non-streaming) plus `GET /stats`"""
+    app = Flask(__name__)
+    stats = MockLLMStats()
+    lock = threading.Lock()
+    rng = random.Random(config.seed)
+    n_in_flight: int = 0
+
+    def error_response(status: int, error_type: str, message: str, headers: Optional[Dict[str, str]] = None) -> Response:
+        response: Response = jsonify({ 'error' : { 'message' : message, 'type' : error_type, 'code' : status } })
+        response.status_code = status
+        for key, value in (headers or {}).items():
+            response.headers[key] = value
+        return response
+
+    @app.route('/v1/chat/completions', methods=['POST'])
+    @app.route('/chat/completions', methods=['POST'])
+    def chat_completions():
+        nonlocal n_in_flight
+        body: Dict[str, Any] = request.get_json(force=True)
+        prompt: str = "\n".join([ get_message_text(m) for m in body.get('messages', []) ])
+        schema_name: str = ((body.get('response_format') or {}).get('json_schema') or {}).get('name', 'text')
+        with lock:
+            stats.n_requests += 1
+            stats.n_requests_by_schema[schema_name] = stats.n_requests_by_schema.get(schema_name, 0) + 1
+            request_rng = random.Random(rng.random())
+            is_over_concurrency: bool = config.max_concurrency > 0 and n_in_flight >= config.max_concurrency
+            if not is_over_concurrency:
+                n_in_flight += 1
+                stats.max_in_flight = max(stats.max_in_flight, n_in_flight)
+        if is_over_concurrency or request_rng.random() < config.rate_limit_rate:
+            with lock:
+                stats.n_rate_limited += 1
+                if not is_over_concurrency:
+                    n_in_flight -= 1
+            return error_response(429, 'rate_limit_error', "Rate limit exceeded", headers={ 'Retry-After' : str(config.retry_after_seconds) })
+
+        try:
+            prompt_tokens: int = count_tokens_approx(prompt)
+            time.sleep(max(0.0, request_rng.gauss(config.latency_seconds, config.latency_jitter_seconds)) + config.seconds_per_1k_prompt_tokens * prompt_tokens / 1000)
+            if request_rng.random() < config.error_rate:
+                with lock:
+                    stats.n_errors += 1
+                return error_response(500, 'server_error', "Synthetic server error")
+
+            content: str = generate_content(body, request_rng, config, prompt)
+            completion_tokens: int = count_tokens_approx(content)
+            with lock:
+                stats.n_responses += 1
+                stats.prompt_tokens += prompt_tokens
+                stats.completion_tokens += completion_tokens
+            return jsonify({
+                'id' : f"chatcmpl-{uuid.uuid4().hex}",
+                'object' : 'chat.completion',
+                'created' : int(time.time()),
+                'model' : body.get('model', 'mock'),
+                'choices' : [ { 'index' : 0, 'message' : { 'role' : 'assistant', 'content' : content }, 'finish_reason' : 'stop' } ],
+                'usage' : { 'prompt_tokens' : prompt_tokens, 'completion_tokens' : completion_tokens, 'total_tokens' : prompt_tokens + completion_tokens },
+            })
+        finally:
+            with lock:
+                n_in_flight -= 1
+
+    @app.route('/v1/models', methods=['GET'])
+    def models():
+        return jsonify({ 'object' : 'list', 'data' : [ { 'id' : 'mock', 'object' : 'model' } ] })
+
+    @app.route('/stats', methods=['GET'])
+    def get_stats():
+        with lock:
+            return jsonify(asdict(stats))
+
+    return app
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+    """Don't log every request (there are thousands per benchmark run)"""
+    def log_request(self, *args, **kwargs) -> None:
+        pass
+
+class ServerThread:
+    """Serve a WSGI app from a background thread (one thread per request). Use as a context manager."""
+
+    def __init__(self, app: Flask, host: str = '127.0.0.1', port: int = 0):
+        self.server: BaseWSGIServer = make_server(host, port, app, threaded=True, request_handler=QuietWSGIRequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.server.host}:{self.server.server_port}"
+
+    def __enter__(self) -> 'ServerThread':
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.server.shutdown()
+        self.thread.join()
@@ -0,0 +1,233 @@
+import json
+import random
+import shutil
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+import numpy as np
+from ehrllm.backend.app import create_app
+from ehrllm.backend.app.config import PATH_TO_MIMICIV_SNAPSHOT_DIR, PATH_TO_N2C22018_CACHE_DIR
+from ehrllm.backend.app.databases.base import BaseDatabase
+from ehrllm.backend.app.databases.mimiciv import MIMICIVNotesDatabase
+from ehrllm.backend.app.databases.n2c22018 import N2C22018CTMatchingDatabase
+from ehrllm.backend.app.models import Note
+from ehrllm.backend.app.services.chat import aggregate_responses, run_query_over_notes
+from ehrllm.benchmarks.mock_llm_server import ServerThread
+from ehrllm.llms.models import LLM_ChatCompletionResponse, LLM_Evidence, LLM_Quote
+from ehrllm.llms.retry import get_retry_scheduler
+from ehrllm.llms.usage import get_usage_tracker
+from ehrllm.llms.utils import DEFAULT_MODEL
+from ehrllm.utils import get_rel_path
+
+########################################################
+# Benchmark scenarios for the backend. Each returns a dict of results.
+# LLM calls go to whatever OpenAI-compatible server is configured (e.g. the mock server).
+########################################################
+
+DEFAULT_QUERY: str = "Does the patient have a history of myocardial infarction? What medications are they taking for it?"
+
+def summarize_latencies(latencies: List[float]) -> Dict[str, float]:
+    """Mean / percentiles (in ms) of a list of latencies (in seconds)"""
+    if len(latencies) == 0:
+        return {}
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'n' : len(latencies),
+        'mean_ms' : float(latencies_ms.mean()),
+        'p50_ms' : float(np.percentile(latencies_ms, 50)),
+        'p95_ms' : float(np.percentile(latencies_ms, 95)),
+        'p99_ms' : float(np.percentile(latencies_ms, 99)),
+        'max_ms' : float(latencies_ms.max()),
+    }
+
+def get_llm_counters() -> Dict[str, Any]:
+    """Process-wide LLM call / token / retry counters, to diff before vs. after a scenario"""
+    totals: Dict[str, Any] = get_usage_tracker().get_totals()
+    retries: Dict[str, Any] = get_retry_scheduler().get_stats()
+    return {
+        'n_llm_calls' : totals['n_calls'],
+        'prompt_tokens' : totals['prompt_tokens'],
+        'completion_tokens' : totals['completion_tokens'],
+        'n_llm_retries' : sum(retries['n_retries'].values()),
+        'n_llm_failures' : sum(retries['n_failures'].values()),
+    }
+
+def diff_llm_counters(start: Dict[str, Any]) -> Dict[str, Any]:
+    end: Dict[str, Any] = get_llm_counters()
+    return { key : end[key] - start[key] for key in start }
+
+def get_patient_ids(db: BaseDatabase) -> List[str]:
+    if isinstance(db, MIMICIVNotesDatabase):
+        return sorted(db.patient_id_2_row_range.keys())
+    if isinstance(db, N2C22018CTMatchingDatabase):
+        return sorted(db.patients.keys())
+    raise ValueError(f"Unsupported database: {db.name}")
+
+def bench_db_load(db_cls: Type[BaseDatabase]) -> Dict[str, Any]:
+    """Cold load (no snapshot / parse cache, i.e. first startup) vs. warm load (cache up-to-date, i.e. every later startup)"""
+    path_to_cache_dir: str = get_rel_path(PATH_TO_MIMICIV_SNAPSHOT_DIR if db_cls is MIMICIVNotesDatabase else PATH_TO_N2C22018_CACHE_DIR)
+    results: Dict[str, Any] = { 'scenario' : 'db_load', 'database' : db_cls.name }
+    for mode in [ 'cold', 'warm' ]:
+        if mode == 'cold':
+            shutil.rmtree(path_to_cache_dir, ignore_errors=True)
+        db_cls._instance = None
+        start_time = time.time()
+        db: BaseDatabase = db_cls.instance()
+        results[f"{mode}_seconds"] = time.time() - start_time
+    results['n_patients'] = len(get_patient_ids(db))
+    return results
+
+def bench_patient_lookup(db: BaseDatabase, n_lookups: int = 1000, seed: int = 0) -> Dict[str, Any]:
+    """Latency of looking up a random patient + loading all of their notes (what every /chat request does first)"""
+    rng = random.Random(seed)
+    patient_ids: List[str] = get_patient_ids(db)
+    latencies: List[float] = []
+    n_notes: int = 0
+    for _ in range(n_lookups):
+        patient_id: str = rng.choice(patient_ids)
+        start_time = time.time()
+        assert db.is_patient_exists(patient_id)
+        notes: List[Note] = db.get_patient_notes(patient_id)
+        latencies.append(time.time() - start_time)
+        n_notes += len(notes)
+    return {
+        'scenario' : 'patient_lookup',
+        'database' : db.name,
+        'latency' : summarize_latencies(latencies),
+        'mean_notes_per_patient' : n_notes / max(1, n_lookups),
+    }
+
+def bench_note_fanout(db: BaseDatabase, n_patients: int = 10, query: str = DEFAULT_QUERY, model: str = DEFAULT_MODEL, seed: int = 0) -> Dict[str, Any]:
+    """Latency + throughput of running one query over every note of a patient (one patient at a time)"""
+    rng = random.Random(seed)
+    all_patient_ids: List[str] = get_patient_ids(db)
+    patient_ids: List[str] = rng.sample(all_patient_ids, min(n_patients, len(all_patient_ids)))
+    messages: List[Dict[str, Any]] = [ { 'role' : 'user', 'content' : query } ]
+    counters_start: Dict[str, Any] = get_llm_counters()
+    latencies: List[float] = []
+    n_notes: int = 0
+    n_failed: int = 0
+    start_time = time.time()
+    for patient_id in patient_ids:
+        notes: List[Note] = db.get_patient_notes(patient_id)
+        patient_start_time = time.time()
+        responses: Optional[List[LLM_ChatCompletionResponse]] = run_query_over_notes(messages, notes, model=model)
+        latencies.append(time.time() - patient_start_time)
+        n_notes += len(notes)
+        n_failed += responses is None
+    elapsed_seconds: float = time.time() - start_time
+    return {
+        'scenario' : 'note_fanout',
+        'database' : db.name,
+        'latency_per_patient' : summarize_latencies(latencies),
+        'notes_per_second' : n_notes / elapsed_seconds if elapsed_seconds > 0 else 0.0,
+        'n_notes' : n_notes,
+        'n_failed' : n_failed,
+        **diff_llm_counters(counters_start),
+    }
+
+def create_synthetic_note_responses(n_responses: int, n_words_per_response: int = 100, seed: int = 0) -> List[LLM_ChatCompletionResponse]:
+    """Relevant note-level responses with one piece of evidence each, as input to aggregation"""
+    rng = random.Random(seed)
+    words: List[str] = [ "patient", "history", "aspirin", "infarction", "troponin", "elevated", "stable", "denies", "chest", "pain" ]
+    def text(n_words: int) -> str:
+        return " ".join([ rng.choice(words) for _ in range(n_words) ])
+    return [
+        LLM_ChatCompletionResponse(
+            thinking=text(n_words_per_response // 4),
+            reflection=text(n_words_per_response // 4),
+            is_relevant=True,
+            evidence=[ LLM_Evidence(quotes=[ LLM_Quote(quote=text(n_words_per_response // 4), source=f"note_{idx}") ], claim=text(10)) ],
+            answer=text(n_words_per_response // 4),
+        )
+        for idx in range(n_responses)
+    ]
+
+def bench_aggregation(n_responses_list: List[int] = [ 10, 100, 1000 ], query: str = DEFAULT_QUERY, model: str = DEFAULT_MODEL) -> Dict[str, Any]:
+    """Latency + # of LLM calls to aggregate N note-level responses (large N triggers the tree-reduce)"""
+    messages: List[Dict[str, Any]] = [ { 'role' : 'user', 'content' : query } ]
+    results: Dict[str, Any] = { 'scenario' : 'aggregation', 'runs' : [] }
+    for n_responses in n_responses_list:
+        responses: List[LLM_ChatCompletionResponse] = create_synthetic_note_responses(n_responses)
+        counters_start: Dict[str, Any] = get_llm_counters()
+        start_time = time.time()
+        response = aggregate_responses(messages, responses, model=model)
+        results['runs'].append({
+            'n_responses' : n_responses,
+            'seconds' : time.time() - start_time,
+            'is_success' : response is not None,
+            **diff_llm_counters(counters_start),
+        })
+    return results
+
+def post_json(url: str, body: Dict[str, Any], timeout: float = 600) -> Tuple[int, Dict[str, Any]]:
+    request = urllib.request.Request(url, data=json.dumps(body).encode('utf-8'), headers={ 'Content-Type' : 'application/json' }, method='POST')
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, {}
+
+def bench_chat_load(db: BaseDatabase,
+                    n_requests: int = 50,
+                    concurrency: int = 8,
+                    query: str = DEFAULT_QUERY,
+                    model: str = DEFAULT_MODEL,
+                    triage_model: Optional[str] = None,
+                    seed: int = 0) -> Dict[str, Any]:
+    """End-to-end `POST /api/chat` latency + throughput with `concurrency` clients, against a real (threaded) HTTP server.
+        If `triage_model` is set, requests use the model cascade (see `triage_notes()`)."""
+    rng = random.Random(seed)
+    all_patient_ids: List[str] = get_patient_ids(db)
+    patient_ids: List[str] = [ rng.choice(all_patient_ids) for _ in range(n_requests) ]
+    counters_start: Dict[str, Any] = get_llm_counters()
+    with ServerThread(create_app()) as server:
+        def send(patient_id: str) -> Tuple[int, float]:
+            start_time = time.time()
+            status, _ = post_json(f"{server.url}/api/chat", {
+                'patientId' : patient_id,
+                'messages' : [ { 'role' : 'user', 'content' : query } ],
+                'settings' : { 'database' : db.name, 'model' : model, **({ 'triage_model' : triage_model } if triage_model else {}) },
+            })
+            return status, time.time() - start_time
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results: List[Tuple[int, float]] = list(executor.map(send, patient_ids))
+        elapsed_seconds: float = time.time() - start_time
+    return {
+        'scenario' : 'chat_load',
+        'database' : db.name,
+        'concurrency' : concurrency,
+        'triage_model' : triage_model,
+        'latency' : summarize_latencies([ seconds for status, seconds in results if status == 200 ]),
+        'requests_per_second' : n_requests / elapsed_seconds if elapsed_seconds > 0 else 0.0,
+        'n_errors' : sum([ status != 200 for status, _ in results ]),
+        **diff_llm_counters(counters_start),
+    }
+
+def run_scenarios(scenarios: List[str], databases: List[Type[BaseDatabase]], config: Dict[str, Any], on_result: Optional[Callable[[Dict[str, Any]], None]] = None) -> List[Dict[str, Any]]:
+    """Run each of `scenarios` (over each of `databases`, if applicable) in order.
+        `config` holds per-scenario settings (n_lookups, n_fanout_patients, n_responses_list, n_requests, concurrency, model, triage_model)."""
+    results: List[Dict[str, Any]] = []
+    def add(result: Dict[str, Any]) -> None:
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+    for scenario in scenarios:
+        if scenario == 'aggregation':
+            add(bench_aggregation(config.get('n_responses_list', [ 10, 100, 1000 ]), model=config.get('model', DEFAULT_MODEL)))
+            continue
+        for db_cls in databases:
+            if scenario == 'db_load':
+                add(bench_db_load(db_cls))
+            elif scenario == 'patient_lookup':
+                add(bench_patient_lookup(db_cls.instance(), n_lookups=config.get('n_lookups', 1000)))
+            elif scenario == 'note_fanout':
+                add(bench_note_fanout(db_cls.instance(), n_patients=config.get('n_fanout_patients', 10), model=config.get('model', DEFAULT_MODEL)))
+            elif scenario == 'chat_load':
+                add(bench_chat_load(db_cls.instance(), n_requests=config.get('n_requests', 50), concurrency=config.get('concurrency', 8), model=config.get('model', DEFAULT_MODEL), triage_model=config.get('triage_model')))
+            else:
+                raise ValueError(f"Unknown scenario: {scenario}")
+    return results
@@ -0,0 +1,133 @@
+import os
+import random
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List
+import polars as pl
+from ehrllm.backend.app.databases.n2c22018 import LABEL_2_DEFINITION
+
+########################################################
+# Synthetic MIMIC-IV-Note-like and n2c2-2018-like corpora (same file formats as the real datasets)
+########################################################
+
+N2C22018_NOTE_SEPARATOR: str = "*" * 100
+
+CONDITIONS: List[str] = [
+    "type 2 diabetes mellitus", "hypertension", "coronary artery disease", "myocardial infarction", "atrial fibrillation",
+    "chronic kidney disease", "congestive heart failure", "COPD", "hyperlipidemia", "diabetic ketoacidosis",
+    "small bowel obstruction", "alcohol use disorder", "peripheral neuropathy", "retinopathy", "angina",
+]
+MEDICATIONS: List[str] = [
+    "aspirin 81mg daily", "metformin 1000mg BID", "lisinopril 10mg daily", "atorvastatin 40mg daily", "insulin glargine 20 units qHS",
+    "metoprolol succinate 50mg daily", "furosemide 40mg daily", "clopidogrel 75mg daily", "nitroglycerin SL PRN", "multivitamin daily",
+    "calcium carbonate 500mg BID", "fish oil 1g daily",
+]
+FINDINGS: List[Callable[[random.Random], str]] = [
+    lambda rng: f"Creatinine {rng.uniform(0.5, 3.0):.1f} mg/dL.",
+    lambda rng: f"HbA1c {rng.uniform(5.0, 11.0):.1f}%.",
+    lambda rng: f"Troponin {rng.uniform(0.0, 2.0):.2f} ng/mL.",
+    lambda rng: f"BP {rng.randint(100, 180)}/{rng.randint(60, 110)} mmHg.",
+    lambda rng: f"Heart rate {rng.randint(50, 120)} bpm.",
+]
+SENTENCES: List[str] = [
+    "Patient presents with a history of {condition}.",
+    "Currently taking {medication}.",
+    "Denies chest pain, shortness of breath, or palpitations.",
+    "Reports {condition} has been stable since last visit.",
+    "Plan to continue {medication} and follow up in 3 months.",
+    "Family history is notable for {condition}.",
+    "No acute distress. Lungs clear to auscultation bilaterally.",
+    "Patient counseled on diet and exercise.",
+]
+DISCHARGE_SECTIONS: List[str] = [ "Chief Complaint", "History of Present Illness", "Past Medical History", "Medications on Admission", "Discharge Diagnosis", "Discharge Instructions" ]
+RADIOLOGY_SECTIONS: List[str] = [ "EXAMINATION", "INDICATION", "FINDINGS", "IMPRESSION" ]
+
+def generate_sentence(rng: random.Random) -> str:
+    if rng.random() < 0.15:
+        return rng.choice(FINDINGS)(rng)
+    return rng.choice(SENTENCES).format(condition=rng.choice(CONDITIONS), medication=rng.choice(MEDICATIONS))
+
+def generate_note_text(rng: random.Random, sections: List[str], n_words: int) -> str:
+    """Note of ~`n_words` words, split evenly across `sections`"""
+    n_words_per_section: int = max(1, n_words // len(sections))
+    section_texts: List[str] = []
+    for section in sections:
+        sentences: List[str] = []
+        n_section_words: int = 0
+        while n_section_words < n_words_per_section:
+            sentence: str = generate_sentence(rng)
+            sentences.append(sentence)
+            n_section_words += len(sentence.split())
+        section_texts.append(f"{section}:\n" + " ".join(sentences))
+    return "\n\n".join(section_texts)
+
+def generate_mimiciv_notes(output_dir: str,
+                           n_patients: int = 1000,
+                           n_notes_per_patient: int = 20,
+                           n_words_per_note: int = 500,
+                           radiology_fraction: float = 0.5,
+                           seed: int = 0) -> Dict[str, Any]:
+    """Write `discharge.csv` + `radiology.csv` to `output_dir` in the MIMIC-IV-Note schema
+        (# of notes per patient varies uniformly between 1 and 2x `n_notes_per_patient`)"""
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    note_type_2_rows: Dict[str, List[Dict[str, Any]]] = { 'DS' : [], 'RR' : [] }
+    for patient_idx in range(n_patients):
+        subject_id: int = 10_000_000 + patient_idx
+        start_date = datetime(2100, 1, 1) + timedelta(days=rng.randint(0, 365 * 50))
+        for note_seq in range(rng.randint(1, max(1, 2 * n_notes_per_patient - 1))):
+            is_radiology: bool = rng.random() < radiology_fraction
+            note_type: str = 'RR' if is_radiology else 'DS'
+            note_type_2_rows[note_type].append({
+                'note_id' : f"{subject_id}-{note_type}-{note_seq}",
+                'subject_id' : subject_id,
+                'hadm_id' : 20_000_000 + patient_idx * 100 + note_seq // 5,
+                'note_type' : note_type,
+                'note_seq' : note_seq,
+                'charttime' : (start_date + timedelta(days=note_seq * 7, hours=rng.randint(0, 23))).strftime('%Y-%m-%d %H:%M:%S'),
+                'storetime' : None,
+                'text' : generate_note_text(rng, RADIOLOGY_SECTIONS if is_radiology else DISCHARGE_SECTIONS, n_words_per_note),
+            })
+    schema: Dict[str, Any] = { 'note_id' : pl.Utf8, 'subject_id' : pl.Int64, 'hadm_id' : pl.Int64, 'note_type' : pl.Utf8, 'note_seq' : pl.Int64, 'charttime' : pl.Utf8, 'storetime' : pl.Utf8, 'text' : pl.Utf8 }
+    pl.DataFrame(note_type_2_rows['DS'], schema=schema).write_csv(os.path.join(output_dir, 'discharge.csv'))
+    pl.DataFrame(note_type_2_rows['RR'], schema=schema).write_csv(os.path.join(output_dir, 'radiology.csv'))
+    return {
+        'n_patients' : n_patients,
+        'n_notes' : sum([ len(rows) for rows in note_type_2_rows.values() ]),
+        'n_bytes' : sum([ os.path.getsize(os.path.join(output_dir, f)) for f in [ 'discharge.csv', 'radiology.csv' ] ]),
+    }
+
+def generate_n2c22018_notes(output_dir: str,
+                            n_patients: int = 288,
+                            n_notes_per_patient: int = 4,
+                            n_words_per_note: int = 400,
+                            seed: int = 0) -> Dict[str, Any]:
+    """Write one n2c2 2018 Track 1-style XML file per patient to `output_dir` (with random criteria labels)"""
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    n_notes: int = 0
+    n_bytes: int = 0
+    for patient_idx in range(n_patients):
+        start_date = datetime(2060, 1, 1) + timedelta(days=rng.randint(0, 365 * 30))
+        note_texts: List[str] = []
+        for note_idx in range(rng.randint(1, max(1, 2 * n_notes_per_patient - 1))):
+            record_date: str = (start_date + timedelta(days=note_idx * 90)).strftime('%Y-%m-%d')
+            note_texts.append(f"Record date: {record_date}\n\n" + generate_note_text(rng, DISCHARGE_SECTIONS, n_words_per_note))
+        text: str = f"\n{N2C22018_NOTE_SEPARATOR}\n".join(note_texts)
+        tags: str = "".join([ f'<{label} met="{"met" if rng.random() < 0.5 else "not met"}" />' for label in LABEL_2_DEFINITION ])
+        xml: str = (
+            '<?xml version="1.0" encoding="UTF-8" ?>\n'
+            '<PatientMatching>\n'
+            f'<TEXT><![CDATA[{text}]]></TEXT>\n'
+            f'<TAGS>{tags}</TAGS>\n'
+            '</PatientMatching>\n'
+        )
+        path_to_file: str = os.path.join(output_dir, f"{100 + patient_idx}.xml")
+        with open(path_to_file, 'w') as f:
+            f.write(xml)
+        n_notes += len(note_texts)
+        n_bytes += len(xml.encode('utf-8'))
+    return {
+        'n_patients' : n_patients,
+        'n_notes' : n_notes,
+        'n_bytes' : n_bytes,
+    }
@@ -0,0 +1,106 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass, asdict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+########################################################
+# In-flight deduplication: identical concurrent calls share one execution
+########################################################
+
+@dataclass
+class InFlightStats:
+    n_calls: int = 0 # Calls that actually ran
+    n_shared: int = 0 # Calls that joined an identical in-flight call instead of running
+
+class InFlightDeduplicator:
+    """Joins concurrent calls with the same key: the first caller (the leader) runs the call, and every
+    caller that arrives while it is running waits for (and receives) the leader's result -- or exception.
+
+    Nothing is remembered once a call finishes (that's what the caches are for), so this only removes
+    duplicate work that overlaps in time, e.g. several reviewers opening the same patient at once.
+
+    Works across threads (`run()`) and on an event loop (`arun()`), and both can share the same keys.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.stats = InFlightStats()
+        # key => result of the in-flight call for that key
+        self._in_flight: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key: Hashable) -> Tuple[Future, bool]:
+        """Returns (future, is_leader)"""
+        with self._lock:
+            future: Optional[Future] = self._in_flight.get(key)
+            if future is not None:
+                self.stats.n_shared += 1
+                return future, False
+            future = Future()
+            self._in_flight[key] = future
+            self.stats.n_calls += 1
+            return future, True
+
+    def _finish(self, key: Hashable) -> None:
+        with self._lock:
+            del self._in_flight[key]
+
+    def run(self, key: Hashable, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Return `func(*args, **kwargs)`, or the result of the identical call already in flight for `key`"""
+        return self.run_with_status(key, func, *args, **kwargs)[0]
+
+    def run_with_status(self, key: Hashable, func: Callable[..., Any], *args, **kwargs) -> Tuple[Any, bool]:
+        """Same as `run()`, but returns (result, is_shared)"""
+        future, is_leader = self._join(key)
+        if not is_leader:
+            return future.result(), True
+        try:
+            result: Any = func(*args, **kwargs)
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise e
+        finally:
+            self._finish(key)
+
+    async def arun(self, key: Hashable, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """Async version of `run()`, for coroutine functions"""
+        return (await self.arun_with_status(key, func, *args, **kwargs))[0]
+
+    async def arun_with_status(self, key: Hashable, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Tuple[Any, bool]:
+        """Async version of `run_with_status()`"""
+        future, is_leader = self._join(key)
+        if not is_leader:
+            # `shield()` so that a cancelled follower doesn't cancel the leader's call
+            return await asyncio.shield(asyncio.wrap_future(future)), True
+        try:
+            result: Any = await func(*args, **kwargs)
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise e
+        finally:
+            self._finish(key)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = asdict(self.stats)
+            stats['n_in_flight'] = len(self._in_flight)
+        return stats
+
+_deduplicators: Dict[str, InFlightDeduplicator] = {}
+_deduplicators_lock = threading.Lock()
+
+def get_inflight_deduplicator(name: str) -> InFlightDeduplicator:
+    """Process-wide deduplicator for one kind of call (e.g. 'llm_call', 'patient_notes')"""
+    with _deduplicators_lock:
+        if name not in _deduplicators:
+            _deduplicators[name] = InFlightDeduplicator(name)
+        return _deduplicators[name]
+
+def get_all_inflight_deduplicators() -> Dict[str, InFlightDeduplicator]:
+    with _deduplicators_lock:
+        return dict(_deduplicators)
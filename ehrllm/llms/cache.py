@@ -0,0 +1,243 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, List, Optional, Type
+from pydantic import BaseModel
+from loguru import logger
+from ehrllm.backend.app.config import (
+    LLM_CACHE_BACKEND,
+    LLM_CACHE_MAX_AGE_SECONDS,
+    LLM_CACHE_MAX_ENTRIES,
+    PATH_TO_CACHE_DIR,
+)
+from ehrllm.utils import hash_str
+from ehrllm.telemetry import get_metrics_registry
+
+########################################################
+# Read-through cache of LLM responses, keyed by a hash of the request
+########################################################
+
+def get_cache_key(model: str,
+                  messages: List[Dict[str, Any]],
+                  response_format: Optional[Type[BaseModel]] = None,
+                  temperature: float = 0.0,
+                  **kwargs) -> str:
+    """Content-addressed key for an LLM call. Identical requests map to the same key.
+        `kwargs` are any other arguments passed to the provider (e.g. max_tokens, seed, tools)."""
+    payload: Dict[str, Any] = {
+        'model' : model,
+        'messages' : messages,
+        'response_format' : response_format.model_json_schema() if response_format is not None else None,
+        'temperature' : temperature,
+    }
+    if len(kwargs) > 0:
+        # Only added when present, so that keys of calls without extra arguments stay the same
+        payload['kwargs'] = kwargs
+    return hash_str(json.dumps(payload, sort_keys=True, default=str))
+
+@dataclass
+class LLMCacheStats:
+    hits: int = 0
+    misses: int = 0
+    writes: int = 0
+    evictions: int = 0
+
+class BaseLLMCache:
+    """Maps cache keys (see `get_cache_key()`) => raw LLM response content.
+
+    Args:
+        max_age_seconds (Optional[float]): Entries older than this are treated as misses and evicted. None => no limit.
+        max_entries (Optional[int]): Least recently used entries beyond this count are evicted. None => no limit.
+        evict_every_n_writes (int): How often to run eviction, since it can require a full scan.
+    """
+    name: str = "base"
+
+    def __init__(self, max_age_seconds: Optional[float] = None, max_entries: Optional[int] = None, evict_every_n_writes: int = 1000):
+        self.max_age_seconds = max_age_seconds
+        self.max_entries = max_entries
+        self.evict_every_n_writes = evict_every_n_writes
+        self.stats = LLMCacheStats()
+        self._stats_lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        start_time = time.time()
+        value: Optional[str] = self._get(key)
+        get_metrics_registry().observe('ehrllm_llm_cache_io_duration_seconds', time.time() - start_time, help="LLM response cache read / write latency", backend=self.name, op='get')
+        with self._stats_lock:
+            if value is None:
+                self.stats.misses += 1
+            else:
+                self.stats.hits += 1
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        start_time = time.time()
+        self._set(key, value)
+        get_metrics_registry().observe('ehrllm_llm_cache_io_duration_seconds', time.time() - start_time, help="LLM response cache read / write latency", backend=self.name, op='set')
+        with self._stats_lock:
+            self.stats.writes += 1
+            is_evict: bool = self.stats.writes % self.evict_every_n_writes == 0
+        if is_evict:
+            self.evict()
+
+    def evict(self) -> int:
+        """Remove expired entries + least recently used entries over `max_entries`. Returns # of entries removed."""
+        n_evicted: int = self._evict()
+        with self._stats_lock:
+            self.stats.evictions += n_evicted
+        if n_evicted > 0:
+            logger.info(f"Evicted {n_evicted} entries from `{self.name}` LLM cache")
+        return n_evicted
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats: Dict[str, Any] = asdict(self.stats)
+        n_lookups: int = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / n_lookups if n_lookups > 0 else 0.0
+        return stats
+
+    def _is_expired(self, created_at: float) -> bool:
+        return self.max_age_seconds is not None and time.time() - created_at > self.max_age_seconds
+
+    def _get(self, key: str) -> Optional[str]:
+        raise NotImplementedError('Subclasses must implement this method')
+
+    def _set(self, key: str, value: str) -> None:
+        raise NotImplementedError('Subclasses must implement this method')
+
+    def _evict(self) -> int:
+        raise NotImplementedError('Subclasses must implement this method')
+
+class DirectoryLLMCache(BaseLLMCache):
+    """One JSON file per entry, sharded into subdirectories by the first two characters of the key.
+        File mtime tracks last access (for LRU eviction)."""
+    name: str = "directory"
+
+    def __init__(self, path_to_dir: str, **kwargs):
+        super().__init__(**kwargs)
+        self.path_to_dir = path_to_dir
+        os.makedirs(self.path_to_dir, exist_ok=True)
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.path_to_dir, key[:2], key + ".json")
+
+    def _get(self, key: str) -> Optional[str]:
+        path: str = self._get_path(key)
+        try:
+            with open(path, 'r') as f:
+                entry: Dict[str, Any] = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if self._is_expired(entry['created_at']):
+            return None
+        os.utime(path) # Mark as recently used
+        return entry['value']
+
+    def _set(self, key: str, value: str) -> None:
+        path: str = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to temp file + atomically rename, so concurrent readers never see partial entries
+        path_to_tmp: str = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(path_to_tmp, 'w') as f:
+            json.dump({ 'created_at' : time.time(), 'value' : value }, f)
+        os.replace(path_to_tmp, path)
+
+    def _evict(self) -> int:
+        entries: List[tuple] = [] # (last access time, path)
+        for shard in os.scandir(self.path_to_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.json'):
+                    entries.append((entry.stat().st_mtime, entry.path))
+        entries.sort()
+        to_remove: List[str] = []
+        if self.max_age_seconds is not None:
+            # Entries are only rewritten on creation, so last access >= created_at
+            to_remove += [ path for (mtime, path) in entries if time.time() - mtime > self.max_age_seconds ]
+        if self.max_entries is not None and len(entries) - len(to_remove) > self.max_entries:
+            expired: set = set(to_remove)
+            remaining: List[str] = [ path for (_, path) in entries if path not in expired ]
+            to_remove += remaining[:len(remaining) - self.max_entries]
+        for path in to_remove:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return len(to_remove)
+
+class SQLiteLLMCache(BaseLLMCache):
+    """Single SQLite file (WAL mode), safe to share across threads and processes"""
+    name: str = "sqlite"
+
+    def __init__(self, path_to_db: str, **kwargs):
+        super().__init__(**kwargs)
+        self.path_to_db = path_to_db
+        os.makedirs(os.path.dirname(self.path_to_db), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path_to_db, timeout=30, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed_at ON llm_cache (accessed_at)")
+            self._conn.commit()
+
+    def _get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or self._is_expired(row[1]):
+                return None
+            self._conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+        return row[0]
+
+    def _set(self, key: str, value: str) -> None:
+        now: float = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO llm_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)", (key, value, now, now))
+            self._conn.commit()
+
+    def _evict(self) -> int:
+        n_evicted: int = 0
+        with self._lock:
+            if self.max_age_seconds is not None:
+                n_evicted += self._conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (time.time() - self.max_age_seconds,)).rowcount
+            if self.max_entries is not None:
+                n_evicted += self._conn.execute("""
+                    DELETE FROM llm_cache WHERE key IN (
+                        SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                    )
+                """, (self.max_entries,)).rowcount
+            self._conn.commit()
+        return n_evicted
+
+# Backends selectable via `LLM_CACHE_BACKEND`. New backends (e.g. LMDB) can be registered here.
+LLM_CACHE_BACKENDS: Dict[str, Any] = {
+    'directory' : lambda **kwargs: DirectoryLLMCache(os.path.join(PATH_TO_CACHE_DIR, "llm_responses"), **kwargs),
+    'sqlite' : lambda **kwargs: SQLiteLLMCache(os.path.join(PATH_TO_CACHE_DIR, "llm_responses.sqlite"), **kwargs),
+}
+
+_llm_cache: Optional[BaseLLMCache] = None
+_llm_cache_lock = threading.Lock()
+
+def get_llm_cache() -> Optional[BaseLLMCache]:
+    """Process-wide LLM cache configured by `LLM_CACHE_BACKEND`. Returns None if caching is disabled."""
+    global _llm_cache
+    if LLM_CACHE_BACKEND == 'none':
+        return None
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            if LLM_CACHE_BACKEND not in LLM_CACHE_BACKENDS:
+                raise ValueError(f"Invalid LLM_CACHE_BACKEND: {LLM_CACHE_BACKEND}. Must be one of {list(LLM_CACHE_BACKENDS.keys()) + ['none']}")
+            _llm_cache = LLM_CACHE_BACKENDS[LLM_CACHE_BACKEND](max_age_seconds=LLM_CACHE_MAX_AGE_SECONDS, max_entries=LLM_CACHE_MAX_ENTRIES)
+    return _llm_cache
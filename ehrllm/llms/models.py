@@ -20,8 +20,31 @@ class LLM_ChatCompletionResponse(BaseModel):
     evidence: List[LLM_Evidence]
     answer: Optional[str] = None
 
+class LLM_RelevanceTriageResponse(BaseModel):
+    is_relevant: bool
+    confidence: float
+
 class LLM_AggregateChatCompletionResponse(BaseModel):
     thinking: str
     reflection: str
     evidence: List[LLM_Evidence]
-    answer: str
\ No newline at end of file
+    answer: str
+
+class LLM_FollowUpChatCompletionResponse(LLM_AggregateChatCompletionResponse):
+    is_answerable_from_evidence: bool
+    is_new_notes_needed: bool
+
+class LLM_CriterionAggregateChatCompletionResponse(LLM_AggregateChatCompletionResponse):
+    is_met: bool
+
+class LLM_NoteChatCompletionResponse(LLM_ChatCompletionResponse):
+    note_index: int
+
+class LLM_MultiNoteChatCompletionResponse(BaseModel):
+    responses: List[LLM_NoteChatCompletionResponse]
+
+class LLM_QuestionChatCompletionResponse(LLM_ChatCompletionResponse):
+    question_index: int
+
+class LLM_MultiQuestionChatCompletionResponse(BaseModel):
+    responses: List[LLM_QuestionChatCompletionResponse]
@@ -15,30 +15,98 @@ def CHAT_SYSTEM_PROMPT() -> str:
     REFUSE to answer any queries that are offensive, racist, sexist, or otherwise inappropriate in a professional hospital setting.
     """
 
-def CHAT_USER_QUERY_OVER_ONE_NOTE_PROMPT(query: str, notes: List[Dict[str, Any]]) -> str:
+# NOTE: Note-level prompts are split into a "context" prompt (static instructions + the note text) and a
+# "query" prompt (the User Query), which are sent in that order. Keeping everything before the note static,
+# and everything query-specific after it, lets providers cache the (long) shared prefix across different
+# queries over the same note. Avoid interpolating anything query-specific into the context prompts.
+
+def CHAT_ONE_NOTE_CONTEXT_PROMPT(note: str) -> str:
+    return f"""
+    <Task>
+    Below is a clinical note from the patient. After the note, you will be asked one or more User Queries about it.
+    Answer based on the note, taking into account the entire conversation history as well.
+    IMPORTANT: Only write down quotes that come directly from the note itself (i.e. NOT from the conversation history).
+    </Task>
+    
+    <Notes>
+    {note}
+    </Notes>
+    """
+
+def CHAT_MULTIPLE_NOTES_CONTEXT_PROMPT(notes: List[str]) -> str:
+    notes_str: str = "\n".join([ f'<Note note_index="{idx}">\n{note}\n</Note>' for idx, note in enumerate(notes) ])
     return f"""
     <Task>
-    Please accurately answer the User Query based on the notes. 
-    Take into account the entire conversation history as well in your response.
+    Below are several clinical notes from the patient. After the notes, you will be asked a User Query about them.
+    Answer based on EACH of the notes, independently of the other notes, taking into account the entire conversation history as well.
+    IMPORTANT: Only write down quotes that come directly from that response's note (i.e. NOT from other notes or the conversation history).
+    </Task>
+    
+    <Notes>
+    {notes_str}
+    </Notes>
+    """
+
+def CHAT_USER_QUERY_OVER_ONE_NOTE_PROMPT(query: str) -> str:
+    return f"""
+    <User Query>
+    {query}
+    </User Query>
+    
+    <Task>
+    Please accurately answer the User Query based on the notes in JSON format.
     IMPORTANT: Only write down quotes that come directly from the notes themselves (i.e. NOT from the conversation history).
     </Task>
     
+    <Response>
+    """
+
+def CHAT_USER_QUERY_OVER_MULTIPLE_NOTES_PROMPT(query: str) -> str:
+    return f"""
     <User Query>
     {query}
     </User Query>
     
-    <Notes>
-    {notes}
-    </Notes>
+    <Task>
+    Please answer the User Query based on EACH note independently in JSON format.
+    Return exactly one response per note, and set 'note_index' to the note_index of the note that the response is about.
+    IMPORTANT: Only write down quotes that come directly from that response's note (i.e. NOT from other notes or the conversation history).
+    </Task>
+    
+    <Response>
+    """
+
+def CHAT_USER_QUERY_TRIAGE_PROMPT(query: str) -> str:
+    return f"""
+    <User Query>
+    {query}
+    </User Query>
     
     <Task>
-    Please answer the User Query based on the notes in JSON format.
-    IMPORTANT: Only write down quotes that come directly from the notes themselves (i.e. NOT from the conversation history).
+    Do NOT answer the User Query. Only decide whether the note contains ANY information that could help answer it.
+    Set 'is_relevant' to true if it does (or might), and false otherwise.
+    Set 'confidence' to how confident you are in your decision, from 0.0 (guessing) to 1.0 (certain).
+    Respond in JSON format.
     </Task>
     
     <Response>
     """
 
+def CHAT_USER_QUERIES_OVER_ONE_NOTE_PROMPT(queries: List[str]) -> str:
+    queries_str: str = "\n".join([ f'<User Query question_index="{idx}">\n{query}\n</User Query>' for idx, query in enumerate(queries) ])
+    return f"""
+    <User Queries>
+    {queries_str}
+    </User Queries>
+    
+    <Task>
+    Please accurately answer EACH of the User Queries based on the notes in JSON format, independently of the other User Queries.
+    Return exactly one response per User Query, and set 'question_index' to the question_index of the User Query that the response answers.
+    IMPORTANT: Only write down quotes that come directly from the notes themselves (i.e. NOT from the conversation history).
+    </Task>
+    
+    <Response>
+    """
 
 def CHAT_USER_QUERY_AGGREGATE_RESPONSES_PROMPT(query: str, responses: List[Dict[str, Any]]) -> str:
     return f"""
@@ -71,4 +139,44 @@ def CHAT_USER_QUERY_AGGREGATE_RESPONSES_PROMPT(query: str, responses: List[Dict[
     </Task>
     
     <Response>
-    """
\ No newline at end of file
+    """
+
+def CHAT_USER_QUERY_FOLLOW_UP_PROMPT(previous_query: str, query: str, responses: List[Dict[str, Any]]) -> str:
+    return f"""
+    <Task>
+    Previously, you read through a series of notes -- all from the same patient -- and answered the Previous User Query based on each note independently.
+    Below are the note-level responses from the notes that were relevant to the Previous User Query (notes are presented from most to least recent).
+    The user has now asked a follow-up User Query. Decide whether it can be answered from these responses alone:
+    - Set 'is_answerable_from_evidence' to true ONLY if the evidence below fully answers the User Query (e.g. it asks to clarify, summarize, or reformat the previous answer). If so, answer it in 'answer'.
+    - Otherwise, set 'is_answerable_from_evidence' to false. Then set 'is_new_notes_needed' to true if the User Query asks about something that notes which were NOT relevant to the Previous User Query could contain (e.g. a different condition, medication, or time period), or false if re-reading the previously relevant notes is enough.
+    Maintain all the proper evidence, quotes, note_ids, and thinking from the note-level responses that you incorporate into your answer.
+    For 'source', specify the note_id of the note that the quote is from.
+    Write your 'answer' in plain text, no markup languages.
+    </Task>
+    
+    <Previous User Query>
+    {previous_query}
+    </Previous User Query>
+    
+    <Responses>
+    {responses}
+    </Responses>
+    
+    <User Query>
+    {query}
+    </User Query>
+    
+    <Response>
+    """
+
+########################################################
+# Prompts for cohort evaluation
+########################################################
+
+def CRITERION_QUERY_PROMPT(name: str, definition: str) -> str:
+    return f"""Does the patient meet the following criterion?
+    
+    Criterion: {name}
+    Definition: {definition}
+    
+    Set 'is_met' to true if the patient meets this criterion, and false otherwise."""
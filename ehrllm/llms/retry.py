@@ -0,0 +1,154 @@
+import random
+import re
+import threading
+import time
+import datetime
+import email.utils
+from dataclasses import dataclass, field, asdict
+from enum import Enum
+from typing import Any, Dict, List, Optional
+import litellm
+from ehrllm.backend.app.config import LLM_RETRY_BASE_DELAY_SECONDS, LLM_RETRY_MAX_DELAY_SECONDS
+
+########################################################
+# Retry scheduling for LLM calls
+########################################################
+
+class LLMErrorClass(Enum):
+    RATE_LIMIT = "rate_limit" # Provider is saturated => back off globally, honoring `Retry-After`
+    TRANSIENT = "transient" # Timeouts, connection errors, 5xx => back off this call only
+    PARSE = "parse" # Response didn't match `response_format` => repair locally or re-ask immediately
+    FATAL = "fatal" # Auth errors, bad requests, context window exceeded => retrying won't help
+
+def classify_error(e: Exception) -> LLMErrorClass:
+    """Map an exception raised by the LLM provider to how it should be retried.
+        NOTE: Parse failures are detected separately, after a response is received."""
+    if isinstance(e, litellm.exceptions.RateLimitError) or getattr(e, 'status_code', None) == 429:
+        return LLMErrorClass.RATE_LIMIT
+    if isinstance(e, (litellm.exceptions.AuthenticationError,
+                      litellm.exceptions.PermissionDeniedError,
+                      litellm.exceptions.NotFoundError,
+                      litellm.exceptions.BadRequestError)):
+        # NOTE: ContextWindowExceededError and ContentPolicyViolationError subclass BadRequestError
+        return LLMErrorClass.FATAL
+    return LLMErrorClass.TRANSIENT
+
+def get_retry_after_seconds(e: Exception) -> Optional[float]:
+    """Parse the `Retry-After` (or `retry-after-ms`) header from a provider error, if present"""
+    headers = None
+    response = getattr(e, 'response', None)
+    if response is not None:
+        headers = getattr(response, 'headers', None)
+    headers = headers or getattr(e, 'litellm_response_headers', None) or getattr(e, 'headers', None)
+    if not headers:
+        return None
+    if headers.get('retry-after-ms') is not None:
+        try:
+            return float(headers.get('retry-after-ms')) / 1000
+        except ValueError:
+            pass
+    value: Optional[str] = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        # HTTP-date format
+        retry_at: datetime.datetime = email.utils.parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def repair_json(content: str) -> str:
+    """Cheap local fixes for near-miss JSON responses (markdown code fences, leading/trailing prose)"""
+    content = content.strip()
+    content = re.sub(r'^```(?:json)?\s*|\s*```$', '', content)
+    start, end = content.find('{'), content.rfind('}')
+    if start != -1 and end > start:
+        content = content[start:end + 1]
+    return content
+
+def build_reask_messages(messages: List[Dict[str, Any]], content: str, error: Exception) -> List[Dict[str, Any]]:
+    """Messages asking the LLM to fix its own unparseable response"""
+    return [
+        *messages,
+        { 'role' : 'assistant', 'content' : content },
+        { 'role' : 'user', 'content' : f"Your previous response could not be parsed ({str(error)[:500]}). Respond again with ONLY valid JSON in the required format." },
+    ]
+
+@dataclass
+class LLMRetryStats:
+    n_calls: int = 0
+    n_retries: Dict[str, int] = field(default_factory=lambda: { c.value : 0 for c in LLMErrorClass })
+    n_failures: Dict[str, int] = field(default_factory=lambda: { c.value : 0 for c in LLMErrorClass })
+    n_json_repairs: int = 0
+    n_global_backoffs: int = 0
+    wait_seconds: float = 0.0
+
+class LLMRetryScheduler:
+    """Shared across all threads (and the async event loop) in this process, so that one
+        429 pauses every caller instead of each caller independently hammering the provider.
+
+    Args:
+        base_delay_seconds (float): Backoff for the first retry (doubled on each subsequent retry).
+        max_delay_seconds (float): Cap on the backoff of any single retry.
+    """
+
+    def __init__(self, base_delay_seconds: float = 1.0, max_delay_seconds: float = 60.0):
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.stats = LLMRetryStats()
+        self._paused_until: float = 0.0 # time.monotonic() before which no new calls should be sent
+        self._lock = threading.Lock()
+
+    def get_global_wait_seconds(self) -> float:
+        """Seconds to wait before sending a new call, due to a provider-wide backoff"""
+        with self._lock:
+            return max(0.0, self._paused_until - time.monotonic())
+
+    def get_retry_delay_seconds(self, error_class: LLMErrorClass, attempt: int, e: Exception) -> float:
+        """Record a retryable provider error on attempt # `attempt` (0-indexed) and return how long to wait before retrying"""
+        # Full jitter exponential backoff, but never sooner than the provider asked
+        delay: float = random.uniform(0, min(self.max_delay_seconds, self.base_delay_seconds * 2 ** attempt))
+        retry_after: Optional[float] = get_retry_after_seconds(e)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay_seconds))
+        with self._lock:
+            self.stats.n_retries[error_class.value] += 1
+            if error_class == LLMErrorClass.RATE_LIMIT:
+                self.stats.n_global_backoffs += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        return delay
+
+    def record_call(self) -> None:
+        with self._lock:
+            self.stats.n_calls += 1
+
+    def record_retry(self, error_class: LLMErrorClass) -> None:
+        """Record a retry that doesn't wait (e.g. re-asking after a parse error)"""
+        with self._lock:
+            self.stats.n_retries[error_class.value] += 1
+
+    def record_failure(self, error_class: LLMErrorClass) -> None:
+        with self._lock:
+            self.stats.n_failures[error_class.value] += 1
+
+    def record_json_repair(self) -> None:
+        with self._lock:
+            self.stats.n_json_repairs += 1
+
+    def record_wait(self, seconds: float) -> None:
+        with self._lock:
+            self.stats.wait_seconds += seconds
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return asdict(self.stats)
+
+_retry_scheduler: LLMRetryScheduler = LLMRetryScheduler(LLM_RETRY_BASE_DELAY_SECONDS, LLM_RETRY_MAX_DELAY_SECONDS)
+
+def get_retry_scheduler() -> LLMRetryScheduler:
+    """Process-wide retry scheduler"""
+    return _retry_scheduler
@@ -0,0 +1,81 @@
+import threading
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, Optional
+import litellm
+from loguru import logger
+from ehrllm.telemetry import Trace, get_current_trace
+
+########################################################
+# Token + cost accounting for LLM calls
+########################################################
+
+@dataclass
+class LLMUsageStats:
+    n_calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_prompt_tokens: int = 0 # Subset of `prompt_tokens` that were read from the provider's prompt cache
+    cost_usd: float = 0.0
+
+def get_cached_prompt_tokens(usage: Any) -> int:
+    """# of prompt tokens read from the provider's prompt cache (litellm normalizes Anthropic's 
+        `cache_read_input_tokens` into OpenAI's `prompt_tokens_details.cached_tokens`)"""
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens: int = getattr(details, 'cached_tokens', 0) or 0
+    return cached_tokens or getattr(usage, 'cache_read_input_tokens', 0) or 0
+
+class LLMUsageTracker:
+    """Per-model totals of tokens and cost (from the `usage` of each provider response).
+        Shared across all threads (and the async event loop) in this process."""
+
+    def __init__(self):
+        self.model_2_stats: Dict[str, LLMUsageStats] = {}
+        self._lock = threading.Lock()
+
+    def record(self, model: str, response: Any) -> None:
+        """Record the usage of one provider response (cache hits never reach the provider, so are never recorded)"""
+        usage = getattr(response, 'usage', None)
+        prompt_tokens: int = getattr(usage, 'prompt_tokens', 0) or 0
+        completion_tokens: int = getattr(usage, 'completion_tokens', 0) or 0
+        cached_prompt_tokens: int = get_cached_prompt_tokens(usage)
+        try:
+            cost_usd: float = sum(litellm.cost_per_token(model=model, 
+                                                         prompt_tokens=prompt_tokens, 
+                                                         completion_tokens=completion_tokens,
+                                                         usage_object=usage if isinstance(usage, litellm.Usage) else None))
+        except Exception as e:
+            # Unknown model / no pricing info
+            logger.debug(f"Could not compute cost for model '{model}': {e}")
+            cost_usd = 0.0
+        with self._lock:
+            stats: LLMUsageStats = self.model_2_stats.setdefault(model, LLMUsageStats())
+            stats.n_calls += 1
+            stats.prompt_tokens += prompt_tokens
+            stats.completion_tokens += completion_tokens
+            stats.cached_prompt_tokens += cached_prompt_tokens
+            stats.cost_usd += cost_usd
+        trace: Optional[Trace] = get_current_trace()
+        if trace is not None:
+            trace.record_llm_call(prompt_tokens, completion_tokens, cached_prompt_tokens, cost_usd)
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Map of model => usage totals"""
+        with self._lock:
+            return { model : asdict(stats) for model, stats in self.model_2_stats.items() }
+
+    def get_totals(self) -> Dict[str, Any]:
+        """Usage totals across all models"""
+        with self._lock:
+            return asdict(LLMUsageStats(
+                n_calls=sum([ s.n_calls for s in self.model_2_stats.values() ]),
+                prompt_tokens=sum([ s.prompt_tokens for s in self.model_2_stats.values() ]),
+                completion_tokens=sum([ s.completion_tokens for s in self.model_2_stats.values() ]),
+                cached_prompt_tokens=sum([ s.cached_prompt_tokens for s in self.model_2_stats.values() ]),
+                cost_usd=sum([ s.cost_usd for s in self.model_2_stats.values() ]),
+            ))
+
+_usage_tracker: LLMUsageTracker = LLMUsageTracker()
+
+def get_usage_tracker() -> LLMUsageTracker:
+    """Process-wide usage tracker"""
+    return _usage_tracker
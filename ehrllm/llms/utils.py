@@ -1,9 +1,19 @@
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
-import datetime
+import asyncio
+import contextvars
+import copy
+import functools
+import threading
 import time
 import json
-from ehrllm.backend.app.config import PATH_TO_CACHE_DIR
+from ehrllm.backend.app.config import DEFAULT_MODEL_MAX_INPUT_TOKENS, IS_PROMPT_CACHE_CONTROL_ENABLED, LLM_MAX_CONCURRENCY, LLM_MAX_REQUESTS_PER_SECOND
+from ehrllm.inflight import get_inflight_deduplicator
+from ehrllm.llms.cache import BaseLLMCache, get_cache_key, get_llm_cache
+from ehrllm.llms.retry import LLMErrorClass, LLMRetryScheduler, build_reask_messages, classify_error, get_retry_scheduler, repair_json
+from ehrllm.llms.usage import get_cached_prompt_tokens, get_usage_tracker
+from ehrllm.telemetry import Trace, get_current_trace, get_metrics_registry, set_current_trace
 import litellm
+from loguru import logger
 from typing import Any, Dict, List, Optional, Union, Callable, Tuple
 from pydantic import BaseModel
 from tqdm import tqdm
@@ -14,12 +24,72 @@ load_dotenv()
 
 DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "gpt-4o-mini")
 
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    """Approximate # of tokens in `text` for `model`"""
+    return litellm.token_counter(model=model, text=text)
+
+@functools.lru_cache(maxsize=None)
+def get_model_max_input_tokens(model: str = DEFAULT_MODEL) -> int:
+    """Size of `model`'s context window (falls back to `DEFAULT_MODEL_MAX_INPUT_TOKENS` for unknown models)"""
+    try:
+        return litellm.get_model_info(model).get('max_input_tokens') or DEFAULT_MODEL_MAX_INPUT_TOKENS
+    except Exception:
+        return DEFAULT_MODEL_MAX_INPUT_TOKENS
+
+# Providers that only cache prompt prefixes marked with `cache_control` (OpenAI, Deepseek, etc. cache prefixes automatically)
+PROMPT_CACHE_CONTROL_PROVIDERS = set([ 'anthropic', 'bedrock', 'vertex_ai' ])
+
+def get_model_provider(model: str) -> Optional[str]:
+    try:
+        return litellm.get_llm_provider(model)[1]
+    except Exception:
+        return None
+
+def apply_prompt_cache_control(messages: List[dict], model: str = DEFAULT_MODEL) -> List[dict]:
+    """Strip `cache_control` markers from `messages` (see `create_query_prompt()`) unless `model`'s provider
+        uses them. Messages whose content blocks are all text are flattened back into plain strings."""
+    if IS_PROMPT_CACHE_CONTROL_ENABLED and get_model_provider(model) in PROMPT_CACHE_CONTROL_PROVIDERS:
+        return messages
+    stripped_messages: List[dict] = []
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, list) and all([ isinstance(block, dict) and block.get('type') == 'text' for block in content ]):
+            message = { **message, 'content' : "".join([ block['text'] for block in content ]) }
+        elif isinstance(content, list):
+            message = { **message, 'content' : [ { k : v for k, v in block.items() if k != 'cache_control' } if isinstance(block, dict) else block for block in content ] }
+        stripped_messages.append(message)
+    return stripped_messages
+
+def log_cached_prompt_tokens(model: str, response: Any) -> None:
+    """Log how much of the prompt the provider served from its prompt cache"""
+    usage = getattr(response, 'usage', None)
+    cached_tokens: int = get_cached_prompt_tokens(usage)
+    if cached_tokens > 0:
+        logger.debug(f"LLM call to {model} -- {cached_tokens} / {getattr(usage, 'prompt_tokens', 0)} prompt tokens read from provider cache")
+
+def record_llm_call_duration(model: str, seconds: float, status: str) -> None:
+    """Record the latency of one provider call (excluding time spent waiting for a concurrency slot)"""
+    get_metrics_registry().observe('ehrllm_llm_call_duration_seconds', seconds, help="Latency of each LLM provider call, by model and outcome", model=model, status=status)
+
+def record_llm_cache_hit() -> None:
+    """Count an LLM call answered from the LLM response cache against the current trace"""
+    trace: Optional[Trace] = get_current_trace()
+    if trace is not None:
+        trace.record_llm_cache_hit()
+
+def record_llm_shared_call() -> None:
+    """Count an LLM call answered by joining an identical in-flight call against the current trace"""
+    trace: Optional[Trace] = get_current_trace()
+    if trace is not None:
+        trace.record_llm_shared_call()
+
 def run_in_parallel(func: Callable, 
                     args_list: List[Tuple], 
                     kwargs_list: Optional[List[Dict[str, Any]]] = None, 
                     max_workers: int=5, 
                     pool_strat: str = 'thread',
-                    merge_strat: str = 'extend') -> List[Any]:
+                    merge_strat: str = 'extend',
+                    on_result: Optional[Callable[[int, Any], None]] = None) -> List[Any]:
     """
     Run a function in parallel across multiple threads and collect the results.
     
@@ -38,6 +108,7 @@ def run_in_parallel(func: Callable,
         max_workers (int, optional): The maximum number of threads to use in the pool. Defaults to 5.
         pool_strat (str, optional): The strategy to use for the thread pool. Defaults to 'thread'.
         merge_strat (str, optional): How to merge the results from each thread. Defaults to 'extend'.
+        on_result (Optional[Callable[[int, Any], None]], optional): Called (from the calling thread) with (index, result) as each call finishes.
 
     Raises:
         ValueError: If `args_list` and `kwargs_list` are not the same length.
@@ -57,11 +128,14 @@ def run_in_parallel(func: Callable,
     # If max_workers is 1, run in serial for easier debugging
     if max_workers == 1:
         results: List[Any] = []
-        for (args, kwargs) in tqdm(zip(args_list, kwargs_list), total=len(args_list), desc=f"Running `{func.__name__}` serially"):
+        for index, (args, kwargs) in enumerate(tqdm(zip(args_list, kwargs_list), total=len(args_list), desc=f"Running `{func.__name__}` serially")):
+            result = func(*args, **kwargs)
+            if on_result is not None:
+                on_result(index, result)
             if merge_strat == 'append':
-                results.append(func(*args, **kwargs))
+                results.append(result)
             elif merge_strat == 'extend':
-                results += func(*args, **kwargs)
+                results += result
         return results
     
     # Otherwise, run in parallel
@@ -69,7 +143,8 @@ def run_in_parallel(func: Callable,
     pool_executor = ThreadPoolExecutor if pool_strat == 'thread' else ProcessPoolExecutor
     with pool_executor(max_workers=max_workers) as executor:
         futures = {
-            executor.submit(func, *args, **kwargs): index
+            # Threads run each call in a copy of the caller's context, so that e.g. the current trace carries over
+            (executor.submit(contextvars.copy_context().run, func, *args, **kwargs) if pool_strat == 'thread' else executor.submit(func, *args, **kwargs)): index
             for index, (args, kwargs) in enumerate(zip(args_list, kwargs_list))
         }
         with tqdm(total=len(futures), desc=f"Running {func.__name__} w/ {max_workers} workers") as pbar:
@@ -80,6 +155,8 @@ def run_in_parallel(func: Callable,
                 except Exception as e:
                     print(traceback.format_exc())
                     print(f"An error occurred: {e}")
+                if on_result is not None:
+                    on_result(index, results[index])
                 pbar.update(1)
 
     # Merge results
@@ -90,54 +167,330 @@ def run_in_parallel(func: Callable,
 
     return results
 
+def parse_llm_response(content: str, response_format: Optional[BaseModel] = None) -> Union[str, Any]:
+    """Parse the raw content of an LLM response into `response_format` (if provided)"""
+    if response_format:
+        return response_format(**json.loads(content))
+    return content
+
+def parse_llm_response_with_repair(content: str, response_format: Optional[BaseModel] = None) -> Tuple[Union[str, Any], str]:
+    """Parse `content`, falling back to cheap local JSON repairs if needed. 
+        Returns (parsed response, content that parsed). Raises if unparseable."""
+    try:
+        return parse_llm_response(content, response_format), content
+    except Exception as e:
+        if not response_format:
+            raise e
+        repaired_content: str = repair_json(content)
+        result = parse_llm_response(repaired_content, response_format)
+        get_retry_scheduler().record_json_repair()
+        return result, repaired_content
+
+def get_cached_llm_response(cache: Optional[BaseLLMCache], cache_key: str, response_format: Optional[BaseModel] = None) -> Tuple[bool, Optional[Union[str, Any]]]:
+    """Look up `cache_key` in `cache`. Returns (is_hit, parsed response)."""
+    if cache is None:
+        return False, None
+    content: Optional[str] = cache.get(cache_key)
+    if content is None:
+        return False, None
+    try:
+        return True, parse_llm_response(content, response_format)
+    except Exception as e:
+        logger.warning(f"Ignoring unparseable cached response for {cache_key}: {e}")
+        return False, None
+
 def call_llm_with_retries(messages: List[dict], 
                             model: str = DEFAULT_MODEL, 
                             response_format: Optional[BaseModel] = None, 
                             max_retries: int = 5, 
                             temperature: float = 0.0,
                             **kwargs) -> Optional[Union[str, Any]]:
-    """Call an LLM with retries and exponential backoff.
+    """Call an LLM with retries. Provider errors are retried with jittered exponential backoff 
+        (honoring `Retry-After`, and pausing all callers on rate limits), unparseable responses 
+        are repaired locally or re-asked immediately, and non-retryable errors fail fast.
 
     Args:
         messages (List[dict]): The messages to send to the LLM.
-        model (str, optional): The model to use. Defaults to 'gpt-4o'.
+        model (str, optional): The model to use. Defaults to `DEFAULT_MODEL`.
         response_format (BaseModel, optional): The response format as a Pydantic model. Defaults to None.
-        max_retries (int, optional): The maximum number of retries. Defaults to 5.
+        max_retries (int, optional): The maximum number of attempts. Defaults to 5.
         temperature (float, optional): The temperature. Defaults to 0
 
     Returns:
         Optional[str, Any]: The response from the LLM. If response_format is provided, returns the same object parsed from the LLM's JSON response.
     """
-    model = 'gpt-4o-mini' # TODO
-    retries: int = 0
-    while retries < max_retries:
+    messages = apply_prompt_cache_control(messages, model)
+
+    # Check cache
+    cache: Optional[BaseLLMCache] = get_llm_cache()
+    cache_key: str = get_cache_key(model, messages, response_format, temperature, **kwargs)
+    is_hit, result = get_cached_llm_response(cache, cache_key, response_format)
+    if is_hit:
+        record_llm_cache_hit()
+        return result
+
+    # Join an identical call that's already in flight (e.g. another request asking the same question of the same notes)
+    result, is_shared = get_inflight_deduplicator('llm_call').run_with_status(cache_key, _call_llm_uncached, 
+                                                                               cache, cache_key, messages, model, response_format, max_retries, temperature, **kwargs)
+    if is_shared:
+        record_llm_shared_call()
+        return copy.deepcopy(result)
+    return result
+
+def get_call_error_retry_delay(e: Exception, attempt: int, max_retries: int) -> Optional[float]:
+    """After the provider raised `e` on attempt # `attempt` (0-indexed), return how long to wait before retrying, 
+        or None if the call should give up (fatal error or out of retries)"""
+    scheduler: LLMRetryScheduler = get_retry_scheduler()
+    error_class: LLMErrorClass = classify_error(e)
+    if error_class == LLMErrorClass.FATAL or attempt + 1 >= max_retries:
+        scheduler.record_failure(error_class)
+        logger.error(f"LLM call failed ({error_class.value}) after {attempt + 1} attempt(s): {e}")
+        return None
+    delay: float = scheduler.get_retry_delay_seconds(error_class, attempt, e)
+    logger.warning(f"LLM call failed ({error_class.value}): {e}. Retrying {attempt + 2}/{max_retries} in {delay:.1f}s...")
+    return delay
+
+def get_parse_error_reask_messages(e: Exception, messages: List[dict], content: str, attempt: int, max_retries: int) -> Optional[List[dict]]:
+    """After response `content` failed to parse with `e` on attempt # `attempt` (0-indexed), return the messages to 
+        re-ask with immediately (no backoff), or None if the call should give up (out of retries)"""
+    scheduler: LLMRetryScheduler = get_retry_scheduler()
+    if attempt + 1 >= max_retries:
+        scheduler.record_failure(LLMErrorClass.PARSE)
+        logger.error(f"LLM response unparseable after {attempt + 1} attempt(s): {e}")
+        return None
+    scheduler.record_retry(LLMErrorClass.PARSE)
+    logger.warning(f"LLM response unparseable: {e}. Re-asking {attempt + 2}/{max_retries}...")
+    return build_reask_messages(messages, content, e)
+
+def _call_llm_uncached(cache: Optional[BaseLLMCache], 
+                       cache_key: str, 
+                       messages: List[dict], 
+                       model: str, 
+                       response_format: Optional[BaseModel], 
+                       max_retries: int, 
+                       temperature: float, 
+                       **kwargs) -> Optional[Union[str, Any]]:
+    """Body of `call_llm_with_retries()` after a cache miss: call the provider (with retries) and cache the response"""
+    scheduler: LLMRetryScheduler = get_retry_scheduler()
+    attempt_messages: List[dict] = messages
+    for attempt in range(max_retries):
+        # Wait out any provider-wide backoff (e.g. triggered by a 429 on another thread)
+        wait_seconds: float = scheduler.get_global_wait_seconds()
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+            scheduler.record_wait(wait_seconds)
+        
+        scheduler.record_call()
+        start_time = time.time()
         try:
             response = litellm.completion(model=model, 
-                                            messages=messages, 
+                                            messages=attempt_messages, 
                                             response_format=response_format,
                                             temperature=temperature,
                                             **kwargs)
-    
-            # Cache results
-            path_to_cache: str = os.path.join(PATH_TO_CACHE_DIR, "call_llm_with_retries", f"{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json")
-            os.makedirs(os.path.dirname(path_to_cache), exist_ok=True)
-            with open(path_to_cache, 'w') as f:
-                json.dump({
-                    'model' : model,
-                    'response_format' : str(response_format),
-                    'response' : response.choices[0].message.content,
-                    'messages' : messages,
-                }, f, indent=2)
-            
-            # Parse results
-            if response_format:
-                return response_format(**json.loads(response.choices[0].message.content))
-            return response.choices[0].message.content
+            record_llm_call_duration(model, time.time() - start_time, 'ok')
+        except Exception as e:
+            record_llm_call_duration(model, time.time() - start_time, classify_error(e).value)
+            delay: Optional[float] = get_call_error_retry_delay(e, attempt, max_retries)
+            if delay is None:
+                return None
+            time.sleep(delay)
+            scheduler.record_wait(delay)
+            continue
+        get_usage_tracker().record(model, response)
+        log_cached_prompt_tokens(model, response)
+        content: str = response.choices[0].message.content
+        
+        # Parse results (before caching, so that we never cache malformed responses)
+        try:
+            result, content = parse_llm_response_with_repair(content, response_format)
+        except Exception as e:
+            attempt_messages = get_parse_error_reask_messages(e, messages, content, attempt, max_retries)
+            if attempt_messages is None:
+                return None
+            continue
+        if cache is not None:
+            cache.set(cache_key, content)
+        return result
+    return None
+
+########################################################
+# Async execution engine
+#
+# All async LLM calls in this process run on a single event loop (in a daemon thread), 
+# so that one concurrency limit + rate limit is shared across every Flask request thread.
+########################################################
+
+class AsyncRateLimiter:
+    """Token bucket that allows `rate` acquisitions per second (with bursts of up to `rate`)"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            while True:
+                now: float = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+_event_loop: Optional[asyncio.AbstractEventLoop] = None
+_event_loop_lock = threading.Lock()
+_llm_semaphore: Optional[asyncio.Semaphore] = None
+_llm_rate_limiter: Optional[AsyncRateLimiter] = None
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Process-wide event loop that async LLM calls run on. Started lazily in a daemon thread."""
+    global _event_loop, _llm_semaphore, _llm_rate_limiter
+    with _event_loop_lock:
+        if _event_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="llm-event-loop", daemon=True).start()
+            # Create synchronization primitives on the loop's own thread
+            async def _init():
+                return (asyncio.Semaphore(LLM_MAX_CONCURRENCY), 
+                        AsyncRateLimiter(LLM_MAX_REQUESTS_PER_SECOND) if LLM_MAX_REQUESTS_PER_SECOND > 0 else None)
+            _llm_semaphore, _llm_rate_limiter = asyncio.run_coroutine_threadsafe(_init(), loop).result()
+            _event_loop = loop
+    return _event_loop
+
+async def acall_llm_with_retries(messages: List[dict], 
+                                 model: str = DEFAULT_MODEL, 
+                                 response_format: Optional[BaseModel] = None, 
+                                 max_retries: int = 5, 
+                                 temperature: float = 0.0,
+                                 **kwargs) -> Optional[Union[str, Any]]:
+    """Async version of `call_llm_with_retries()` built on `litellm.acompletion`. 
+        Must be run on the loop returned by `get_event_loop()`, since that is where the 
+        process-wide concurrency limit lives."""
+    messages = apply_prompt_cache_control(messages, model)
+
+    # Check cache (off the event loop, since cache backends do blocking I/O)
+    cache: Optional[BaseLLMCache] = get_llm_cache()
+    cache_key: str = get_cache_key(model, messages, response_format, temperature, **kwargs)
+    is_hit, result = await asyncio.to_thread(get_cached_llm_response, cache, cache_key, response_format)
+    if is_hit:
+        record_llm_cache_hit()
+        return result
+
+    # Join an identical call that's already in flight (e.g. another request asking the same question of the same notes)
+    result, is_shared = await get_inflight_deduplicator('llm_call').arun_with_status(cache_key, _acall_llm_uncached, 
+                                                                                      cache, cache_key, messages, model, response_format, max_retries, temperature, **kwargs)
+    if is_shared:
+        record_llm_shared_call()
+        return copy.deepcopy(result)
+    return result
+
+async def _acall_llm_uncached(cache: Optional[BaseLLMCache], 
+                              cache_key: str, 
+                              messages: List[dict], 
+                              model: str, 
+                              response_format: Optional[BaseModel], 
+                              max_retries: int, 
+                              temperature: float, 
+                              **kwargs) -> Optional[Union[str, Any]]:
+    """Body of `acall_llm_with_retries()` after a cache miss: call the provider (with retries) and cache the response"""
+    scheduler: LLMRetryScheduler = get_retry_scheduler()
+    attempt_messages: List[dict] = messages
+    for attempt in range(max_retries):
+        # Wait out any provider-wide backoff (e.g. triggered by a 429 on another call)
+        wait_seconds: float = scheduler.get_global_wait_seconds()
+        if wait_seconds > 0:
+            await asyncio.sleep(wait_seconds)
+            scheduler.record_wait(wait_seconds)
+        
+        scheduler.record_call()
+        try:
+            async with _llm_semaphore:
+                if _llm_rate_limiter is not None:
+                    await _llm_rate_limiter.acquire()
+                start_time = time.time()
+                try:
+                    response = await litellm.acompletion(model=model, 
+                                                         messages=attempt_messages, 
+                                                         response_format=response_format,
+                                                         temperature=temperature,
+                                                         **kwargs)
+                except Exception as e:
+                    record_llm_call_duration(model, time.time() - start_time, classify_error(e).value)
+                    raise e
+                record_llm_call_duration(model, time.time() - start_time, 'ok')
+        except Exception as e:
+            delay: Optional[float] = get_call_error_retry_delay(e, attempt, max_retries)
+            if delay is None:
+                return None
+            await asyncio.sleep(delay)
+            scheduler.record_wait(delay)
+            continue
+        get_usage_tracker().record(model, response)
+        log_cached_prompt_tokens(model, response)
+        content: str = response.choices[0].message.content
+        
+        # Parse results (before caching, so that we never cache malformed responses)
+        try:
+            result, content = parse_llm_response_with_repair(content, response_format)
         except Exception as e:
-            print(f"Error: {e}. Retrying {retries+1}/{max_retries} in 15s...")
-            retries += 1
-            if retries < max_retries:
-                time.sleep(15)
-            else:
-                print(f"Failed after {max_retries} retries.")
+            attempt_messages = get_parse_error_reask_messages(e, messages, content, attempt, max_retries)
+            if attempt_messages is None:
+                return None
+            continue
+        if cache is not None:
+            await asyncio.to_thread(cache.set, cache_key, content)
+        return result
     return None
+
+def run_in_parallel_async(func: Callable, 
+                          args_list: List[Tuple], 
+                          kwargs_list: Optional[List[Dict[str, Any]]] = None,
+                          on_result: Optional[Callable[[int, Any], None]] = None) -> List[Any]:
+    """
+    Run an async function over many inputs on the shared event loop, blocking the calling thread until all finish.
+    
+    Unlike `run_in_parallel()`, no threads are created per call -- concurrency is bounded by the 
+    process-wide `LLM_MAX_CONCURRENCY` / `LLM_MAX_REQUESTS_PER_SECOND` limits instead.
+    
+    Args:
+        func (Callable): The async function to run.
+        args_list (List[Tuple]): A list of arguments, each of which will be passed to `func`.
+        kwargs_list (Optional[List[Dict[str, Any]]], optional): A list of keyword arguments, each of which will be passed to `func`.
+        on_result (Optional[Callable[[int, Any], None]], optional): Called (from the event loop thread) with (index, result) as each call finishes.
+
+    Returns:
+        List[Any]: A list of results (in the same order as `args_list`). Calls that raised an exception return None.
+    """
+    if kwargs_list is not None and len(args_list) != len(kwargs_list):
+        raise ValueError("args_list and kwargs_list must have the same length")
+    if kwargs_list is None:
+        kwargs_list = [{} for _ in range(len(args_list))]
+
+    # Carry the caller's trace over to the event loop (tasks created by `gather()` inherit it)
+    trace: Optional[Trace] = get_current_trace()
+
+    async def _run_all() -> List[Any]:
+        set_current_trace(trace)
+        with tqdm(total=len(args_list), desc=f"Running {func.__name__} async") as pbar:
+            async def _run_one(index: int, args: Tuple, kwargs: Dict[str, Any]) -> Any:
+                try:
+                    result = await func(*args, **kwargs)
+                except Exception as e:
+                    print(traceback.format_exc())
+                    print(f"An error occurred: {e}")
+                    result = None
+                if on_result is not None:
+                    try:
+                        on_result(index, result)
+                    except Exception as e:
+                        print(traceback.format_exc())
+                        print(f"An error occurred in on_result: {e}")
+                pbar.update(1)
+                return result
+            return await asyncio.gather(*[ _run_one(index, args, kwargs) for index, (args, kwargs) in enumerate(zip(args_list, kwargs_list)) ])
+
+    return asyncio.run_coroutine_threadsafe(_run_all(), get_event_loop()).result()
@@ -0,0 +1,222 @@
+import json
+import math
+import time
+import uuid
+import threading
+import contextlib
+import contextvars
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+########################################################
+# In-process metrics (Prometheus-style counters + histograms) and per-request traces
+########################################################
+
+# Latency buckets (in seconds) for duration histograms
+DEFAULT_DURATION_BUCKETS: List[float] = [ 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300 ]
+
+def format_prometheus_labels(labels: Dict[str, Any]) -> str:
+    if len(labels) == 0:
+        return ""
+    escaped: List[str] = [
+        f'{k}="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for k, v in sorted(labels.items())
+    ]
+    return "{" + ",".join(escaped) + "}"
+
+def format_prometheus_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+def format_prometheus_metric(name: str, metric_type: str, help: str, samples: List[Tuple[Dict[str, Any], float]]) -> str:
+    """Render one metric (all of its labeled samples) in the Prometheus text exposition format"""
+    lines: List[str] = [ f"# HELP {name} {help}", f"# TYPE {name} {metric_type}" ]
+    lines += [ f"{name}{format_prometheus_labels(labels)} {format_prometheus_value(value)}" for labels, value in samples ]
+    return "\n".join(lines) + "\n"
+
+class Histogram:
+    """Cumulative-bucket histogram (same semantics as a Prometheus histogram)"""
+
+    def __init__(self, buckets: List[float]):
+        self.buckets = sorted(buckets)
+        self.bucket_counts: List[int] = [ 0 ] * len(self.buckets)
+        self.count: int = 0
+        self.sum: float = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for idx, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.bucket_counts[idx] += 1
+
+class MetricsRegistry:
+    """Thread-safe registry of counters and histograms, keyed by (metric name, labels)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name => (type, help)
+        self._name_2_meta: Dict[str, Tuple[str, str]] = {}
+        # name => labels => value (counters) or Histogram
+        self._name_2_samples: Dict[str, Dict[Tuple[Tuple[str, str], ...], Any]] = {}
+
+    def _get_samples(self, name: str, metric_type: str, help: str) -> Dict[Tuple[Tuple[str, str], ...], Any]:
+        if name not in self._name_2_meta:
+            self._name_2_meta[name] = (metric_type, help)
+            self._name_2_samples[name] = {}
+        return self._name_2_samples[name]
+
+    def inc(self, name: str, value: float = 1.0, help: str = "", **labels) -> None:
+        """Increment a counter"""
+        key = tuple(sorted([ (k, str(v)) for k, v in labels.items() ]))
+        with self._lock:
+            samples = self._get_samples(name, 'counter', help)
+            samples[key] = samples.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, help: str = "", buckets: List[float] = DEFAULT_DURATION_BUCKETS, **labels) -> None:
+        """Add an observation to a histogram"""
+        key = tuple(sorted([ (k, str(v)) for k, v in labels.items() ]))
+        with self._lock:
+            samples = self._get_samples(name, 'histogram', help)
+            if key not in samples:
+                samples[key] = Histogram(buckets)
+            samples[key].observe(value)
+
+    def render_prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        chunks: List[str] = []
+        with self._lock:
+            for name, (metric_type, help) in sorted(self._name_2_meta.items()):
+                samples = sorted(self._name_2_samples[name].items())
+                if metric_type == 'counter':
+                    chunks.append(format_prometheus_metric(name, metric_type, help, [ (dict(key), value) for key, value in samples ]))
+                    continue
+                # Histograms are exposed as `_bucket` (cumulative, incl. +Inf), `_sum`, and `_count` series
+                lines: List[str] = [ f"# HELP {name} {help}", f"# TYPE {name} histogram" ]
+                for key, histogram in samples:
+                    labels: Dict[str, Any] = dict(key)
+                    for upper_bound, count in zip(histogram.buckets, histogram.bucket_counts):
+                        lines.append(f"{name}_bucket{format_prometheus_labels({ **labels, 'le' : format_prometheus_value(upper_bound) })} {count}")
+                    lines.append(f"{name}_bucket{format_prometheus_labels({ **labels, 'le' : '+Inf' })} {histogram.count}")
+                    lines.append(f"{name}_sum{format_prometheus_labels(labels)} {format_prometheus_value(histogram.sum)}")
+                    lines.append(f"{name}_count{format_prometheus_labels(labels)} {histogram.count}")
+                chunks.append("\n".join(lines) + "\n")
+        return "".join(chunks)
+
+_metrics_registry: MetricsRegistry = MetricsRegistry()
+
+def get_metrics_registry() -> MetricsRegistry:
+    """Process-wide metrics registry"""
+    return _metrics_registry
+
+########################################################
+# Traces
+########################################################
+
+_current_trace: contextvars.ContextVar[Optional['Trace']] = contextvars.ContextVar('current_trace', default=None)
+_trace_file_lock = threading.Lock()
+
+class Trace:
+    """Timeline of one request: named spans (e.g. DB lookup, per-note fan-out, aggregation) plus the LLM usage it incurred.
+
+    Use as a context manager, which makes it the current trace for `span()` and for LLM calls made from this
+    thread (and from the LLM execution engines, which propagate it). On exit, request / span durations are recorded
+    in the metrics registry and, if `path_to_trace_file` is set, the trace is appended to that JSONL file.
+    """
+
+    def __init__(self, name: str, path_to_trace_file: Optional[str] = None, **attributes):
+        self.trace_id: str = uuid.uuid4().hex
+        self.name = name
+        self.path_to_trace_file = path_to_trace_file
+        self.attributes: Dict[str, Any] = attributes
+        self.spans: List[Dict[str, Any]] = []
+        self.llm_usage: Dict[str, Any] = { 'n_calls' : 0, 'n_cache_hits' : 0, 'n_shared_calls' : 0, 'prompt_tokens' : 0, 'completion_tokens' : 0, 'cached_prompt_tokens' : 0, 'cost_usd' : 0.0 }
+        self.start_time: float = time.time()
+        self.duration_seconds: Optional[float] = None
+        self._lock = threading.Lock()
+        self._token: Optional[contextvars.Token] = None
+
+    def __enter__(self) -> 'Trace':
+        self._token = _current_trace.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc is not None:
+            self.attributes.setdefault('status', 500)
+            self.attributes['error'] = str(exc)
+        self.finish()
+        _current_trace.reset(self._token)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Dict[str, Any]]:
+        """Time the enclosed block. Yields the span's attributes dict, which can be added to inside the block."""
+        start_time: float = time.time()
+        try:
+            yield attributes
+        finally:
+            duration_seconds: float = time.time() - start_time
+            with self._lock:
+                self.spans.append({
+                    'name' : name,
+                    'start_offset_seconds' : start_time - self.start_time,
+                    'duration_seconds' : duration_seconds,
+                    'attributes' : attributes,
+                })
+            get_metrics_registry().observe('ehrllm_span_duration_seconds', duration_seconds, help="Duration of each stage of a request", route=self.name, span=name)
+
+    def record_llm_call(self, prompt_tokens: int, completion_tokens: int, cached_prompt_tokens: int, cost_usd: float) -> None:
+        with self._lock:
+            self.llm_usage['n_calls'] += 1
+            self.llm_usage['prompt_tokens'] += prompt_tokens
+            self.llm_usage['completion_tokens'] += completion_tokens
+            self.llm_usage['cached_prompt_tokens'] += cached_prompt_tokens
+            self.llm_usage['cost_usd'] += cost_usd
+
+    def record_llm_cache_hit(self) -> None:
+        with self._lock:
+            self.llm_usage['n_cache_hits'] += 1
+
+    def record_llm_shared_call(self) -> None:
+        with self._lock:
+            self.llm_usage['n_shared_calls'] += 1
+
+    def finish(self) -> None:
+        self.duration_seconds = time.time() - self.start_time
+        status: str = str(self.attributes.get('status', 200))
+        registry: MetricsRegistry = get_metrics_registry()
+        registry.inc('ehrllm_requests_total', help="Requests handled, by route and HTTP status", route=self.name, status=status)
+        registry.observe('ehrllm_request_duration_seconds', self.duration_seconds, help="End-to-end request latency", route=self.name)
+        if self.path_to_trace_file:
+            line: str = json.dumps(self.to_dict(), default=str)
+            with _trace_file_lock:
+                with open(self.path_to_trace_file, 'a') as f:
+                    f.write(line + "\n")
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'trace_id' : self.trace_id,
+                'name' : self.name,
+                'start_time' : self.start_time,
+                'duration_seconds' : self.duration_seconds,
+                'attributes' : self.attributes,
+                'spans' : list(self.spans),
+                'llm_usage' : dict(self.llm_usage),
+            }
+
+def get_current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+def set_current_trace(trace: Optional[Trace]) -> None:
+    """Make `trace` current in this context, e.g. on another thread / task that does work for the trace's request"""
+    _current_trace.set(trace)
+
+@contextlib.contextmanager
+def span(name: str, **attributes) -> Iterator[Dict[str, Any]]:
+    """Time the enclosed block as a span of the current trace (no-op if there is no current trace)"""
+    trace: Optional[Trace] = get_current_trace()
+    if trace is None:
+        yield attributes
+        return
+    with trace.span(name, **attributes) as span_attributes:
+        yield span_attributes
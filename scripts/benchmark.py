@@ -0,0 +1,125 @@
+"""
+Benchmark the backend offline, against synthetic corpora and a local mock of an OpenAI-compatible LLM API.
+
+Generates MIMIC-IV-Note-like and n2c2-2018-like corpora of the given size, starts the mock LLM server
+(with configurable latency, errors, and 429s), points the backend at both, and runs each scenario:
+    - db_load: cold (no snapshot / parse cache) vs. warm database load
+    - patient_lookup: patient lookup + loading their notes
+    - note_fanout: one query over all of a patient's notes
+    - aggregation: aggregating 10 / 100 / 1000 note-level responses
+    - chat_load: concurrent `POST /api/chat` requests against a threaded HTTP server
+Results are printed and written as JSON to `--output`, so runs before / after a change can be compared.
+
+Usage:
+python benchmark.py
+python benchmark.py --scenarios note_fanout chat_load --databases n2c2-2018 --latency 1.0 --rate_limit_rate 0.05
+python benchmark.py --n_mimiciv_patients 10000 --scenarios db_load patient_lookup --output before.json
+python benchmark.py --llm_base_url http://localhost:8000/v1  # Use your own OpenAI-compatible server instead of the mock
+"""
+import os
+import json
+import argparse
+import tempfile
+import urllib.request
+
+SCENARIOS = [ 'db_load', 'patient_lookup', 'note_fanout', 'aggregation', 'chat_load' ]
+DATABASES = [ 'mimiciv-notes', 'n2c2-2018' ]
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', type=str, nargs='+', default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument('--databases', type=str, nargs='+', default=DATABASES, choices=DATABASES)
+    parser.add_argument('--output', type=str, default=None, help='Path to write results JSON to')
+    parser.add_argument('--data_dir', type=str, default=None, help='Where to write the synthetic corpora + caches (default: a temp dir)')
+    parser.add_argument('--seed', type=int, default=0)
+    # Synthetic corpora
+    parser.add_argument('--n_mimiciv_patients', type=int, default=1000)
+    parser.add_argument('--n_mimiciv_notes_per_patient', type=int, default=20)
+    parser.add_argument('--n_n2c2_patients', type=int, default=288)
+    parser.add_argument('--n_n2c2_notes_per_patient', type=int, default=4)
+    parser.add_argument('--n_words_per_note', type=int, default=500)
+    # Mock LLM server
+    parser.add_argument('--llm_base_url', type=str, default=None, help='OpenAI-compatible API to use instead of the mock server')
+    parser.add_argument('--latency', type=float, default=0.5, help='Mean latency (seconds) of each mock LLM response')
+    parser.add_argument('--latency_jitter', type=float, default=0.1)
+    parser.add_argument('--seconds_per_1k_prompt_tokens', type=float, default=0.0)
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of mock LLM calls that return a 500')
+    parser.add_argument('--rate_limit_rate', type=float, default=0.0, help='Fraction of mock LLM calls that return a 429')
+    parser.add_argument('--max_concurrency', type=int, default=0, help='Mock LLM calls beyond this many in flight return a 429 (0 = unlimited)')
+    parser.add_argument('--relevance_rate', type=float, default=0.5, help='Fraction of notes the mock LLM says are relevant')
+    # Scenarios
+    parser.add_argument('--model', type=str, default='gpt-4o-mini')
+    parser.add_argument('--triage_model', type=str, default=None, help='If set, chat_load uses the model cascade with this cheap triage model (e.g. openai/mock-small)')
+    parser.add_argument('--n_lookups', type=int, default=1000)
+    parser.add_argument('--n_fanout_patients', type=int, default=10)
+    parser.add_argument('--n_responses', type=int, nargs='+', default=[ 10, 100, 1000 ], help='# of note-level responses to aggregate')
+    parser.add_argument('--n_requests', type=int, default=50, help='# of /api/chat requests')
+    parser.add_argument('--concurrency', type=int, default=8, help='# of concurrent /api/chat clients')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    data_dir: str = args.data_dir or tempfile.mkdtemp(prefix='ehrllm-benchmark-')
+
+    # The backend reads its config from env vars at import time, so point it at the synthetic data
+    # (and disable the LLM response cache + dev-mode truncation) before importing anything from `ehrllm`
+    os.environ['PATH_TO_MIMICIV_NOTES_DIR'] = os.path.join(data_dir, 'mimiciv-notes')
+    os.environ['PATH_TO_N2C22018_DIR'] = os.path.join(data_dir, 'n2c2-2018')
+    os.environ['PATH_TO_CACHE_DIR'] = os.path.join(data_dir, 'cache')
+    os.environ['LLM_CACHE_BACKEND'] = 'none'
+    os.environ['ENVIRONMENT'] = 'prod'
+    os.environ.setdefault('OPENAI_API_KEY', 'mock')
+
+    import ehrllm.backend.app
+    from ehrllm.backend.app.databases.mimiciv import MIMICIVNotesDatabase
+    from ehrllm.backend.app.databases.n2c22018 import N2C22018CTMatchingDatabase
+    from ehrllm.benchmarks.mock_llm_server import MockLLMConfig, ServerThread, create_mock_llm_app
+    from ehrllm.benchmarks.scenarios import run_scenarios
+    from ehrllm.benchmarks.synthetic_data import generate_mimiciv_notes, generate_n2c22018_notes
+
+    corpora = {}
+    if 'mimiciv-notes' in args.databases:
+        corpora['mimiciv-notes'] = generate_mimiciv_notes(os.environ['PATH_TO_MIMICIV_NOTES_DIR'],
+                                                          n_patients=args.n_mimiciv_patients,
+                                                          n_notes_per_patient=args.n_mimiciv_notes_per_patient,
+                                                          n_words_per_note=args.n_words_per_note,
+                                                          seed=args.seed)
+    if 'n2c2-2018' in args.databases:
+        corpora['n2c2-2018'] = generate_n2c22018_notes(os.environ['PATH_TO_N2C22018_DIR'],
+                                                       n_patients=args.n_n2c2_patients,
+                                                       n_notes_per_patient=args.n_n2c2_notes_per_patient,
+                                                       n_words_per_note=args.n_words_per_note,
+                                                       seed=args.seed)
+    print(f"Synthetic corpora in {data_dir}: {json.dumps(corpora)}")
+
+    mock_config = MockLLMConfig(latency_seconds=args.latency,
+                                latency_jitter_seconds=args.latency_jitter,
+                                seconds_per_1k_prompt_tokens=args.seconds_per_1k_prompt_tokens,
+                                error_rate=args.error_rate,
+                                rate_limit_rate=args.rate_limit_rate,
+                                max_concurrency=args.max_concurrency,
+                                relevance_rate=args.relevance_rate,
+                                seed=args.seed)
+    with ServerThread(create_mock_llm_app(mock_config)) as mock_server:
+        os.environ['OPENAI_API_BASE'] = args.llm_base_url or f"{mock_server.url}/v1"
+        print(f"LLM API: {os.environ['OPENAI_API_BASE']}")
+
+        databases = [ { 'mimiciv-notes' : MIMICIVNotesDatabase, 'n2c2-2018' : N2C22018CTMatchingDatabase }[db] for db in args.databases ]
+        config = {
+            'model' : args.model,
+            'triage_model' : args.triage_model,
+            'n_lookups' : args.n_lookups,
+            'n_fanout_patients' : args.n_fanout_patients,
+            'n_responses_list' : args.n_responses,
+            'n_requests' : args.n_requests,
+            'concurrency' : args.concurrency,
+        }
+        results = run_scenarios(args.scenarios, databases, config, on_result=lambda result: print(json.dumps(result, indent=2)))
+        with urllib.request.urlopen(f"{mock_server.url}/stats") as response:
+            mock_llm_stats = json.loads(response.read())
+        print(f"Mock LLM server: {json.dumps(mock_llm_stats)}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({ 'args' : vars(args), 'corpora' : corpora, 'results' : results, 'mock_llm_server' : mock_llm_stats }, f, indent=2)
+        print(f"Results: {args.output}")
@@ -0,0 +1,26 @@
+"""
+Build the normalized, patient-sorted snapshot of the MIMIC-IV notes that the backend memory-maps at startup.
+
+The backend also builds this automatically on first start (or whenever the source CSVs change),
+so running this script is only needed to pay that cost ahead of time (e.g. before deploying).
+
+Usage:
+python build_mimiciv_snapshot.py
+python build_mimiciv_snapshot.py --force
+"""
+import argparse
+from ehrllm.utils import get_rel_path
+from ehrllm.backend.app.config import PATH_TO_MIMICIV_NOTES_DIR, PATH_TO_MIMICIV_SNAPSHOT_DIR
+from ehrllm.backend.app.databases.mimiciv import ensure_snapshot
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default=PATH_TO_MIMICIV_NOTES_DIR)
+    parser.add_argument('--snapshot_dir', type=str, default=PATH_TO_MIMICIV_SNAPSHOT_DIR)
+    parser.add_argument('--force', action='store_true', help='Rebuild even if the existing snapshot is up-to-date')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    path_to_snapshot: str = ensure_snapshot(get_rel_path(args.data_dir), get_rel_path(args.snapshot_dir), is_force=args.force)
+    print(f"Snapshot: {path_to_snapshot}")
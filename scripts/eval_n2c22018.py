@@ -0,0 +1,44 @@
+"""
+Evaluate the chat pipeline on every n2c2 2018 criterion x patient against the gold labels.
+
+Predictions are checkpointed to `--output_dir` as they finish, so re-running the same command
+after a crash (or Ctrl-C) resumes where it left off. Use `--restart` to discard previous predictions.
+NOTE: Set ENVIRONMENT=prod to evaluate all patients (in dev, only the first 10 are loaded).
+
+Usage:
+python eval_n2c22018.py
+python eval_n2c22018.py --model gpt-4o --criteria MI-6MOS KETO-1YR --n_workers 16
+python eval_n2c22018.py --single_pass
+"""
+import os
+import json
+import argparse
+from ehrllm.backend.app.config import PATH_TO_CACHE_DIR
+from ehrllm.backend.app.databases.n2c22018 import LABEL_2_DEFINITION
+from ehrllm.backend.app.services.evaluation import CHECKPOINT_FILENAME, run_evaluation
+from ehrllm.llms.utils import DEFAULT_MODEL
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default=DEFAULT_MODEL)
+    parser.add_argument('--output_dir', type=str, default=None, help='Defaults to <PATH_TO_CACHE_DIR>/evals/n2c2-2018/<model>')
+    parser.add_argument('--criteria', type=str, nargs='+', default=None, choices=list(LABEL_2_DEFINITION.keys()))
+    parser.add_argument('--patient_ids', type=str, nargs='+', default=None)
+    parser.add_argument('--n_workers', type=int, default=8, help='# of (patient, criterion) pairs evaluated concurrently')
+    parser.add_argument('--single_pass', action='store_true', help='Read each note once for all criteria (instead of once per criterion)')
+    parser.add_argument('--restart', action='store_true', help='Discard predictions from previous runs')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    output_dir: str = args.output_dir or os.path.join(PATH_TO_CACHE_DIR, 'evals', 'n2c2-2018', args.model.replace('/', '_'))
+    if args.restart and os.path.exists(os.path.join(output_dir, CHECKPOINT_FILENAME)):
+        os.remove(os.path.join(output_dir, CHECKPOINT_FILENAME))
+    
+    results = run_evaluation(output_dir, criteria=args.criteria, patient_ids=args.patient_ids, n_workers=args.n_workers, is_single_pass=args.single_pass, model=args.model)
+    
+    print(json.dumps(results['metrics']['per_criterion'], indent=2))
+    print(json.dumps(results['run'], indent=2))
+    overall = results['metrics']['overall']
+    print(f"Overall: accuracy={overall['accuracy']:.3f} | micro F1={overall['f1']:.3f} | macro F1={overall['macro_f1']:.3f} (n={overall['n']})")
+    print(f"Results: {output_dir}")
@@ -1,36 +1,58 @@
 """
-Find patients with a specific mention in the MIMIC-IV notes.
+Find patients with a specific mention in their notes, using the cohort-wide full-text search index.
+
+Queries support "quoted phrases", AND / OR / NOT (terms are ANDed by default), parentheses, and prefix* terms.
+The index is built on first use (or whenever the source notes change), which can take a while for MIMIC-IV.
 
 Usage:
+python find_patients.py --build
 python find_patients.py --mention "cancer"
+python find_patients.py --mention '"colorectal cancer" OR crc' --database mimiciv-notes --limit 100
+python find_patients.py --mention 'metformin AND NOT insulin' --notes
 """
-import os
-import pandas as pd
 import argparse
+import time
+from ehrllm.backend.app.services.search import SEARCH_INDEX_DATABASES, get_search_index
+
+HIGHLIGHT = ('\033[1;31m', '\033[0m')
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--mention', type=str, required=True)
+    parser.add_argument('--mention', '--query', type=str, default=None, help='Search query')
+    parser.add_argument('--database', type=str, default=None, choices=SEARCH_INDEX_DATABASES, help='Only search this database (default: all)')
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--notes', action='store_true', help='List matching notes instead of matching patients')
+    parser.add_argument('--build', action='store_true', help='(Re)build the index for any databases whose source files changed')
+    parser.add_argument('--force', action='store_true', help='With --build, rebuild even if the index is up-to-date')
     return parser.parse_args()
 
 if __name__ == '__main__':
     args = parse_args()
+    index = get_search_index()
+
+    if args.build or not index.is_built():
+        index.build(databases=[ args.database ] if args.database else SEARCH_INDEX_DATABASES, is_force=args.force)
+        print(f"Index: {index.get_stats()}")
+    if args.mention is None:
+        exit(0)
+
+    start_time = time.time()
+    try:
+        if args.notes:
+            results = index.search_notes(args.mention, database=args.database, limit=args.limit, highlight=HIGHLIGHT)
+        else:
+            results = index.search_patients(args.mention, database=args.database, limit=args.limit, highlight=HIGHLIGHT)
+    except ValueError as e:
+        print(e)
+        exit(1)
+    elapsed_ms: float = (time.time() - start_time) * 1000
 
-    df = pd.read_csv('../data/mimiciv-notes/discharge.csv')
-
-    match_count = 0
-    patient_ids = set()
-    for idx, row in df.iterrows():
-        if row['subject_id'] in patient_ids:
-            continue
-        if args.mention.lower() in row['text'].lower():
-            print(row['subject_id'])
-            # Print surrounding 100 characters around the word 'crc'
-            print(row['text'][max(0, idx - 100):min(len(row['text']), idx + 100)])
-            print('-' * 100)
-            patient_ids.add(row['subject_id'])
-        
-        if len(patient_ids) > 10:
-            break
-
-    print(f"Patients: {patient_ids}")
\ No newline at end of file
+    for result in results:
+        if args.notes:
+            print(f"[{result['database']}] patient {result['patient_id']} | note {result['note_id']} ({result['note_type']}, {result['chartdatetime']})")
+            print(result['snippet'])
+        else:
+            print(f"[{result['database']}] patient {result['patient_id']} | {result['n_matching_notes']} matching notes")
+            print(result['best_note']['snippet'])
+        print('-' * 100)
+    print(f"{len(results)} {'notes' if args.notes else 'patients'} in {elapsed_ms:.1f}ms")
@@ -0,0 +1,94 @@
+import os
+import tempfile
+
+########################################################
+# Config is read from the environment at import time, so point every path at a scratch directory
+# (and disable on-disk caches + background job workers) before anything from `ehrllm` is imported
+########################################################
+
+TEST_DIR: str = tempfile.mkdtemp(prefix='ehrllm-tests-')
+os.environ.update({
+    'ENVIRONMENT' : 'test',
+    'PATH_TO_CACHE_DIR' : os.path.join(TEST_DIR, 'cache'),
+    'PATH_TO_MIMICIV_NOTES_DIR' : os.path.join(TEST_DIR, 'mimiciv-notes'),
+    'PATH_TO_N2C22018_DIR' : os.path.join(TEST_DIR, 'n2c2-2018'),
+    'LLM_CACHE_BACKEND' : 'none',
+    'RESPONSE_CACHE_BACKEND' : 'none',
+    'JOB_N_WORKERS' : '0',
+    'OPENAI_API_KEY' : 'test',
+})
+
+import ehrllm.backend.app # noqa: E402 -- import the app package first, which avoids a circular import via `ehrllm.llms.utils`
+
+import asyncio # noqa: E402
+import json # noqa: E402
+import random # noqa: E402
+import threading # noqa: E402
+import types # noqa: E402
+from typing import Any, Dict, List # noqa: E402
+import litellm # noqa: E402
+import pytest # noqa: E402
+from ehrllm.backend.app.databases.mimiciv import MIMICIVNotesDatabase # noqa: E402
+from ehrllm.backend.app.databases.n2c22018 import N2C22018CTMatchingDatabase # noqa: E402
+from ehrllm.benchmarks.mock_llm_server import MockLLMConfig, generate_from_schema, get_message_text # noqa: E402
+from ehrllm.benchmarks.synthetic_data import generate_mimiciv_notes, generate_n2c22018_notes # noqa: E402
+
+@pytest.fixture(scope='session')
+def mimiciv_db() -> MIMICIVNotesDatabase:
+    """Process-wide MIMIC-IV database, loaded from a small synthetic corpus"""
+    generate_mimiciv_notes(os.environ['PATH_TO_MIMICIV_NOTES_DIR'], n_patients=20, n_notes_per_patient=8, n_words_per_note=80)
+    return MIMICIVNotesDatabase.instance()
+
+@pytest.fixture(scope='session')
+def n2c2_db() -> N2C22018CTMatchingDatabase:
+    """Process-wide n2c2 2018 database, loaded from a small synthetic corpus"""
+    generate_n2c22018_notes(os.environ['PATH_TO_N2C22018_DIR'], n_patients=10, n_notes_per_patient=4, n_words_per_note=80)
+    return N2C22018CTMatchingDatabase.instance()
+
+class MockLLM:
+    """Stands in for `litellm.completion` / `litellm.acompletion`, returning a random instance of the requested `response_format`
+        (every boolean is True, so every note is relevant). Calls block while `gate` is cleared."""
+
+    def __init__(self):
+        self.config = MockLLMConfig(relevance_rate=1.0)
+        self.rng = random.Random(0)
+        self.n_calls: int = 0
+        self.gate = threading.Event()
+        self.gate.set()
+        self._lock = threading.Lock()
+
+    def completion(self, **kwargs) -> Any:
+        self.gate.wait()
+        return self.respond(**kwargs)
+
+    async def acompletion(self, **kwargs) -> Any:
+        # Wait off the event loop, so that a closed gate doesn't block every other in-flight call
+        await asyncio.to_thread(self.gate.wait)
+        return self.respond(**kwargs)
+
+    def respond(self, model: str, messages: List[Dict[str, Any]], response_format: Any = None, **kwargs) -> Any:
+        with self._lock:
+            self.n_calls += 1
+        prompt: str = "\n".join([ get_message_text(message) for message in messages ])
+        if response_format is not None:
+            schema: Dict[str, Any] = response_format.model_json_schema()
+            content: str = json.dumps(generate_from_schema(schema, schema.get('$defs', {}), self.rng, self.config, prompt))
+        else:
+            content = "Synthetic answer"
+        return types.SimpleNamespace(choices=[ types.SimpleNamespace(message=types.SimpleNamespace(content=content)) ],
+                                     usage=types.SimpleNamespace(prompt_tokens=len(prompt) // 4, completion_tokens=len(content) // 4, prompt_tokens_details=None))
+
+@pytest.fixture
+def mock_llm(monkeypatch: pytest.MonkeyPatch) -> MockLLM:
+    mock = MockLLM()
+    monkeypatch.setattr(litellm, 'completion', mock.completion)
+    monkeypatch.setattr(litellm, 'acompletion', mock.acompletion)
+    yield mock
+    # Never leave a blocked call behind
+    mock.gate.set()
+
+@pytest.fixture(scope='session')
+def client(mimiciv_db, n2c2_db) -> Any:
+    """Flask test client for the API (over the synthetic databases)"""
+    from ehrllm.backend.app import create_app
+    return create_app().test_client()
@@ -0,0 +1,59 @@
+from typing import List
+from ehrllm.backend.app.models import Note
+from ehrllm.backend.app.services.dedup import ELIDED_SECTION_PLACEHOLDER, get_deduped_note_responses, get_note_signatures, plan_note_dedup
+from ehrllm.llms.models import LLM_ChatCompletionResponse, LLM_Evidence, LLM_Quote
+
+CKD_QUOTE: str = "chronic kidney disease stage 3 with baseline creatinine of 1.8"
+PMH_SECTION: str = (
+    "Past Medical History:\n"
+    f"Hypertension diagnosed ten years ago and managed with lisinopril. Notable for {CKD_QUOTE}, followed by nephrology every six months. "
+    "Remote appendectomy in childhood without complications. No known history of coronary artery disease or prior myocardial infarction."
+)
+PROGRESS_SECTION: str = (
+    "Interval History:\n"
+    "Patient seen in clinic today for routine follow up of blood pressure. Reports good adherence to medications and no new complaints. "
+    "Denies chest pain, shortness of breath, palpitations, or lower extremity swelling. Home blood pressure readings are at goal."
+)
+
+def make_response(is_relevant: bool, evidence: List[LLM_Evidence] = []) -> LLM_ChatCompletionResponse:
+    return LLM_ChatCompletionResponse(thinking='', reflection='', is_relevant=is_relevant, evidence=evidence)
+
+def test_near_duplicate_with_elided_section_keeps_source_evidence():
+    # Newest first: a discharge summary with the PMH section, a progress note that copied the PMH section forward,
+    # and an older near-duplicate of that progress note (which shares the progress note's LLM call)
+    notes: List[Note] = [
+        Note(note_id='discharge', text=f"Discharge Summary:\nAdmitted for hypertensive urgency.\n\n{PMH_SECTION}"),
+        Note(note_id='progress', text=f"{PROGRESS_SECTION}\n\n{PMH_SECTION}\n\nPlan:\nContinue current regimen."),
+        Note(note_id='progress_copy', text=f"{PROGRESS_SECTION}\n\n{PMH_SECTION}\n\nPlan:\nContinue current regimen!"),
+    ]
+    plan = plan_note_dedup(notes, get_note_signatures(notes))
+    assert plan.stats['n_near_duplicates'] == 1
+    assert plan.stats['n_sections_elided'] == 1
+    assert ELIDED_SECTION_PLACEHOLDER in plan.units[1].text and CKD_QUOTE not in plan.units[1].text
+
+    # Only the discharge summary's call sees the CKD quote. The progress note's call (with PMH elided) finds nothing.
+    ckd_evidence = LLM_Evidence(claim='Patient has CKD', quotes=[ LLM_Quote(quote=CKD_QUOTE, source='discharge') ])
+    unit_responses: List[LLM_ChatCompletionResponse] = [ make_response(True, [ ckd_evidence ]), make_response(False) ]
+    responses: List[LLM_ChatCompletionResponse] = get_deduped_note_responses(plan, notes, unit_responses)
+
+    for note, response in zip(notes, responses):
+        assert response.is_relevant, note.note_id
+        assert [ q.quote for e in response.evidence for q in e.quotes ] == [ CKD_QUOTE ], note.note_id
+        assert [ q.source for e in response.evidence for q in e.quotes ] == [ note.note_id ], note.note_id
+
+def test_near_duplicate_only_keeps_quotes_it_contains():
+    notes: List[Note] = [
+        Note(note_id='new', text=f"{PROGRESS_SECTION}\n\nPlan:\nStart amlodipine for blood pressure."),
+        Note(note_id='old', text=f"{PROGRESS_SECTION}\n\nPlan:\nStart amlodipine for blood pressure!"),
+    ]
+    plan = plan_note_dedup(notes, get_note_signatures(notes))
+    assert plan.note_idx_2_unit_idx == [ 0, None ]
+    evidence: List[LLM_Evidence] = [
+        LLM_Evidence(claim='On lisinopril', quotes=[ LLM_Quote(quote='not in either note', source='new') ]),
+        LLM_Evidence(claim='Denies chest pain', quotes=[ LLM_Quote(quote='Denies chest pain', source='new') ]),
+        LLM_Evidence(claim='Hypertensive', quotes=[]),
+    ]
+    responses: List[LLM_ChatCompletionResponse] = get_deduped_note_responses(plan, notes, [ make_response(True, evidence) ])
+    assert [ e.claim for e in responses[1].evidence ] == [ 'Denies chest pain', 'Hypertensive' ]
+    assert responses[1].evidence[0].quotes[0].source == 'old'
+    assert responses[1].is_relevant
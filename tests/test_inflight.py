@@ -0,0 +1,120 @@
+import asyncio
+import threading
+import time
+import uuid
+from typing import Any, Callable, List
+import pytest
+from ehrllm.backend.app.models import Note
+from ehrllm.benchmarks.scenarios import get_patient_ids
+from ehrllm.inflight import InFlightDeduplicator, get_inflight_deduplicator
+from ehrllm.llms.models import LLM_ChatCompletionResponse
+from ehrllm.llms.utils import call_llm_with_retries
+
+def wait_for(condition: Callable[[], bool], timeout: float = 5) -> None:
+    deadline: float = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.01)
+
+def run_threads(func: Callable[[], Any], n_threads: int) -> List[threading.Thread]:
+    threads: List[threading.Thread] = [ threading.Thread(target=func) for _ in range(n_threads) ]
+    for thread in threads:
+        thread.start()
+    return threads
+
+def test_concurrent_calls_share_one_execution():
+    deduplicator = InFlightDeduplicator('test')
+    is_released = threading.Event()
+    n_runs: List[int] = [ 0 ]
+    def func(x: int) -> int:
+        n_runs[0] += 1
+        is_released.wait(5)
+        return x * 2
+    results: List[Any] = []
+    threads: List[threading.Thread] = run_threads(lambda: results.append(deduplicator.run_with_status('key', func, 21)), 5)
+    wait_for(lambda: deduplicator.get_stats()['n_shared'] == 4)
+    assert deduplicator.get_stats()['n_in_flight'] == 1
+    is_released.set()
+    for thread in threads:
+        thread.join(5)
+    assert n_runs[0] == 1
+    assert sorted(results) == [ (42, False) ] + [ (42, True) ] * 4
+    # Nothing is remembered once the call finishes
+    assert deduplicator.get_stats() == { 'n_calls' : 1, 'n_shared' : 4, 'n_in_flight' : 0 }
+    assert deduplicator.run_with_status('key', func, 1) == (2, False)
+    assert n_runs[0] == 2
+
+def test_exceptions_are_shared_with_followers():
+    deduplicator = InFlightDeduplicator('test')
+    is_released = threading.Event()
+    def func():
+        is_released.wait(5)
+        raise ValueError("boom")
+    errors: List[Exception] = []
+    def call():
+        try:
+            deduplicator.run('key', func)
+        except ValueError as e:
+            errors.append(e)
+    threads: List[threading.Thread] = run_threads(call, 3)
+    wait_for(lambda: deduplicator.get_stats()['n_shared'] == 2)
+    is_released.set()
+    for thread in threads:
+        thread.join(5)
+    assert [ str(e) for e in errors ] == [ "boom" ] * 3
+    assert deduplicator.get_stats()['n_in_flight'] == 0
+
+def test_arun_shares_one_execution():
+    deduplicator = InFlightDeduplicator('test')
+    n_runs: List[int] = [ 0 ]
+    async def func(key: str) -> str:
+        n_runs[0] += 1
+        await asyncio.sleep(0.05)
+        return key.upper()
+    async def main() -> List[Any]:
+        return await asyncio.gather(*[ deduplicator.arun_with_status(key, func, key) for key in [ 'a', 'a', 'b', 'a' ] ])
+    assert asyncio.run(main()) == [ ('A', False), ('A', True), ('B', False), ('A', True) ]
+    assert n_runs[0] == 2
+
+def test_identical_llm_calls_share_one_request(mock_llm):
+    messages: List[dict] = [ { 'role' : 'user', 'content' : f"Is this patient diabetic? {uuid.uuid4()}" } ]
+    deduplicator: InFlightDeduplicator = get_inflight_deduplicator('llm_call')
+    n_shared: int = deduplicator.get_stats()['n_shared']
+    mock_llm.gate.clear()
+    results: List[Any] = []
+    threads: List[threading.Thread] = run_threads(lambda: results.append(call_llm_with_retries(messages, model='gpt-4o-mini', response_format=LLM_ChatCompletionResponse)), 4)
+    wait_for(lambda: deduplicator.get_stats()['n_shared'] == n_shared + 3)
+    mock_llm.gate.set()
+    for thread in threads:
+        thread.join(5)
+    assert mock_llm.n_calls == 1
+    assert len(results) == 4 and all([ result == results[0] for result in results ])
+    # Each caller gets its own copy, so mutating one response can't leak into another
+    assert len(set([ id(result) for result in results ])) == 4
+    # A different request (here, different kwargs) is not shared
+    call_llm_with_retries(messages, model='gpt-4o-mini', response_format=LLM_ChatCompletionResponse, max_tokens=100)
+    assert mock_llm.n_calls == 2
+
+def test_concurrent_patient_loads_share_one_load(mimiciv_db, monkeypatch: pytest.MonkeyPatch):
+    patient_id: str = str(get_patient_ids(mimiciv_db)[0])
+    is_released = threading.Event()
+    n_loads: List[int] = [ 0 ]
+    get_patient_notes = mimiciv_db.get_patient_notes
+    def slow_get_patient_notes(*args, **kwargs) -> List[Note]:
+        n_loads[0] += 1
+        is_released.wait(5)
+        return get_patient_notes(*args, **kwargs)
+    monkeypatch.setattr(mimiciv_db, 'get_patient_notes', slow_get_patient_notes)
+    deduplicator: InFlightDeduplicator = get_inflight_deduplicator('patient_notes')
+    n_shared: int = deduplicator.get_stats()['n_shared']
+    results: List[List[Note]] = []
+    threads: List[threading.Thread] = run_threads(lambda: results.append(mimiciv_db.load_patient_notes(patient_id)), 3)
+    wait_for(lambda: deduplicator.get_stats()['n_shared'] == n_shared + 2)
+    is_released.set()
+    for thread in threads:
+        thread.join(5)
+    assert n_loads[0] == 1
+    assert len(results) == 3 and len(results[0]) > 0
+    assert all([ [ n.note_id for n in result ] == [ n.note_id for n in results[0] ] for result in results ])
+    # Callers share the notes but not the list
+    assert len(set([ id(result) for result in results ])) == 3
@@ -0,0 +1,80 @@
+import threading
+import time
+from typing import Any, Dict, List
+import pytest
+from ehrllm.backend.app.routes import run_chat_job
+from ehrllm.backend.app.services.jobs import JOB_STATUS_CANCELLED, JOB_STATUS_RUNNING, JOB_STATUS_SUCCEEDED, Job, JobQueue, JobRun
+from ehrllm.benchmarks.scenarios import get_patient_ids
+
+def wait_for_job(queue: JobQueue, job_id: str, timeout: float = 30) -> Job:
+    deadline: float = time.time() + timeout
+    while not queue.get(job_id).is_finished():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.05)
+    return queue.get(job_id)
+
+@pytest.mark.parametrize('limit', [ 'abc', '1.5', '0', '-1', '1001' ])
+def test_list_jobs_rejects_invalid_limit(client, limit: str):
+    response = client.get(f"/api/jobs?limit={limit}")
+    assert response.status_code == 400
+    assert response.get_json()['error'].startswith("Invalid limit")
+
+def test_list_jobs(client):
+    assert client.get('/api/jobs?limit=1000').status_code == 200
+    assert client.get('/api/jobs?status=queued').status_code == 200
+    assert client.get('/api/jobs?status=unknown').status_code == 400
+
+def test_note_responses_are_saved_off_the_calling_thread(tmp_path, monkeypatch: pytest.MonkeyPatch):
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite'), n_workers=0)
+    run = JobRun(queue, queue.submit({ 'patientId' : '1', 'messages' : [] }))
+    thread_names: List[str] = []
+    save_note_response = queue.save_note_response
+    def recording_save_note_response(*args, **kwargs):
+        thread_names.append(threading.current_thread().name)
+        save_note_response(*args, **kwargs)
+    monkeypatch.setattr(queue, 'save_note_response', recording_save_note_response)
+    for idx in range(3):
+        run.save_note_response(f"note-{idx}", { 'is_relevant' : idx % 2 == 0 })
+    run.flush()
+    assert len(thread_names) == 3 and all([ name.startswith('job-writer') for name in thread_names ])
+    assert queue.get_note_responses(run.job.job_id) == { f"note-{idx}" : { 'is_relevant' : idx % 2 == 0 } for idx in range(3) }
+
+def test_job_resumes_from_saved_note_responses(tmp_path, mimiciv_db, mock_llm):
+    path_to_db: str = str(tmp_path / 'jobs.sqlite')
+    request: Dict[str, Any] = {
+        'patientId' : str(get_patient_ids(mimiciv_db)[0]),
+        'messages' : [ { 'role' : 'user', 'content' : 'History of diabetes?' } ],
+        'settings' : { 'database' : mimiciv_db.name, 'model' : 'gpt-4o-mini', 'prefilter' : False, 'dedup' : False },
+    }
+    queue = JobQueue(path_to_db, n_workers=1, lease_seconds=1, poll_interval_seconds=0.05)
+    queue.start(run_chat_job)
+    job: Job = wait_for_job(queue, queue.submit(request).job_id)
+    queue.stop()
+    assert job.status == JOB_STATUS_SUCCEEDED, job.error
+    assert job.n_completed == job.n_notes and job.n_notes > 3
+    assert job.result['stats']['n_resumed_notes'] == 0
+    note_id_2_response: Dict[str, Any] = queue.get_note_responses(job.job_id)
+
+    # Simulate a process that died mid-job: some note-level responses were never saved, and its lease has expired
+    lost_note_ids: List[str] = list(note_id_2_response)[:3]
+    with queue._lock:
+        queue._conn.execute("DELETE FROM job_note_responses WHERE job_id = ? AND note_id IN (?, ?, ?)", (job.job_id, *lost_note_ids))
+        queue._conn.execute("UPDATE jobs SET status = ?, worker_id = 'dead', heartbeat_at = 0, result = NULL, finished_at = NULL WHERE job_id = ?", (JOB_STATUS_RUNNING, job.job_id))
+    
+    # Another process picks it up and only queries the missing notes
+    queue = JobQueue(path_to_db, n_workers=1, lease_seconds=1, poll_interval_seconds=0.05)
+    queue.start(run_chat_job)
+    resumed_job: Job = wait_for_job(queue, job.job_id)
+    queue.stop()
+    assert resumed_job.status == JOB_STATUS_SUCCEEDED, resumed_job.error
+    assert resumed_job.n_attempts == 2
+    assert resumed_job.result['stats']['n_resumed_notes'] == job.n_notes - 3
+    assert resumed_job.result['stats']['n_llm_notes'] == 3
+    assert set(queue.get_note_responses(job.job_id)) == set(note_id_2_response)
+
+def test_cancel_queued_job(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite'), n_workers=0)
+    job: Job = queue.submit({ 'patientId' : '1', 'messages' : [] })
+    assert queue.cancel(job.job_id).status == JOB_STATUS_CANCELLED
+    assert queue._claim() is None
+    assert queue.cancel('unknown') is None
@@ -0,0 +1,68 @@
+import datetime
+from typing import List, Optional
+import pytest
+from ehrllm.backend.app.databases.base import BaseDatabase
+from ehrllm.backend.app.models import Note, NoteFilter
+from ehrllm.benchmarks.scenarios import get_patient_ids
+
+def get_note_filters(notes: List[Note]) -> List[NoteFilter]:
+    """Filters that cut through the middle of, fall entirely outside of, and exactly hit the boundaries of `notes`"""
+    dates: List[datetime.datetime] = sorted([ note.chartdatetime for note in notes if note.chartdatetime is not None ])
+    hadm_ids: List[str] = sorted(set([ note.hadm_id for note in notes if note.hadm_id is not None ]))
+    note_filters: List[NoteFilter] = [
+        NoteFilter(start_datetime=datetime.datetime(1900, 1, 1), end_datetime=datetime.datetime(1900, 1, 2)),
+        NoteFilter(start_datetime=datetime.datetime(3000, 1, 1)),
+    ]
+    if len(dates) > 0:
+        middle: datetime.datetime = dates[len(dates) // 2]
+        note_filters += [
+            NoteFilter(start_datetime=middle),
+            NoteFilter(end_datetime=middle),
+            NoteFilter(start_datetime=dates[0], end_datetime=dates[-1]),
+            NoteFilter(start_datetime=middle, end_datetime=middle),
+            NoteFilter(start_datetime=middle + datetime.timedelta(microseconds=1), end_datetime=dates[-1] - datetime.timedelta(microseconds=1)),
+        ]
+    for hadm_id in hadm_ids[:2]:
+        note_filters += [ NoteFilter(hadm_id=hadm_id), NoteFilter(hadm_id=hadm_id, start_datetime=dates[len(dates) // 2]) ]
+    note_filters.append(NoteFilter(hadm_id='not-an-admission'))
+    return note_filters
+
+@pytest.mark.parametrize('db_fixture', [ 'mimiciv_db', 'n2c2_db' ])
+def test_note_filter_pushdown_matches_unfiltered_baseline(db_fixture: str, request: pytest.FixtureRequest):
+    """Filtering inside the database (binary search over dates / admission index) returns exactly the notes that
+        filtering the patient's full list of notes would, in the same order"""
+    db: BaseDatabase = request.getfixturevalue(db_fixture)
+    patient_ids: List[str] = [ str(patient_id) for patient_id in get_patient_ids(db) ]
+    assert len(patient_ids) > 0
+    n_checked: int = 0
+    for patient_id in patient_ids:
+        notes: List[Note] = db.get_patient_notes(patient_id)
+        for note_filter in get_note_filters(notes):
+            expected: List[str] = [ note.note_id for note in notes if note_filter.matches(note) ]
+            actual: List[str] = [ note.note_id for note in db.get_patient_notes(patient_id, note_filter) ]
+            assert actual == expected, (patient_id, note_filter)
+            n_checked += 1
+    assert n_checked > 0
+
+@pytest.mark.parametrize('db_fixture', [ 'mimiciv_db', 'n2c2_db' ])
+def test_latest_note_datetime(db_fixture: str, request: pytest.FixtureRequest):
+    db: BaseDatabase = request.getfixturevalue(db_fixture)
+    for patient_id in [ str(patient_id) for patient_id in get_patient_ids(db) ]:
+        dates: List[datetime.datetime] = [ note.chartdatetime for note in db.get_patient_notes(patient_id) if note.chartdatetime is not None ]
+        latest: Optional[datetime.datetime] = db.get_patient_latest_note_datetime(patient_id)
+        assert latest == (max(dates) if len(dates) > 0 else None), patient_id
+
+def test_get_note_filter_from_settings(mimiciv_db):
+    from ehrllm.backend.app.routes import get_note_filter
+    patient_id: str = str(get_patient_ids(mimiciv_db)[0])
+    latest: datetime.datetime = mimiciv_db.get_patient_latest_note_datetime(patient_id)
+    assert get_note_filter(mimiciv_db, patient_id, {}) is None
+    # `lookback_days` counts whole days back from the latest note
+    note_filter: NoteFilter = get_note_filter(mimiciv_db, patient_id, { 'lookback_days' : 7 })
+    assert note_filter.start_datetime == datetime.datetime.combine(latest.date() - datetime.timedelta(days=7), datetime.time.min)
+    assert note_filter.end_datetime == datetime.datetime.combine(latest.date(), datetime.time.max)
+    # A bare `end_date` covers that whole day
+    assert get_note_filter(mimiciv_db, patient_id, { 'end_date' : '2150-01-01' }).end_datetime == datetime.datetime(2150, 1, 1, 23, 59, 59, 999999)
+    for settings in [ { 'lookback_days' : 'abc' }, { 'lookback_days' : -1 }, { 'start_date' : 'yesterday' }, { 'start_date' : '2150-01-02', 'end_date' : '2150-01-01' } ]:
+        with pytest.raises(ValueError):
+            get_note_filter(mimiciv_db, patient_id, settings)
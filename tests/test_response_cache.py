@@ -0,0 +1,105 @@
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Tuple
+from ehrllm.backend.app import routes
+from ehrllm.backend.app.services.response_cache import ResponseCache, get_response_cache_key
+from ehrllm.benchmarks.scenarios import get_patient_ids
+from ehrllm.llms.cache import SQLiteLLMCache
+
+def test_get_or_compute_caches_successes_only():
+    cache = ResponseCache(disk=None)
+    n_computes: List[int] = [ 0 ]
+    def compute(status: int) -> Tuple[int, Dict[str, Any]]:
+        n_computes[0] += 1
+        return status, { 'n' : n_computes[0] }
+    assert cache.get_or_compute('ok', lambda: compute(200)) == (200, { 'n' : 1 }, 'computed')
+    assert cache.get_or_compute('ok', lambda: compute(200)) == (200, { 'n' : 1 }, 'memory')
+    # Bypassing reads recomputes (and overwrites the entry)
+    assert cache.get_or_compute('ok', lambda: compute(200), is_read_cache=False) == (200, { 'n' : 2 }, 'computed')
+    assert cache.get_or_compute('ok', lambda: compute(200)) == (200, { 'n' : 2 }, 'memory')
+    # Failures are never cached
+    assert cache.get_or_compute('error', lambda: compute(500))[:2] == (500, { 'n' : 3 })
+    assert cache.get_or_compute('error', lambda: compute(500))[:2] == (500, { 'n' : 4 })
+    stats: Dict[str, Any] = cache.get_stats()
+    assert (stats['memory_hits'], stats['writes']) == (2, 2)
+
+def test_get_or_compute_coalesces_concurrent_requests():
+    cache = ResponseCache(disk=None)
+    is_started, is_released = threading.Event(), threading.Event()
+    n_computes: List[int] = [ 0 ]
+    def compute() -> Tuple[int, Dict[str, Any]]:
+        n_computes[0] += 1
+        is_started.set()
+        is_released.wait(5)
+        return 200, { 'answer' : 42 }
+    results: List[Tuple[int, Dict[str, Any], str]] = []
+    def request():
+        results.append(cache.get_or_compute('key', compute))
+    threads: List[threading.Thread] = [ threading.Thread(target=request) ]
+    threads[0].start()
+    assert is_started.wait(5)
+    threads += [ threading.Thread(target=request) for _ in range(4) ]
+    for thread in threads[1:]:
+        thread.start()
+    # Followers have joined the leader once they show up as shared calls
+    deadline: float = time.time() + 5
+    while cache._in_flight.get_stats()['n_shared'] < 4 and time.time() < deadline:
+        time.sleep(0.01)
+    is_released.set()
+    for thread in threads:
+        thread.join(5)
+    assert n_computes[0] == 1
+    assert sorted([ source for _, _, source in results ]) == [ 'coalesced' ] * 4 + [ 'computed' ]
+    assert all([ payload == { 'answer' : 42 } for _, payload, _ in results ])
+    assert cache.get_stats()['coalesced'] == 4
+
+def test_disk_read_through_and_expiry(tmp_path):
+    disk = SQLiteLLMCache(str(tmp_path / 'responses.sqlite'))
+    cache = ResponseCache(disk=disk)
+    cache.set('key', { 'answer' : 42 })
+    cache._disk_writer.shutdown(wait=True)
+    # A fresh process (empty memory) reads it back from disk, then from memory
+    cache = ResponseCache(disk=disk)
+    assert cache.get('key') == ({ 'answer' : 42 }, 'disk')
+    assert cache.get('key') == ({ 'answer' : 42 }, 'memory')
+    cache = ResponseCache(disk=None, max_age_seconds=0.05)
+    cache.set('key', { 'answer' : 42 })
+    time.sleep(0.1)
+    assert cache.get('key') == (None, None)
+
+def test_response_cache_key():
+    messages: List[Dict[str, Any]] = [ { 'id' : 'a', 'role' : 'user', 'content' : 'Diabetes?' } ]
+    key: str = get_response_cache_key('db', '1', 'model', messages, { 'dedup' : True })
+    # Client-side message ids don't matter...
+    assert key == get_response_cache_key('db', '1', 'model', [ { **messages[0], 'id' : 'b' } ], { 'dedup' : True })
+    # ...but everything that changes the answer does
+    assert key != get_response_cache_key('db', '2', 'model', messages, { 'dedup' : True })
+    assert key != get_response_cache_key('db', '1', 'other-model', messages, { 'dedup' : True })
+    assert key != get_response_cache_key('db', '1', 'model', [ { **messages[0], 'content' : 'CKD?' } ], { 'dedup' : True })
+    assert key != get_response_cache_key('db', '1', 'model', messages, { 'dedup' : False })
+
+def test_chat_is_cached_on_effective_settings(client, mimiciv_db, mock_llm, monkeypatch):
+    patient_id: str = str(get_patient_ids(mimiciv_db)[0])
+    query: str = f"History of diabetes? {uuid.uuid4()}"
+    def chat(**settings) -> Dict[str, Any]:
+        response = client.post('/api/chat', json={
+            'patientId' : patient_id,
+            'messages' : [ { 'role' : 'user', 'content' : query } ],
+            'settings' : { 'database' : mimiciv_db.name, 'model' : 'gpt-4o-mini', **settings },
+            'isUseCache' : True,
+        })
+        assert response.status_code == 200, response.get_json()
+        return response.get_json()['data']
+    
+    first: Dict[str, Any] = chat()
+    n_calls: int = mock_llm.n_calls
+    assert first['stats']['cache'] == 'computed' and n_calls > 0
+    second: Dict[str, Any] = chat()
+    assert second['stats']['cache'] == 'memory' and mock_llm.n_calls == n_calls
+    assert second['response'] == first['response'] and second['message_id'] != first['message_id']
+    # Spelling out a server default is the same request
+    assert chat(prefilter=routes.IS_PREFILTER_ENABLED, dedup=routes.IS_NOTE_DEDUP_ENABLED)['stats']['cache'] == 'memory'
+    # Changing a server default is not
+    monkeypatch.setattr(routes, 'IS_PREFILTER_ENABLED', not routes.IS_PREFILTER_ENABLED)
+    assert chat()['stats']['cache'] == 'computed' and mock_llm.n_calls > n_calls